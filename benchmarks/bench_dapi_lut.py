@@ -0,0 +1,66 @@
+"""
+Check and time the lookup-table DAPI normalisation against the original path.
+
+Purpose
+-------
+comet.py / ultivue.py used to clip, rescale and cast the DAPI plane with
+several full-image float64 passes. prep.dapi now precomputes the transform as
+a uint8 lookup table and applies it with one gather. This script:
+- asserts the LUT output is bit-identical to the original arithmetic for
+  uint16 (COMET) and uint8 (Ultivue) synthetic planes;
+- reports runtime and peak traced memory (tracemalloc) of both paths.
+
+Usage
+-----
+python -m benchmarks.bench_dapi_lut [--size 8192]      (from the repo root)
+"""
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+from prep import dapi
+from prep.percentiles import array_percentiles
+
+
+def measure(func, *args):
+    """Run ``func(*args)``; return (result, seconds, peak traced MiB)."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def lut_path(plane, lo, hi):
+    return dapi.apply_lut(plane, dapi.normalisation_lut(lo, hi, plane.dtype))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=8192, help="edge length of the synthetic square plane")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for dtype in (np.uint16, np.uint8):
+        top = np.iinfo(dtype).max
+        plane = rng.gamma(2.0, top / 40, size=(args.size, args.size)).clip(0, top).astype(dtype)
+        lo, hi = array_percentiles(plane, (0.05, 99.95))
+        # the original path edits its input in place, so it gets its own copy (not timed)
+        ref, ref_s, ref_peak = measure(dapi.normalise_reference, plane.copy(), lo, hi)
+        out, lut_s, lut_peak = measure(lut_path, plane, lo, hi)
+        if not np.array_equal(ref, out):
+            raise AssertionError(f"LUT output differs from reference for {np.dtype(dtype).name}")
+        mpx = plane.size / 1e6
+        print(f"{np.dtype(dtype).name:7s} {args.size}x{args.size}  bit-identical: yes")
+        print(f"  original : {ref_s:7.3f} s  {mpx / ref_s:8.1f} Mpx/s  peak {ref_peak:9.1f} MiB")
+        print(f"  LUT      : {lut_s:7.3f} s  {mpx / lut_s:8.1f} Mpx/s  peak {lut_peak:9.1f} MiB")
+        print(f"  speed-up {ref_s / lut_s:.1f}x, peak memory {ref_peak / lut_peak:.1f}x lower")
+
+
+if __name__ == "__main__":
+    main()
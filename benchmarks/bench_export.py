@@ -0,0 +1,110 @@
+"""
+Size / speed benchmark of the pyramid BigTIFF export options.
+
+Purpose
+-------
+For each prep.export preset and tile size, writes two representative
+synthetic 8-bit slides (a DAPI-like nuclei image and an H&E pseudo-DAPI,
+both with empty background around the tissue) and reports:
+- write time of the full pyramid;
+- file size (and ratio to uncompressed);
+- read time of level 0 back into numpy (page cache warm, i.e. decode cost)
+  and an estimated cold read at ``--bandwidth`` MB/s (size / bandwidth + decode),
+  which is what VALIS sees on scratch / NAS;
+- max |difference| of the read-back pixels (0 for lossless presets, asserted).
+Codecs missing from the local libtiff build are reported as unsupported.
+
+Usage
+-----
+python -m benchmarks.bench_export [--size 8192] [--tile-sizes 128 512] [--bandwidth 500] [--csv out.csv]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import pyvips
+from scipy import ndimage
+
+from benchmarks.bench_hne_kernel import synthetic_rgba
+from prep import export, hne
+
+
+def synthetic_dapi(size, rng):
+    """Blurred random nuclei on a dark background, tissue in a central disc."""
+    image = np.zeros((size, size), dtype=np.float32)
+    count = size * size // 400
+    ys, xs = rng.integers(0, size, count), rng.integers(0, size, count)
+    image[ys, xs] = rng.uniform(2000, 6000, count)
+    image = ndimage.gaussian_filter(image, 2.5)
+    yy, xx = np.ogrid[:size, :size]
+    tissue = (yy - size / 2) ** 2 + (xx - size / 2) ** 2 < (0.4 * size) ** 2
+    image = np.where(tissue, image + rng.normal(12, 4, image.shape), 0)
+    return np.clip(image * (255 / image.max()), 0, 255).astype(np.uint8)
+
+
+def synthetic_hne(size, rng):
+    """Pseudo-DAPI of a synthetic H&E slide (transparent border -> 0)."""
+    return hne.pseudo_dapi_array(synthetic_rgba(size, rng))
+
+
+def measure(image, options, folder, name):
+    # one file name per run: libvips caches new_from_file by file name
+    path = os.path.join(folder, f"{name}.tif")
+    start = time.perf_counter()
+    export.save_array(image, path, options)
+    write_s = time.perf_counter() - start
+    size = os.path.getsize(path)
+    start = time.perf_counter()
+    back = pyvips.Image.new_from_file(path).numpy()
+    read_s = time.perf_counter() - start
+    diff = int(np.abs(back.astype(np.int16) - image.astype(np.int16)).max())
+    os.remove(path)
+    return write_s, size, read_s, diff
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=8192, help="edge length of the synthetic square slides")
+    parser.add_argument("--presets", nargs="+", default=sorted(export.PRESETS), help="prep.export presets to compare")
+    parser.add_argument("--tile-sizes", nargs="+", type=int, default=[128, 512], help="tile edges to compare")
+    parser.add_argument("--bandwidth", type=float, default=500.0, help="storage read bandwidth (MB/s) for the cold-read estimate")
+    parser.add_argument("--csv", default=None, help="also write the table to this CSV file")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    images = {"dapi": synthetic_dapi(args.size, rng), "hne": synthetic_hne(args.size, rng)}
+    rows = []
+    with tempfile.TemporaryDirectory() as folder:
+        for name, image in images.items():
+            raw = image.nbytes
+            for preset in args.presets:
+                for tile in args.tile_sizes:
+                    options = {"preset": preset, "tile_size": tile}
+                    row = {"image": name, "preset": preset, "tile": tile}
+                    try:
+                        write_s, size, read_s, diff = measure(image, options, folder, f"{name}-{preset}-{tile}")
+                    except pyvips.Error:
+                        rows.append({**row, "note": "not supported by this libvips / libtiff build"})
+                        continue
+                    if export.is_lossless(options) and diff:
+                        raise AssertionError(f"{preset} is meant to be lossless but differs by {diff} grey levels")
+                    rows.append({**row, "write_s": round(write_s, 2), "size_mb": round(size / 1e6, 1),
+                                 "ratio": round(size / raw, 3), "read_s": round(read_s, 2),
+                                 "cold_read_s": round(size / (args.bandwidth * 1e6) + read_s, 2),
+                                 "max_diff": diff, "note": ""})
+    table = pd.DataFrame(rows)
+    if "max_diff" in table:
+        table["max_diff"] = table["max_diff"].astype("Int64")
+    print(f"Synthetic {args.size}x{args.size} uint8 slides ({args.size * args.size / 1e6:.0f} MB raw each), "
+          f"cold read at {args.bandwidth:.0f} MB/s")
+    print(table.to_string(index=False, na_rep=""))
+    if args.csv:
+        table.to_csv(args.csv, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Peak-RSS check of the numpy -> pyvips export handoff.
+
+Purpose
+-------
+The scripts used to export with ``pyvips.Image.new_from_memory(np.rot90(x).tobytes(), ...)``:
+``tobytes()`` of the (non-contiguous) rotated view duplicated the whole uint8
+image right before writing. prep.export.save_array wraps the array through the
+buffer protocol and rotates inside libvips. This script writes the same image
+both ways, each in a fresh process, and reports the peak resident memory
+added by the write on top of the image itself. libvips keeps the reduced
+pyramid levels (1/4 + 1/16 + ... ~ 1/3 of level 0) until the file is
+assembled, so both paths pay that; the legacy path pays a full extra image on
+top. It asserts that save_array stays below ``FIXED_OVERHEAD_BYTES`` plus
+``MAX_EXTRA_FRACTION`` of the image and saves at least ``MIN_SAVED_FRACTION``
+of it against the legacy path. Below ``MIN_SIZE`` the fixed libvips overhead
+would hide a full-image copy, so smaller sizes are refused.
+
+Usage
+-----
+python -m benchmarks.bench_export_memory [--size 16384]      (from the repo root, --size >= 8192)
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+
+import numpy as np
+import pyvips
+
+from prep import export
+
+MAX_EXTRA_FRACTION = 0.5    # save_array may add at most this (pyramid levels ~ 1/3 + libvips buffers)
+FIXED_OVERHEAD_BYTES = 16 * 1024 ** 2   # ... plus this, whatever the size (libvips threads and tile buffers)
+MIN_SIZE = 8192             # a copy (1x the image) is then well above the allowance
+MIN_SAVED_FRACTION = 0.75   # ... and must save at least this against tobytes() (one full copy = 1.0)
+
+
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024     # KiB on Linux
+
+
+def legacy_write(image, path):
+    rotated = np.rot90(image)
+    height, width = rotated.shape
+    pyvips.Image.new_from_memory(rotated.tobytes(), width, height, 1, "uchar").tiffsave(
+        path, tile=True, pyramid=True, compression="none", bigtiff=True)
+
+
+def zero_copy_write(image, path):
+    export.save_array(image, path, rotation=90)
+
+
+def run(mode, size, folder, queue):
+    image = np.random.default_rng(0).integers(0, 256, (size, size), dtype=np.uint8)
+    before = peak_rss()
+    path = os.path.join(folder, f"{mode}.tif")
+    {"legacy": legacy_write, "zero-copy": zero_copy_write}[mode](image, path)
+    queue.put((peak_rss() - before, os.path.getsize(path)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=16384, help="edge length of the uint8 test image")
+    args = parser.parse_args()
+    if args.size < MIN_SIZE:
+        parser.error(f"--size must be at least {MIN_SIZE}: smaller images cannot tell a copy from libvips' own buffers")
+
+    image_bytes = args.size * args.size
+    context = multiprocessing.get_context("spawn")
+    extra = {}
+    with tempfile.TemporaryDirectory() as folder:
+        for mode in ("legacy", "zero-copy"):
+            queue = context.Queue()
+            process = context.Process(target=run, args=(mode, args.size, folder, queue))
+            process.start()
+            extra[mode], _ = queue.get()
+            process.join()
+            print(f"{mode:<10}: peak RSS +{extra[mode] / 1024 ** 2:8.1f} MiB during the write "
+                  f"({extra[mode] / image_bytes:.2f}x the {image_bytes / 1024 ** 2:.0f} MiB image)")
+    if extra["zero-copy"] > FIXED_OVERHEAD_BYTES + MAX_EXTRA_FRACTION * image_bytes:
+        raise AssertionError(f"save_array added {extra['zero-copy'] / image_bytes:.2f}x the image size "
+                             f"(limit {MAX_EXTRA_FRACTION}x + {FIXED_OVERHEAD_BYTES / 1024 ** 2:.0f} MiB): "
+                             f"a full-image copy is being made")
+    if extra["legacy"] - extra["zero-copy"] < MIN_SAVED_FRACTION * image_bytes:
+        raise AssertionError("save_array did not avoid the full-image copy of the legacy path")
+
+
+if __name__ == "__main__":
+    main()
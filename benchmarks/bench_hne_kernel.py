@@ -0,0 +1,121 @@
+"""
+Check and time the fixed-point H&E pseudo-DAPI kernel against the float path.
+
+Purpose
+-------
+The pseudo-DAPI used to be computed in float64 over the full slide
+(0.4975 R + 0.4975 B + 0.005 G -> cv2.normalize -> 255 - x -> alpha mask ->
+uint8). prep.hne.pseudo_dapi_array does the same in integer arithmetic with a
+fused per-tile kernel. This script:
+- asserts the two agree to within one grey level on synthetic RGBA slides
+  (with transparent background, as OpenSlide returns outside scanned areas);
+- asserts the streamed libvips pseudo-DAPI with a resize (``--scales``, e.g.
+  2.0 for the 20x slides) matches the old rot90 -> ski.transform.rescale ->
+  min/max stretch path to within one grey level, with the same output shape;
+- reports throughput of both paths in megapixels per second.
+
+Usage
+-----
+python -m benchmarks.bench_hne_kernel [--size 8192] [--repeats 3] [--scales 2.0 0.5] [--resize-size 1024]
+(from the repo root)
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pyvips
+import skimage as ski
+
+from prep import hne
+
+TOLERANCE = 1   # grey levels
+
+
+def float_path(rgba):
+    """The original numpy/float64 pseudo-DAPI (cv2.normalize written out as scale/shift)."""
+    red, green, blue, alpha = (rgba[:, :, i] for i in range(4))
+    purple = 0.4975 * red + 0.4975 * blue + 0.005 * green
+    scale = 255.0 / (purple.max() - purple.min())
+    purple = purple * scale + (-purple.min() * scale)
+    purple = 255 - purple
+    return np.where(alpha > 0, purple, 0).astype(np.uint8)
+
+
+def synthetic_rgba(size, rng):
+    """Smooth H&E-like RGBA slide with a transparent border."""
+    yy, xx = np.mgrid[0:size, 0:size].astype(np.float32) / size
+    base = 0.5 + 0.25 * np.sin(12 * xx) * np.cos(9 * yy)
+    rgba = np.empty((size, size, 4), dtype=np.uint8)
+    for band, gain in enumerate((230, 160, 210)):
+        noise = rng.normal(0, 8, size=(size, size))
+        rgba[:, :, band] = np.clip(gain * base + noise, 0, 255)
+    rgba[:, :, 3] = 255
+    border = size // 16
+    rgba[:border] = 0
+    rgba[:, :border] = 0
+    return rgba
+
+
+def rescaled_path(rgba, scale):
+    """The original rot90 -> ski.transform.rescale -> min/max stretch of comet.py / ultivue.py."""
+    region_out = ski.transform.rescale(np.rot90(float_path(rgba)), scale)
+    stretched = 255 * (region_out - np.min(region_out)) / (np.max(region_out) - np.min(region_out))
+    return stretched.astype(np.uint8)
+
+
+def check_resize(rgba, scale):
+    """Max grey-level difference of the streamed resized pseudo-DAPI from ``rescaled_path``."""
+    ref = rescaled_path(rgba, scale)
+    out = hne.pseudo_dapi(pyvips.Image.new_from_array(rgba), scale=scale).numpy()
+    if out.shape != ref.shape:
+        raise AssertionError(f"scale {scale}: output shape {out.shape}, skimage {ref.shape}")
+    diff = np.abs(ref.astype(np.int16) - out.astype(np.int16))
+    if diff.max() > TOLERANCE:
+        raise AssertionError(f"scale {scale}: resized output differs by up to {diff.max()} grey levels "
+                             f"(tolerance {TOLERANCE})")
+    return diff
+
+
+def best_of(func, arg, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func(arg)
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=8192, help="edge length of the synthetic square slide")
+    parser.add_argument("--repeats", type=int, default=3, help="timing repeats (best is reported)")
+    parser.add_argument("--scales", type=float, nargs="*", default=[2.0, 0.5], help="resize factors to check")
+    parser.add_argument("--resize-size", type=int, default=1024, help="edge length for the resize checks")
+    args = parser.parse_args()
+
+    rgba = synthetic_rgba(args.size, np.random.default_rng(0))
+    ref, float_s = best_of(float_path, rgba, args.repeats)
+    out, fixed_s = best_of(hne.pseudo_dapi_array, rgba, args.repeats)
+    diff = np.abs(ref.astype(np.int16) - out.astype(np.int16))
+    if diff.max() > TOLERANCE:
+        raise AssertionError(f"fixed-point output differs by up to {diff.max()} grey levels (tolerance {TOLERANCE})")
+    mpx = args.size * args.size / 1e6
+    print(f"RGBA {args.size}x{args.size}: max |diff| = {diff.max()}, "
+          f"{100 * np.count_nonzero(diff) / diff.size:.4f}% of pixels differ")
+    print(f"  float64     : {float_s:7.3f} s  {mpx / float_s:8.1f} Mpx/s")
+    print(f"  fixed-point : {fixed_s:7.3f} s  {mpx / fixed_s:8.1f} Mpx/s  ({float_s / fixed_s:.1f}x)")
+
+    # odd edge lengths: the output size rounds half to even, as skimage
+    textured = np.random.default_rng(1).integers(0, 256, size=(args.resize_size + 5, args.resize_size + 97, 4),
+                                                  dtype=np.uint8)
+    textured[:, :, 3] = 255
+    for name, image in (("smooth", rgba[:args.resize_size, :args.resize_size + 96]), ("textured", textured)):
+        for scale in args.scales:
+            diff = check_resize(image, scale)
+            print(f"resize {name} x{scale}: max |diff| = {diff.max()}, "
+                  f"{100 * np.count_nonzero(diff) / diff.size:.4f}% of pixels differ")
+
+
+if __name__ == "__main__":
+    main()
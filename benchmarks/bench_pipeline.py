@@ -0,0 +1,387 @@
+"""
+Synthetic-slide benchmark suite of the COMET / Ultivue / H&E prep path, with regression tracking.
+
+Purpose
+-------
+comet.py / ultivue.py could only be timed on the cluster against patient
+data. This script generates synthetic inputs locally at several sizes:
+- pyramidal OME-TIFFs (tifffile, SubIFD pyramid, PhysicalSizeX): uint16
+  single-channel (COMET-like DAPI) and multi-channel (``--channels``);
+- pyramidal RGB slides in the Aperio layout OpenSlide reads (tiled JPEG
+  levels as successive IFDs after a thumbnail, AppMag / MPP in the description);
+and runs each pipeline stage plus the end-to-end ``prepare_sample`` against
+them, each case in a fresh process. For every case it reports throughput in
+level-0 Mpx/s, the peak RSS added by the case and the size of the outputs.
+
+Every run is appended to a JSON-lines history (``--history``) and compared
+with the latest earlier result of each case on the same host (or with
+``--baseline <run id>``): a drop
+in Mpx/s or a rise in peak memory beyond ``--tolerance``, or a change of
+output size, is flagged; ``--check`` exits with status 1 if anything is.
+
+Usage
+-----
+python -m benchmarks.bench_pipeline [--sizes 2048 8192] [--channels 4] [--cases dapi-export hne-export]
+                                    [--repeats 1] [--history FILE] [--baseline RUN] [--check]      (from the repo root)
+
+Notes
+-----
+- Without OpenSlide in libvips the H&E stages read the same slide through
+  ``tiffload`` (decode differs, pseudo-DAPI and write are the same) and the
+  end-to-end cases are reported as unsupported.
+- Peak RSS is the growth of the case process's high-water mark over the
+  imports, so it includes libvips buffers and caches.
+"""
+
+import argparse
+import importlib.util
+import multiprocessing
+import os
+import platform
+import socket
+import subprocess
+import tempfile
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+import pyvips
+import tifffile as tff
+from scipy import ndimage
+
+from prep import channels, dapi, export, hne, percentiles, telemetry, tissue
+
+TILE = 512
+LEVELS = 4                      # pyramid levels written (each half the previous)
+MPP = 0.25                      # µm/pixel of level 0 (40x)
+THUMBNAIL = 256                 # edge of the SVS thumbnail page
+DEFAULT_HISTORY = os.path.expanduser("~/.cache/spatial-prep/bench_pipeline.jsonl")
+TOLERANCE = 0.15                # relative change of Mpx/s / peak RSS flagged as a regression
+MIN_RSS_CHANGE = 32 * 1024 ** 2  # peak RSS changes below this are noise
+MIN_SECONDS = 0.1               # throughput of faster cases is timer noise, not compared
+
+
+class Unsupported(Exception):
+    """A case that cannot run in this environment (e.g. libvips without OpenSlide)."""
+
+
+def _texture(rng, peak):
+    """One TILE x TILE tile of blurred random nuclei (float32, up to ``peak``)."""
+    image = np.zeros((TILE, TILE), dtype=np.float32)
+    count = TILE * TILE // 400
+    image[rng.integers(0, TILE, count), rng.integers(0, TILE, count)] = rng.uniform(0.3, 1.0, count)
+    image = ndimage.gaussian_filter(image, 2.5, mode="wrap")
+    return image * (peak / image.max())
+
+
+def _disc(y0, x0, rows, cols, height, width):
+    """Tissue mask of a tile: a central disc covering most of the slide."""
+    yy, xx = np.ogrid[y0:y0 + rows, x0:x0 + cols]
+    return ((yy - height / 2) / height) ** 2 + ((xx - width / 2) / width) ** 2 < 0.4 ** 2
+
+
+def _tiles(height, width, make_tile):
+    """Tiles of a (height, width) plane in row-major order, cropped at the edges."""
+    for y0 in range(0, height, TILE):
+        for x0 in range(0, width, TILE):
+            rows, cols = min(TILE, height - y0), min(TILE, width - x0)
+            yield make_tile(y0, x0, rows, cols)
+
+
+def _dapi_tiles(height, width, textures, seed):
+    rng = np.random.default_rng(seed)
+    for texture in textures: # one plane per channel, as tifffile expects for CYX
+        def make_tile(y0, x0, rows, cols, texture=texture):
+            tile = np.roll(texture, (y0 * 7 + x0 * 3) % TILE, axis=(0, 1))[:rows, :cols]
+            tile = np.where(_disc(y0, x0, rows, cols, height, width), tile + rng.normal(600, 150, (rows, cols)), 0)
+            return np.clip(tile, 0, 65535).astype(np.uint16)
+        yield from _tiles(height, width, make_tile)
+
+
+def write_ome(path, size, n_channels=1, seed=0):
+    """Pyramidal uint16 OME-TIFF of ``size`` x ``size`` with ``n_channels`` channels."""
+    rng = np.random.default_rng(seed)
+    textures = [_texture(rng, rng.uniform(4000, 20000)) for _ in range(n_channels)]
+    axes = "YX" if n_channels == 1 else "CYX"
+    metadata = {"axes": axes, "PhysicalSizeX": MPP, "PhysicalSizeY": MPP,
+                "Channel": {"Name": ["DAPI"] + [f"Marker{c}" for c in range(1, n_channels)]}}
+    with tff.TiffWriter(path, bigtiff=True, ome=True) as writer:
+        for level in range(LEVELS):
+            side = max(1, size >> level)
+            shape = (side, side) if n_channels == 1 else (n_channels, side, side)
+            kwargs = {"subifds": LEVELS - 1, "metadata": metadata} if level == 0 else {"subfiletype": 1}
+            writer.write(_dapi_tiles(side, side, textures, seed + level), shape=shape, dtype=np.uint16,
+                         tile=(TILE, TILE), photometric="minisblack", **kwargs)
+
+
+def write_slide(path, size, seed=0):
+    """Pyramidal RGB slide of ``size`` x ``size`` in the Aperio SVS layout (40x, MPP in the description)."""
+    rng = np.random.default_rng(seed)
+    with tff.TiffWriter(path, bigtiff=True) as writer:
+        for level in range(LEVELS):
+            side = max(1, size >> level)
+
+            def make_tile(y0, x0, rows, cols, side=side):
+                yy, xx = np.mgrid[y0:y0 + rows, x0:x0 + cols].astype(np.float32) / side
+                base = 0.5 + 0.25 * np.sin(12 * xx) * np.cos(9 * yy)
+                tile = np.full((rows, cols, 3), 255, dtype=np.uint8)
+                tissue_mask = _disc(y0, x0, rows, cols, side, side)
+                for band, gain in enumerate((230, 160, 210)):
+                    values = np.clip(gain * base + rng.normal(0, 8, (rows, cols)), 0, 255)
+                    tile[..., band] = np.where(tissue_mask, values, 255)
+                return tile
+
+            description = (f"Aperio Image Library v12.0.0 \r\n{side}x{side} [0,0 {side}x{side}] ({TILE}x{TILE}) "
+                           f"JPEG/RGB Q=90|AppMag = 40|MPP = {MPP * (1 << level):.4f}")
+            writer.write(_tiles(side, side, make_tile), shape=(side, side, 3), dtype=np.uint8, tile=(TILE, TILE),
+                         photometric="rgb", compression="jpeg", compressionargs={"level": 90},
+                         description=description, metadata=None)
+            if level == 0: # stripped thumbnail as the second page, as in scanner SVS files
+                writer.write(np.full((THUMBNAIL, THUMBNAIL, 3), 200, dtype=np.uint8), photometric="rgb",
+                             description=f"Aperio Image Library v12.0.0 \r\n{side}x{side} -> {THUMBNAIL}x{THUMBNAIL}",
+                             metadata=None)
+
+
+def openslide_available():
+    """True if libvips can read slides through OpenSlide and the openslide module imports."""
+    return bool(pyvips.type_find("VipsForeign", "openslideload")) and importlib.util.find_spec("openslide") is not None
+
+
+def load_slide(path, level=0):
+    """``hne.open_slide``, or the same level through tiffload (plus alpha) without OpenSlide."""
+    if openslide_available():
+        return hne.open_slide(path, level)
+    return pyvips.Image.tiffload(path, page=level + (level > 0)).bandjoin(255) # page 1 is the thumbnail
+
+
+def _outputs_size(folder):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(folder) for name in names)
+
+
+# Cases: (inputs, output folder) -> level-0 pixels processed; outputs are whatever lands in the folder
+def case_ome_open(inputs, out):
+    with tff.TiffFile(inputs["dapi"]) as tif:
+        planes = [dapi.open_level(tif, level).shape for level in range(len(tif.series[0].levels))]
+    return planes[0][-2] * planes[0][-1]
+
+
+def case_dapi_tissue_box(inputs, out):
+    with tff.TiffFile(inputs["dapi"]) as tif:
+        tissue.dapi_tissue_box(tif, 0)
+        return int(np.prod(dapi.open_level(tif, 0).shape[-2:]))
+
+
+def case_dapi_percentiles(inputs, out):
+    with tff.TiffFile(inputs["dapi"]) as tif:
+        plane = dapi.open_level(tif, 0)
+        percentiles.plane_percentiles(plane)
+        return plane.size
+
+
+def case_dapi_percentiles_level2(inputs, out):
+    with tff.TiffFile(inputs["dapi"]) as tif:
+        percentiles.level_percentiles(tif, 2)
+        return dapi.open_level(tif, 0).size
+
+
+def case_dapi_export(inputs, out):
+    with tff.TiffFile(inputs["dapi"]) as tif:
+        plane = dapi.open_level(tif, 0)
+        lo, hi = percentiles.plane_percentiles(plane)
+        dapi.write_normalised(plane, os.path.join(out, "dapi.tif"), lo, hi)
+        return plane.size
+
+
+def case_channels_export(inputs, out):
+    with tff.TiffFile(inputs["multi"]) as tif:
+        channels.write_channels(tif, 0, "all", ome_path=os.path.join(out, "channels.ome.tif"))
+        return dapi.open_level(tif, 0).size
+
+
+def case_hne_limits(inputs, out):
+    slide = load_slide(inputs["slide"])
+    hne.pseudo_dapi_limits(slide)
+    return slide.width * slide.height
+
+
+def case_hne_export(inputs, out):
+    slide = load_slide(inputs["slide"])
+    image = hne.pseudo_dapi(slide, hne.pseudo_dapi_limits(slide))
+    export.tiffsave(export.rotate(image, 90), os.path.join(out, "hne.tif"))
+    return slide.width * slide.height
+
+
+def _end_to_end(inputs, out, dapi_key, extra):
+    if not openslide_available():
+        raise Unsupported("OpenSlide not available")
+    from prep import sample
+    row = {"MedicalAchiever": "BENCH", "COMET_DAPI_path": inputs[dapi_key], "H&E_path": inputs["slide"]}
+    settings = {"catalog_index": os.path.join(out, "catalog.sqlite"), "hne_cache": os.path.join(out, "hne_cache"),
+                "telemetry": None, "concurrent_stages": True, **extra}
+    sample.prepare_sample(row, "comet", os.path.join(out, "samples"), settings)
+    os.remove(settings["catalog_index"])
+    with tff.TiffFile(inputs[dapi_key]) as tif:
+        return dapi.open_level(tif, 0).size
+
+
+def case_end_to_end(inputs, out):
+    return _end_to_end(inputs, out, "dapi", {})
+
+
+def case_end_to_end_channels(inputs, out):
+    return _end_to_end(inputs, out, "multi", {"channels": "all"})
+
+
+CASES = {
+    "ome-open": case_ome_open,
+    "dapi-tissue-box": case_dapi_tissue_box,
+    "dapi-percentiles": case_dapi_percentiles,
+    "dapi-percentiles-level2": case_dapi_percentiles_level2,
+    "dapi-export": case_dapi_export,
+    "channels-export": case_channels_export,
+    "hne-limits": case_hne_limits,
+    "hne-export": case_hne_export,
+    "end-to-end": case_end_to_end,
+    "end-to-end-channels": case_end_to_end_channels,
+}
+
+
+def run_case(name, inputs, folder):
+    """Run one case in this (fresh) process; returns seconds, peak RSS growth and output bytes."""
+    out = tempfile.mkdtemp(dir=folder)
+    begin = telemetry.snapshot()
+    try:
+        pixels = CASES[name](inputs, out)
+    except (Unsupported, ImportError) as exc:
+        return {"status": f"unsupported: {exc}"}
+    used = telemetry.usage(begin, telemetry.snapshot())
+    return {"status": "ok", "seconds": used["seconds"], "cpu_seconds": used["cpu_seconds"],
+            "mpx_per_s": pixels / 1e6 / used["seconds"], "peak_rss_mb": used["peak_rss_delta_bytes"] / 1024 ** 2,
+            "output_mb": _outputs_size(out) / 1024 ** 2}
+
+
+def run_isolated(name, inputs, folder, repeats):
+    """Best of ``repeats`` runs of a case, each in a new process (clean peak RSS, cold libvips cache)."""
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for _ in range(repeats):
+        with context.Pool(1, maxtasksperchild=1) as pool:
+            result = pool.apply(run_case, (name, inputs, folder))
+        if result["status"] != "ok":
+            return result
+        results.append(result)
+    best = min(results, key=lambda result: result["seconds"])
+    return {**best, "peak_rss_mb": min(result["peak_rss_mb"] for result in results)}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return pd.DataFrame()
+    return pd.DataFrame(telemetry.read_events(path))
+
+
+def baseline_for(history, run_id=None, host=None):
+    """Records of run ``run_id``, else the latest successful record of every case on ``host``."""
+    if history.empty:
+        return history
+    if run_id is not None:
+        return history[history["run"] == run_id]
+    runs = history[(history["host"] == host) & (history["status"] == "ok")]
+    return runs.sort_values("time").groupby(["case", "size", "channels"]).tail(1)
+
+
+def compare(current, baseline, tolerance=TOLERANCE):
+    """``current`` with the baseline's Mpx/s, peak RSS and output size, and a ``regression`` column."""
+    keys = ["case", "size", "channels"]
+    if baseline.empty:
+        return current.assign(regression="")
+    base = baseline[baseline["status"] == "ok"][keys + ["mpx_per_s", "peak_rss_mb", "output_mb"]]
+    table = current.merge(base, on=keys, how="left", suffixes=("", "_base"))
+
+    def flags(row):
+        found = []
+        if row["status"] != "ok" or pd.isna(row.get("mpx_per_s_base")):
+            return ""
+        if row["seconds"] >= MIN_SECONDS and row["mpx_per_s"] < row["mpx_per_s_base"] * (1 - tolerance):
+            found.append(f"throughput -{100 * (1 - row['mpx_per_s'] / row['mpx_per_s_base']):.0f}%")
+        rss_change = row["peak_rss_mb"] - row["peak_rss_mb_base"]
+        if rss_change * 1024 ** 2 > MIN_RSS_CHANGE and rss_change > row["peak_rss_mb_base"] * tolerance:
+            found.append(f"peak RSS +{rss_change:.0f} MiB")
+        if abs(row["output_mb"] - row["output_mb_base"]) > 0.01 * max(row["output_mb_base"], 1e-6):
+            found.append(f"output {row['output_mb_base']:.1f} -> {row['output_mb']:.1f} MiB")
+        return "; ".join(found)
+
+    return table.assign(regression=table.apply(flags, axis=1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[2048, 8192], help="level-0 edge lengths")
+    parser.add_argument("--channels", type=int, default=4, help="channels of the multi-channel OME-TIFF")
+    parser.add_argument("--cases", nargs="+", default=list(CASES), choices=list(CASES), help="cases to run")
+    parser.add_argument("--repeats", type=int, default=1, help="runs per case (best is reported)")
+    parser.add_argument("--history", default=DEFAULT_HISTORY, help="JSON-lines results history ('none': not stored)")
+    parser.add_argument("--baseline", default=None, help="run id to compare with (default: latest result of each case on this host)")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="relative change flagged as a regression")
+    parser.add_argument("--check", action="store_true", help="exit with status 1 if a regression is flagged")
+    parser.add_argument("--tmp-dir", default=None, help="where the synthetic slides are written")
+    args = parser.parse_args()
+
+    run = {"run": uuid.uuid4().hex[:12], "time": round(time.time(), 3), "host": socket.gethostname(),
+           "commit": git_commit(), "python": platform.python_version(), "vips": ".".join(str(pyvips.version(i)) for i in range(3)),
+           "cpus": hne.available_cpus()}
+    records = []
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as folder:
+        for size in args.sizes:
+            inputs = {"dapi": os.path.join(folder, f"dapi-{size}.ome.tif"),
+                      "multi": os.path.join(folder, f"multi-{size}.ome.tif"),
+                      "slide": os.path.join(folder, f"slide-{size}.svs")}
+            start = time.perf_counter()
+            write_ome(inputs["dapi"], size)
+            write_ome(inputs["multi"], size, args.channels)
+            write_slide(inputs["slide"], size)
+            print(f"{size}x{size}: synthetic inputs written in {time.perf_counter() - start:.1f} s")
+            for name in args.cases:
+                result = run_isolated(name, inputs, folder, args.repeats)
+                records.append({**run, "case": name, "size": size, "channels": args.channels if "channels" in name else 1,
+                                **result})
+                if result["status"] == "ok":
+                    print(f"  {name:<24} {result['seconds']:8.2f} s  {result['mpx_per_s']:8.1f} Mpx/s  "
+                          f"peak +{result['peak_rss_mb']:7.1f} MiB  output {result['output_mb']:7.1f} MiB")
+                else:
+                    print(f"  {name:<24} {result['status']}")
+
+    current = pd.DataFrame(records)
+    history_path = None if args.history.lower() == "none" else args.history
+    history = load_history(history_path) if history_path else pd.DataFrame()
+    baseline = baseline_for(history, args.baseline, run["host"])
+    table = compare(current, baseline, args.tolerance)
+    regressions = table[table["regression"] != ""]
+    if baseline.empty:
+        print("No baseline to compare with")
+    elif regressions.empty:
+        print("No regressions against the baseline")
+    else:
+        print("Regressions against the baseline:")
+        print(regressions[["case", "size", "channels", "mpx_per_s", "mpx_per_s_base", "peak_rss_mb",
+                           "peak_rss_mb_base", "regression"]].round(2).to_string(index=False))
+    if history_path:
+        sink = telemetry.JsonLines(history_path)
+        for record in records:
+            sink(record)
+        print(f"Run {run['run']} appended to {history_path}")
+    if args.check and not regressions.empty:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
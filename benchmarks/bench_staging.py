@@ -0,0 +1,134 @@
+"""
+Check and time node-local staging (prep.staging) shared by several processes.
+
+Purpose
+-------
+prep.batch workers and array tasks on one node share one staging directory
+and its quota. A slide staged and pinned by one process must survive another
+process making room, since the H&E is reopened several times per sample
+(tissue box, pseudo-DAPI, level shape). This script runs, each in fresh
+processes on one staging root:
+
+- pinned   : A stages f0 and holds it; B stages f1 under a quota that only
+  fits one file. B must fall back to the source and A can still reopen f0;
+  after A releases it, B's f1 evicts f0;
+- killed   : A stages f0 and is SIGKILLed while holding it; B's f1 evicts
+  f0 (the dead process's pin is swept) and no markers are left behind;
+- throughput of a first stage (copy + verify) and of a re-stage (lookup).
+
+Usage
+-----
+python -m benchmarks.bench_staging [--size-mb 256]      (from the repo root)
+"""
+
+import argparse
+import multiprocessing
+import os
+import signal
+import tempfile
+import time
+
+from prep import staging
+
+
+def hold(root, quota, path, ready, go, result):
+    """Process A: stage ``path``, hold it until ``go``, then reopen and read it."""
+    cache = staging.StagingCache(root, quota)
+    local = cache.stage(path)
+    ready.set()
+    go.wait()
+    try:
+        with open(local, "rb") as fh:
+            result.put(("ok", local != path, len(fh.read())))
+    except OSError as exc:
+        result.put(("failed", local != path, f"{type(exc).__name__}: {exc}"))
+    cache.release([local])
+
+
+def stage_once(root, quota, path, result):
+    """Process B: stage ``path`` once; reports whether a local copy was made."""
+    cache = staging.StagingCache(root, quota)
+    local = cache.stage(path)
+    result.put(local != path)
+    cache.release([local])
+
+
+def run_stage_once(context, root, quota, path):
+    result = context.Queue()
+    process = context.Process(target=stage_once, args=(root, quota, path, result))
+    process.start()
+    staged = result.get()
+    process.join()
+    return staged
+
+
+def write_file(path, size):
+    with open(path, "wb") as fh:
+        fh.write(os.urandom(size))
+    return path
+
+
+def check_pinned(context, folder, size):
+    root, quota = os.path.join(folder, "pinned"), int(size * 1.5)
+    f0, f1 = (write_file(os.path.join(folder, f"pinned-{i}.bin"), size) for i in range(2))
+    ready, go, result = context.Event(), context.Event(), context.Queue()
+    holder = context.Process(target=hold, args=(root, quota, f0, ready, go, result))
+    holder.start()
+    ready.wait()
+    if run_stage_once(context, root, quota, f1):
+        raise AssertionError("B staged f1 although f0 is pinned by A and only one file fits the quota")
+    go.set()
+    status, staged, detail = result.get()
+    holder.join()
+    if not staged or status != "ok":
+        raise AssertionError(f"A could not reopen its staged f0: {status} {detail}")
+    if not run_stage_once(context, root, quota, f1):
+        raise AssertionError("B did not stage f1 after A released f0")
+    print("pinned : another process's pinned copy survives; evicted once released")
+
+
+def check_killed(context, folder, size):
+    root, quota = os.path.join(folder, "killed"), int(size * 1.5)
+    f0, f1 = (write_file(os.path.join(folder, f"killed-{i}.bin"), size) for i in range(2))
+    ready, go, result = context.Event(), context.Event(), context.Queue()
+    holder = context.Process(target=hold, args=(root, quota, f0, ready, go, result))
+    holder.start()
+    ready.wait()
+    os.kill(holder.pid, signal.SIGKILL)
+    holder.join()
+    if not run_stage_once(context, root, quota, f1):
+        raise AssertionError("the pin of a killed process kept f0 from being evicted")
+    leftovers = [name for name in os.listdir(root) if ".pin." in name or ".copying." in name]
+    if leftovers:
+        raise AssertionError(f"markers left behind: {leftovers}")
+    print("killed : pins of a killed process are swept")
+
+
+def time_staging(folder, size):
+    source = write_file(os.path.join(folder, "throughput.bin"), size)
+    cache = staging.StagingCache(os.path.join(folder, "throughput"), 4 * size)
+    start = time.perf_counter()
+    cache.release([cache.stage(source)])
+    first = time.perf_counter() - start
+    start = time.perf_counter()
+    cache.release([cache.stage(source)])
+    again = time.perf_counter() - start
+    mib = size / 1024 ** 2
+    print(f"stage {mib:.0f} MiB: first {first:.2f} s ({mib / first:.0f} MiB/s, copy + verify), "
+          f"again {again * 1000:.1f} ms (lookup)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=256, help="size of the file timed")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as folder:
+        check_pinned(context, folder, 4 * 1024 ** 2)
+        check_killed(context, folder, 4 * 1024 ** 2)
+        time_staging(folder, args.size_mb * 1024 ** 2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Start-up cost of the prep entry points: import time and RSS of a fresh process.
+
+Purpose
+-------
+A SLURM array task preparing one small sample used to pay for napari,
+OpenSlide, scikit-image, SciPy, Zarr and pandas before its first line of
+work: comet.py / ultivue.py imported them (and read the master sheet) at
+import time. Each case here runs in a new interpreter, like an array task,
+and reports the wall time from process start to exit and the peak RSS of that
+process (best of ``--repeats``):
+
+- python        : an empty interpreter (the floor);
+- cli-help      : ``python -m prep --help``;
+- cli-parse     : ``python -m prep comet --help`` (imports prep.sample for the settings flags);
+- import-sample : ``import prep.sample`` (what a task imports before its first stage);
+- import-script : ``import comet, ultivue`` (config block only, the sheet is not read);
+- eager         : the imports comet.py used to run on start (those installed here).
+
+It asserts that the lazy entry points load none of the heavy modules, and
+prints what the saving amounts to over ``--tasks`` array tasks.
+
+Usage
+-----
+python -m benchmarks.bench_startup [--repeats 5] [--tasks 500]      (from the repo root)
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ("napari", "openslide", "cv2", "skimage", "scipy", "zarr", "pandas")
+EAGER = ("pandas", "napari", "openslide", "numpy", "tifffile", "zarr", "pyvips", "skimage.transform",
+         "scipy.ndimage")   # module-level imports of comet.py and prep before the lazy imports
+
+# Reports the heavy modules a case left in sys.modules, as the last line of its output
+_REPORT = f"import json, sys; print(json.dumps(sorted(m for m in {HEAVY!r} if m in sys.modules)))"
+
+
+def installed(name):
+    try:
+        return importlib.util.find_spec(name) is not None
+    except ModuleNotFoundError:
+        return False
+
+
+def cases():
+    """``{case: (python arguments, must stay light)}``."""
+    eager = [name for name in EAGER if installed(name.split(".")[0])]
+    return {
+        "python": (["-c", _REPORT], True),
+        "cli-help": (["-c", f"import runpy, sys; sys.argv = ['prep', '--help']\n"
+                            f"try: runpy.run_module('prep', run_name='__main__')\nexcept SystemExit: pass\n{_REPORT}"], True),
+        "cli-parse": (["-c", f"import runpy, sys; sys.argv = ['prep', 'comet', '--help']\n"
+                             f"try: runpy.run_module('prep', run_name='__main__')\nexcept SystemExit: pass\n{_REPORT}"], True),
+        "import-sample": (["-c", f"import prep.sample\n{_REPORT}"], True),
+        "import-script": (["-c", f"import comet, ultivue\n{_REPORT}"], True),
+        "eager": (["-c", "".join(f"import {name}\n" for name in eager) + _REPORT], False),
+    }
+
+
+def run_once(arguments):
+    """Wall seconds, peak RSS bytes and heavy modules loaded of one fresh ``python arguments`` process."""
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [REPO, os.environ.get("PYTHONPATH")]))}
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, *arguments], cwd=REPO, env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    out, err = process.stdout.read(), process.stderr.read()    # small outputs: no deadlock on the pipes
+    _, status, usage = os.wait4(process.pid, 0)                   # rusage of this child alone
+    seconds = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f"python {' '.join(arguments)} failed:\n{err}")
+    return seconds, usage.ru_maxrss * 1024, json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=5, help="fresh processes per case (best is reported)")
+    parser.add_argument("--tasks", type=int, default=500, help="array tasks to project the saving over")
+    args = parser.parse_args()
+
+    missing = [name for name in EAGER if not installed(name.split(".")[0])]
+    if missing:
+        print(f"Not installed here (left out of the eager case): {', '.join(missing)}")
+    results, heavy_loaded = {}, {}
+    for case, (arguments, light) in cases().items():
+        runs = [run_once(arguments) for _ in range(args.repeats)]
+        seconds, rss = min(run[0] for run in runs), min(run[1] for run in runs)
+        results[case] = (seconds, rss)
+        loaded = runs[0][2]
+        if light and loaded:
+            heavy_loaded[case] = loaded
+        print(f"{case:<14} {seconds * 1000:8.0f} ms  {rss / 1024 ** 2:8.1f} MiB  heavy modules: {', '.join(loaded) or '-'}")
+
+    saved = results["eager"][0] - results["import-sample"][0]
+    print(f"\nimport-sample vs eager: {saved * 1000:.0f} ms and "
+          f"{(results['eager'][1] - results['import-sample'][1]) / 1024 ** 2:.0f} MiB less per process, "
+          f"{saved * args.tasks / 60:.1f} min of start-up over {args.tasks} array tasks")
+    if heavy_loaded:
+        raise AssertionError(f"Entry points importing heavy modules on start: {heavy_loaded}")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,7 +6,8 @@ Purpose
 Prep large microscopy datasets for COMET–H&E co-registration:
 - Read COMET DAPI OME-TIFF pyramids lazily (tifffile → Zarr) and normalize.
 - Read H&E whole-slide images (OpenSlide) and build a pseudo-DAPI channel.
-- Handle per-sample resolution differences (20× vs 40×) with optional rescaling.
+- Handle per-sample resolution differences (20× vs 40×) with optional rescaling, or set
+  target_mpp to read the pyramid level nearest a target µm/pixel (prep/resolution.py).
 - Export pyramid BigTIFFs (pyvips) for downstream registration (e.g., VALIS).
 
 Inputs
@@ -21,13 +22,26 @@ Outputs
 - For each sample (MedicalAchiever subfolder under save_ome):
   • pseudo-dapi-comet.tif      (8-bit, tiled pyramid BigTIFF)
   • pseudo-dapi-hne-40x.tif    (8-bit, tiled pyramid BigTIFF)
+  • comet-channels.ome.tif     (8-bit multi-channel pyramidal OME-TIFF; only with channels set)
+  • comet-chNN-<name>.tif      (8-bit pyramid per channel; channel_output "separate")
+  • crop.json                  (tissue crop box, level and scale of each output; crop_to_tissue)
+  • manifest.json              (input/settings fingerprint of each output; reruns rebuild only what changed)
 - Console logs of shapes, scaling decisions, and progress
 
 Notes
 -----
-- Dependencies: numpy, pandas, tifffile, zarr, scikit-image, OpenSlide, pyvips, cv2, napari (optional).
+- Dependencies: numpy, pandas, tifffile, zarr, scikit-image, OpenSlide, pyvips, napari (optional).
 - COMET is higher resolution than Ultivue; script normalizes/optionally rescales to harmonize.
 - Memory-safe: reads OME-TIFF via Zarr; avoid full in-RAM loads for gigapixel images.
+- stream_dapi = True normalises the DAPI plane band by band (prep/dapi.py); peak memory is
+  bounded by tile_budget instead of the slide size.
+- stream_hne = True builds the H&E pseudo-DAPI as a lazy pyvips pipeline (prep/hne.py)
+  instead of reading the whole slide with OpenSlide.read_region.
+- Outputs are written under a temporary name and renamed into place; the H&E pseudo-DAPI is
+  built once in the shared hne_cache and reused by ultivue.py (prep/cache.py).
+- Levels and scale factors come from the slide catalog (headers, cached); every selected row is
+  checked before the first sample starts, so missing or inconsistent files stop the job up front
+  (prep/autoconfig.py).
 """
 # ------------------------------------------------------------------------------
 # Environment Setup
@@ -74,19 +88,8 @@ Notes
 # python
 # Import packages
 # Import packages
-import os
-import pandas as pd
-import cv2
-import numpy as np
-from scipy.stats import scoreatpercentile
-import skimage as ski
-import napari
-import tifffile as tff
-import zarr
-import gc
-import openslide
-
-import pyvips
+# napari, pandas, OpenSlide, scikit-image and Zarr are imported by the stages that need them (prep/cli.py)
+from prep import cli, dapi
 
 
 
@@ -95,107 +98,86 @@ import pyvips
 hne_path = "/mnt/scratchc/fmlab/lythgo02/Spatial/Visium_H&E/"
 save_ome = "/mnt/scratchc/fmlab/lythgo02/Spatial/valis_prep_comet_hne40x/" #valis_prep_cometlayer3_hne40x/"
 
-# Load master metadata sheet
-master_df = pd.read_excel("/mnt/scratchc/fmlab/lythgo02/Spatial/20250513_valis_meta_scratch1.xlsx")
-reg_df = master_df
+# Master metadata sheet (read when the script runs, not on import)
+metadata = "/mnt/scratchc/fmlab/lythgo02/Spatial/20250513_valis_meta_scratch1.xlsx"
 
 # Visualisation flag
 visualise = 0
-if visualise:
-    viewer = napari.Viewer()
 
 region = (0, 0)
 level = 0
 dapi_idx = 0
 
-ii=0
-
-# Loop through datasets to co-register
-for idx, row in reg_df.iterrows():
-    file_id = row["MedicalAchiever"]
-    print(f"Preparing data for co-registration: {file_id}")
-    out_folder = os.path.join(save_ome, file_id)
-    if os.path.exists(out_folder):
-        print("FILE ALREADY EXPORTED")
-        continue
-    if not os.path.exists(row["COMET_DAPI_path"]):
-        print("No valid DAPI path found — skipping.")
-        continue
-    dapi_path = row["COMET_DAPI_path"]
-    tif = tff.TiffFile(dapi_path)
-    position_series = tif.series[0] # Use Zarr to avoid loading into memory the complete image
-    position_zarr = zarr.open(position_series.aszarr(), mode='r')
-    position_zarr = position_zarr[0] #choose pyramid/resolution
-    print(np.shape(position_zarr))
-    if position_zarr.ndim == 3: # Load DAPI image and preprocess it
-        wsiStain = np.array(position_zarr[int(dapi_idx), :, :])
-    elif position_zarr.ndim == 2:
-        wsiStain = np.array(position_zarr)
-    else:
-        raise ValueError(f"Unexpected array shape: {position_zarr.shape}")
-    upcy5_wb = scoreatpercentile(wsiStain,99.95)
-    lwcy5_wb = scoreatpercentile(wsiStain,0.05)
-    wsiStain[wsiStain > upcy5_wb] = upcy5_wb
-    wsiStain[wsiStain < lwcy5_wb] = lwcy5_wb        
-    wsiStain[wsiStain<0]=0
-    wsiStain = 255*(wsiStain-lwcy5_wb)/(upcy5_wb-lwcy5_wb)
-    print(wsiStain.shape)
-    downscale_ultivue = False  # set dynamically if needed # Downscale Ultivue DAPI by 0.925x
-    if downscale_ultivue:
-        print("Downscaling Ultivue DAPI by 0.9245x")
-        wsiStain = ski.transform.rescale(wsiStain, 0.9245, anti_aliasing=True, preserve_range=True)
-        print("Downscaled Ultivue DAPI shape:", wsiStain.shape)
-    if not os.path.exists(row["H&E_path"]):
-        print("No valid H&E path found — skipping.")
-        continue
-    hne_file_path = row["H&E_path"]
-    wsi_hne = openslide.OpenSlide(hne_file_path)  # Load HnE image
-    size = wsi_hne.level_dimensions[0]
-    print(size)
-    region_img = wsi_hne.read_region((0,0), level, size)
-    rgba_array = np.array(region_img)
-    red_channel = rgba_array[:, :, 0] # Split the RGBA channels
-    green_channel = rgba_array[:, :, 1]
-    blue_channel = rgba_array[:, :, 2]
-    alpha_channel = rgba_array[:, :, 3]
-    purple_intensity = 0.4975 * red_channel + 0.4975 * blue_channel + 0.005 * green_channel # Create a pseudo-DAPI from HnE as an inverted grayscale image using a weighted combination of red and blue channels
-    purple_intensity = cv2.normalize(purple_intensity, None, 0, 255, cv2.NORM_MINMAX)
-    purple_intensity = 255-purple_intensity    
-    purple_intensity = np.where(alpha_channel>0, purple_intensity, 0).astype(np.uint8)
-    if len(purple_intensity.shape) == 3 and purple_intensity.shape[2] == 1:
-        purple_intensity = purple_intensity[:, :, 0]
-    region_out = np.rot90(purple_intensity) # Aperio rotates 90degrees compared to COMET data
-    shape_fixed = wsiStain.shape
-    low_res_samples = ["CRU00162406-039", "CRU00167339-030"]  # scanned at 20x not 40x # Optional: Upscale H&E if scanned at lower resolution (e.g., 20x, ~0.5034 µm/pixel)
-    if file_id in low_res_samples:
-        region_out  = ski.transform.rescale(region_out,2.0)
-    else:
-        region_out  = ski.transform.rescale(region_out,1.0)   #set to 0.5 to downsacle the 40x to 20x
-    print(f"No scaling applied for 40x H&E for {file_id}")
-    shape_moving = region_out.shape
-    print(shape_moving)
-    cropped_region = 255*(region_out-np.min(region_out))/(np.max(region_out)-np.min(region_out)) # Output normalised pseudo-DAPI from HnE  
-    if wsiStain.dtype != np.uint8:
-        wsiStain = wsiStain.astype(np.uint8)
-    if cropped_region.dtype != np.uint8:
-        cropped_region = cropped_region.astype(np.uint8)   
-    height, width = wsiStain.shape
-    height_h, width_h = cropped_region.shape
-    if not os.path.exists(out_folder):
-        os.makedirs(out_folder)
-    # import pdb; pdb.set_trace()
-    vips_image = pyvips.Image.new_from_memory(
-        wsiStain.tobytes(), width, height, 1, 'uchar')
-    vips_image.tiffsave(os.path.join(out_folder, "pseudo-dapi-comet.tif"), tile=True, pyramid=True, compression="none", bigtiff=True)
-    vips_image2 = pyvips.Image.new_from_memory(
-        cropped_region.tobytes(), width_h, height_h, 1, 'uchar')
-    vips_image2.tiffsave(os.path.join(out_folder, "pseudo-dapi-hne-40x.tif"), tile=True, pyramid=True, compression="none", bigtiff=True)
-    if visualise:
-        viewer.add_image(cropped_region, name=f'Purple Intensity Image', blending='additive',opacity=1.0)
-        viewer.add_image(wsiStain, name=f'Purple Intensity Image', blending='additive',opacity=1.0)
-    wsi_hne.close()
-    del red_channel, green_channel, blue_channel, rgba_array, cropped_region, wsiStain, tif, position_series, position_zarr, purple_intensity
-    gc.collect()
-    print('Saved DAPI/DAPI-like files')
-    print('----')
+# Target resolution (µm/pixel) for both exports, e.g. 0.4977 to match Ultivue. The pyramid level
+# closest to it is read from each file's own metadata (OME PhysicalSizeX / openslide.mpp-x) and
+# only the residual is resampled. None keeps level 0 (DAPI unscaled, H&E brought to hne_objective).
+target_mpp = None
+
+# Crop to a padded tissue bounding box found on the coarsest pyramid level (Otsu + morphology);
+# crop offsets and scale are recorded in <out_folder>/crop.json to map registration results back
+crop_to_tissue = True
+
+# Out-of-core DAPI mode: normalise the pyramid level band by band straight from the Zarr store
+# instead of loading the full plane (peak memory bounded by tile_budget, not slide size)
+stream_dapi = True
+tile_budget = dapi.DEFAULT_TILE_BUDGET  # bytes of DAPI band data held in memory at once
+# Clip limits: None = exact histogram over the exported level; N = estimate from pyramid level N (much faster)
+percentile_level = None
+
+# Lazy pyvips H&E pipeline (openslideload -> weighting -> mask -> rot90 -> resize -> tiffsave)
+# instead of a full-slide read_region; runs in bounded memory on all CPUs SLURM allocated
+stream_hne = True # (libvips then uses every CPU SLURM allocated)
+
+# H&E magnification to export at: slides scanned at another objective power (e.g. the 20x scans) are rescaled
+# to it, read from each slide's openslide.objective-power / mpp-x in the slide catalog (prep/catalog.py)
+hne_objective = 40
+
+# Check every selected row against the slide catalog before the first sample starts and stop on any
+# missing or inconsistent file (False: skip those samples and process the rest)
+fail_fast = True
+
+# Shared store of H&E pseudo-DAPIs, built once per slide and settings and hard-linked into each sample folder
+# (the COMET and Ultivue runs reuse each other's). None = hne_pseudo_dapi_cache next to save_ome
+hne_cache = None
+
+# Overlap work: DAPI and H&E exports of a sample in parallel threads, and the next sample's input
+# files read into the page cache (up to prefetch_bytes each, 0 = off) while the current one is written
+concurrent_stages = True
+prefetch_bytes = 4 * 1024 ** 3
+
+# Node-local staging: copy each input from the NAS / scratch mount to local disk with one sequential read
+# (size and checksum verified) and read it from there; the next sample is staged in the background instead
+# of prefetched. None = off, "auto" = $TMPDIR, or a directory. Least recently used copies are evicted to
+# stay under staging_quota bytes (prep/staging.py)
+staging_dir = None
+staging_quota = 200 * 1024 ** 3
+
+# Stage telemetry: wall / CPU time, peak RSS and bytes read / written of every stage, one JSON line per event
+# ("auto" = <save_ome>/prep_telemetry.jsonl, None = off; python -m prep.telemetry <file> summarises it).
+# profile = "py-spy" names threads after their stage for py-spy dump / record, "tracemalloc" traces allocations
+telemetry = "auto"
+profile = None
+
+# Pyramid compression / tiling of both outputs: "none" (as before), "deflate", "lzw", "zstd", "jpeg95", "jpeg85",
+# or a dict such as {"preset": "deflate", "tile_size": 512}; see prep/export.py and benchmarks/bench_export.py
+export_options = "none"
+
+# Multiplex channels: None exports the DAPI only. "all" or a list of indices also normalises those channels
+# (per-channel clip limits) in the same read of the OME-TIFF as the DAPI (prep/channels.py), written as
+# one multi-channel OME-TIFF with the channel names ("ome"), one pyramid per channel ("separate") or "both"
+channels = None
+channel_output = "ome"
+
+settings = dict(level=level, dapi_idx=dapi_idx, target_mpp=target_mpp, crop_to_tissue=crop_to_tissue,
+                stream_dapi=stream_dapi, tile_budget=tile_budget, percentile_level=percentile_level,
+                stream_hne=stream_hne, hne_objective=hne_objective, fail_fast=fail_fast,
+                hne_cache=hne_cache, concurrent_stages=concurrent_stages, prefetch_bytes=prefetch_bytes,
+                export=export_options, channels=channels, channel_output=channel_output,
+                staging_dir=staging_dir, staging_quota=staging_quota, telemetry=telemetry, profile=profile)
 
+# Loop through datasets to co-register (one sample at a time, next one prefetched; python -m prep batch runs them in parallel).
+# Optional subset for SLURM array tasks (python -m prep plan): --sample ID [ID ...], --samples-file, --shard i/N.
+# Without arguments every row is processed, as before. python -m prep comet takes the same settings as flags.
+if __name__ == "__main__":
+    args = cli.script_arguments()
+    cli.run("comet", metadata, save_ome, settings, cli.selected_samples(args), args.shard, visualise)
@@ -0,0 +1,25 @@
+"""
+Shared helpers for the COMET / Ultivue / H&E co-registration prep scripts
+(comet.py, ultivue.py), and their command line: python -m prep comet|ultivue|hne|batch|plan|catalog|telemetry|register.
+
+Modules
+-------
+- dapi        : out-of-core (band-by-band) DAPI normalisation and pyramid export.
+- channels    : single-pass multi-channel export (per-channel limits, OME-TIFF or one pyramid per channel).
+- percentiles : exact histogram percentiles (streamed or from a lower pyramid level).
+- hne         : lazy pyvips H&E pseudo-DAPI pipeline and fixed-point numpy kernel.
+- resolution  : pick the pyramid level nearest a target µm/pixel from file metadata.
+- tissue      : tissue bounding-box detection on a low pyramid level and crop sidecars.
+- sample      : prepare_sample, the per-sample body of comet.py / ultivue.py.
+- cache       : input-fingerprinted incremental outputs, atomic writes, shared H&E store.
+- export      : pyramid BigTIFF compression / tile size / predictor / depth options.
+- pipeline    : concurrent DAPI / H&E stages, next-sample prefetch and stage timings.
+- telemetry   : per-stage wall / CPU time, peak RSS and I/O as JSON lines, run summaries (python -m prep.telemetry).
+- staging     : node-local copies of NAS inputs (checksum-verified, LRU-evicted under a quota).
+- batch       : process-pool batch runner with a memory budget (python -m prep.batch).
+- catalog     : parallel, SQLite-indexed slide metadata catalog behind the gather_* scripts (python -m prep.catalog).
+- autoconfig  : per-sample levels / scale factors from the catalog, all rows checked before any heavy I/O.
+- plan        : per-sample memory / runtime estimates and SLURM array scripts (python -m prep.plan).
+- registration: batch VALIS registration of the sample folders, cached transforms, warp-only reuse (python -m prep register).
+- cli         : the python -m prep entry point; heavy / optional libraries are imported by the stages that use them.
+"""
@@ -0,0 +1,6 @@
+"""python -m prep <command>: see prep/cli.py."""
+
+from prep.cli import main
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""
+Metadata-driven per-sample configuration, checked before any heavy I/O.
+
+Purpose
+-------
+comet.py / ultivue.py hard-coded which H&E slides were scanned at 20x
+(``low_res_samples``) and an Ultivue downscale flag, and every stage re-opened
+the slides to learn their shapes. ``configure`` joins the rows of the master
+sheet with the slide catalog (prep.catalog: header reads, cached in its
+SQLite index) and derives for every sample:
+
+- the DAPI pyramid level and residual scale (``level``, or ``target_mpp``
+  through the OME PhysicalSizeX);
+- the H&E level and scale: with ``target_mpp`` from the slide MPP, otherwise
+  ``hne_objective`` / the slide's objective power, so 20x scans are upsampled 2x
+  to match 40x ones as the hard-coded list did, for any new slide too;
+- the level shapes, dtype and channel count prep.batch and prep.plan size
+  their memory / runtime estimates with.
+
+Every row is checked up front and all problems are reported at once in a
+ValueError: missing or unreadable files, no pixel size where ``target_mpp``
+needs one, objective power and MPP that contradict each other, unsupported dtypes,
+channel or level indices out of range and duplicate sample IDs. A long job
+then fails in its first seconds instead of on sample 37.
+
+Notes
+-----
+- A blank DAPI / H&E cell means the modality was not acquired: the sample is
+  skipped, as before. A path that does not exist is a problem.
+- With ``fail_fast`` off, samples with problems are skipped (the problems as
+  message) and the others run.
+- The H&E rotation (90 degrees, Aperio vs COMET) is not recorded in any header
+  and stays fixed.
+"""
+
+import collections
+import math
+
+from prep import catalog, channels, resolution
+
+REFERENCE_UM = 10.0             # µm/pixel x objective power of the scanners used (40x ~ 0.25 µm/pixel)
+MPP_CONSISTENCY = 0.3           # MPP may differ from REFERENCE_UM / objective power by this fraction
+SUPPORTED_DTYPES = ("uint8", "uint16")
+
+
+def given(value):
+    """True for a non-blank path cell of the master sheet."""
+    return isinstance(value, str) and bool(value.strip())
+
+
+def ome_level_pixel_sizes(geometry):
+    """µm/pixel of every level of a catalogued OME-TIFF (None without PhysicalSizeX)."""
+    if geometry.get("mpp") is None:
+        return None
+    base_width = geometry["level_shapes"][0][1]
+    return [geometry["mpp"] * base_width / shape[1] for shape in geometry["level_shapes"]]
+
+
+def dapi_level_scale(geometry, s):
+    """``(level, scale)`` of the DAPI export for settings ``s``."""
+    if s["target_mpp"] is not None: # read the level nearest the target resolution, resample only the residual
+        sizes = ome_level_pixel_sizes(geometry)
+        if sizes is None:
+            raise ValueError("no PhysicalSizeX in the OME-XML, needed for target_mpp")
+        return resolution.choose_level(sizes, s["target_mpp"])
+    return s["level"], 1.0
+
+
+def objective_scale(properties, objective):
+    """
+    Scale bringing a slide to ``objective`` magnification: from its objective
+    power, else from its MPP rounded to a power of two, else 1.0 (as the
+    hard-coded export did; ``hne_config`` records a warning).
+    """
+    power = properties.get("openslide.objective-power")
+    mpp = properties.get("openslide.mpp-x")
+    if power:
+        return objective / float(power)
+    if mpp:
+        return 2.0 ** round(math.log2(float(mpp) * objective / REFERENCE_UM))
+    return 1.0
+
+
+def hne_level_scale(geometry, s):
+    """``(level, scale)`` of the H&E export for settings ``s``."""
+    properties = geometry["properties"]
+    if s["target_mpp"] is not None:
+        return resolution.slide_level_for(properties, s["target_mpp"])
+    return s["level"], objective_scale(properties, s["hne_objective"])
+
+
+def slide_problems(properties):
+    """Contradictions between the objective power and the MPP of a slide."""
+    power = properties.get("openslide.objective-power")
+    mpp = properties.get("openslide.mpp-x")
+    if not (power and mpp):
+        return []
+    expected = REFERENCE_UM / float(power)
+    if abs(float(mpp) / expected - 1) > MPP_CONSISTENCY:
+        return [f"objective power {power}x does not match {float(mpp):.4f} µm/pixel (expected ~{expected:.3f})"]
+    return []
+
+
+def dapi_config(geometry, s):
+    """DAPI part of a sample config (raises ValueError on the first problem)."""
+    if "Error" in geometry:
+        raise ValueError(geometry["Error"])
+    if geometry["dtype"] not in SUPPORTED_DTYPES:
+        raise ValueError(f"dtype {geometry['dtype']} (expected one of {SUPPORTED_DTYPES})")
+    if geometry["ndim"] == 3 and not 0 <= int(s["dapi_idx"]) < geometry["channels"]:
+        raise ValueError(f"dapi_idx {s['dapi_idx']} out of range for {geometry['channels']} channel(s)")
+    level, scale = dapi_level_scale(geometry, s)
+    if not 0 <= level < len(geometry["level_shapes"]):
+        raise ValueError(f"level {level} out of range ({len(geometry['level_shapes'])} levels)")
+    exported = None
+    if s["channels"] is not None:
+        exported = channels.select_channels(geometry["channels"], s["channels"])
+    return {"dapi_level": level, "dapi_scale": scale, "dapi_shape": geometry["level_shapes"][level],
+            "dapi_dtype": geometry["dtype"], "dapi_channels": geometry["channels"], "exported_channels": exported}
+
+
+def hne_config(geometry, s):
+    """H&E part of a sample config (raises ValueError on the first problem)."""
+    if "Error" in geometry:
+        raise ValueError(geometry["Error"])
+    problems = slide_problems(geometry["properties"])
+    if problems:
+        raise ValueError("; ".join(problems))
+    level, scale = hne_level_scale(geometry, s)
+    if not 0 <= level < len(geometry["level_shapes"]):
+        raise ValueError(f"level {level} out of range ({len(geometry['level_shapes'])} levels)")
+    config = {"hne_level": level, "hne_scale": scale, "hne_shape": geometry["level_shapes"][level]}
+    properties = geometry["properties"]
+    if s["target_mpp"] is None and not (properties.get("openslide.objective-power")
+                                        or properties.get("openslide.mpp-x")):
+        config["message"] = "no objective power or MPP in the slide, H&E exported at scale 1.0"
+    return config
+
+
+def configure(rows, dapi_column, s, index_path=catalog.DEFAULT_INDEX, workers=catalog.DEFAULT_WORKERS):
+    """
+    ``{MedicalAchiever: config}`` for ``rows`` of the master sheet, settings ``s``.
+
+    A config holds ``status`` ("ok" or "skip"), ``message``, the input paths
+    and, for "ok", ``dapi_level`` / ``dapi_scale`` / ``dapi_shape`` /
+    ``dapi_dtype`` / ``dapi_channels`` / ``exported_channels`` and ``hne_level`` /
+    ``hne_scale`` / ``hne_shape`` (``message`` then holds a warning, printed,
+    if any). Raises ValueError listing every problem unless ``s["fail_fast"]``
+    is off.
+    """
+    rows = [dict(row) for row in rows]
+    dapi_paths = sorted({row[dapi_column] for row in rows if given(row[dapi_column])})
+    hne_paths = sorted({row["H&E_path"] for row in rows if given(row["H&E_path"])})
+    ome = dict(zip(dapi_paths, catalog.scan_records("ome", dapi_paths, index_path, workers)))
+    slides = dict(zip(hne_paths, catalog.scan_records("slide", hne_paths, index_path, workers)))
+    counts = collections.Counter(row["MedicalAchiever"] for row in rows)
+
+    configs, problems = {}, []
+    for row in rows:
+        file_id = row["MedicalAchiever"]
+        dapi_path, hne_path = row[dapi_column], row["H&E_path"]
+        config = {"sample": file_id, "status": "ok", "message": "", "dapi_path": dapi_path, "hne_path": hne_path}
+        configs[file_id] = config
+        if not given(dapi_path):
+            config.update(status="skip", message="no valid DAPI path")
+            continue
+        if not given(hne_path):
+            config.update(status="skip", message="no valid H&E path")
+            continue
+        sample_problems = []
+        if counts[file_id] > 1:
+            sample_problems.append(f"listed {counts[file_id]} times in the metadata sheet")
+        for part, build, geometry, path in (("DAPI", dapi_config, ome[dapi_path], dapi_path),
+                                            ("H&E", hne_config, slides[hne_path], hne_path)):
+            try:
+                config.update(build(geometry, s))
+            except ValueError as exc:
+                sample_problems.append(f"{part} {path}: {exc}")
+        if sample_problems:
+            config.update(status="skip", message="; ".join(sample_problems))
+            problems += [f"{file_id}: {problem}" for problem in sample_problems]
+        elif config["message"]:
+            print(f"Warning: {file_id}: {config['message']}")
+    if problems and s["fail_fast"]:
+        raise ValueError(f"{len(problems)} problem(s) in the metadata sheet, nothing was processed:\n  - "
+                         + "\n  - ".join(problems))
+    for problem in problems:
+        print(f"Skipping {problem}")
+    return configs
+
+
+def configure_slides(paths, s, index_path=catalog.DEFAULT_INDEX, workers=catalog.DEFAULT_WORKERS):
+    """
+    ``{H&E path: config}`` of the slides alone (``python -m prep hne``): ``status``,
+    ``message`` and, for "ok", ``hne_level`` / ``hne_scale`` / ``hne_shape``.
+    Problems are handled as in ``configure``.
+    """
+    paths = sorted({path for path in paths if given(path)})
+    configs, problems = {}, []
+    for path, geometry in zip(paths, catalog.scan_records("slide", paths, index_path, workers)):
+        config = {"sample": path, "status": "ok", "message": "", "hne_path": path}
+        configs[path] = config
+        try:
+            config.update(hne_config(geometry, s))
+        except ValueError as exc:
+            config.update(status="skip", message=f"H&E {path}: {exc}")
+            problems.append(config["message"])
+            continue
+        if config["message"]:
+            print(f"Warning: {path}: {config['message']}")
+    if problems and s["fail_fast"]:
+        raise ValueError(f"{len(problems)} problem(s) in the metadata sheet, nothing was processed:\n  - "
+                         + "\n  - ".join(problems))
+    for problem in problems:
+        print(f"Skipping {problem}")
+    return configs
@@ -0,0 +1,249 @@
+"""
+Memory-aware parallel batch runner for the COMET / Ultivue prep.
+
+Purpose
+-------
+comet.py / ultivue.py prepare the samples of the master metadata sheet one at
+a time, so a batch of dozens of slides uses one sample's worth of the SLURM
+allocation for most of the wall time. This runner hands the same rows to
+``prep.sample.prepare_sample`` in a process pool:
+- at most ``--max-workers`` samples run at once;
+- every row is configured and checked first (prep.autoconfig: levels, scales
+  and shapes from the slide catalog), so missing or inconsistent inputs stop
+  the batch before any sample starts;
+- each sample's peak memory is estimated from those shapes and a sample is only started while the estimates of the
+  running samples plus its own fit in ``--memory-budget``; a sample larger
+  than the whole budget runs alone;
+- a failing sample (exception, or a worker killed e.g. by the OOM killer) is
+  recorded and the batch carries on;
+- per-sample status, estimate, wall time and error are written to a results
+  table (Excel) next to the outputs, per-stage telemetry of every sample to
+  ``prep_telemetry.jsonl`` (prep/telemetry.py), summarised at the end.
+
+Usage
+-----
+python -m prep.batch comet --metadata 20250513_valis_meta_scratch1.xlsx \
+    --save-ome /mnt/scratchc/.../valis_prep_comet_hne40x/ --max-workers 4 --memory-budget 120G
+
+Notes
+-----
+- libvips threads are shared out: each worker gets available CPUs // max-workers.
+- Estimates assume the full level is exported (the tissue box is not known
+  before detection), so they are conservative when crop_to_tissue is on.
+"""
+
+import argparse
+import concurrent.futures as cf
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import os
+import time
+import traceback
+
+import numpy as np
+import pandas as pd
+import pyvips
+
+from prep import hne, sample, telemetry
+
+BASE_OVERHEAD = 768 * 1024 ** 2     # interpreter, numpy/pyvips/openslide and libvips caches per worker
+VIPS_THREAD_BYTES = 64 * 1024 ** 2  # libvips per-thread tile buffers of a streamed pipeline
+_UNITS = {"": 1, "B": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_bytes(text):
+    """Parse sizes like ``"200G"``, ``"64GiB"``, ``"512M"`` or ``"1073741824"`` to bytes."""
+    value = str(text).strip().upper().replace("IB", "").rstrip("B") or "0"
+    number, unit = (value[:-1], value[-1]) if value[-1] in _UNITS else (value, "")
+    try:
+        return int(float(number) * _UNITS[unit])
+    except ValueError:
+        raise ValueError(f"Cannot parse memory size {text!r}") from None
+
+
+def default_memory_budget():
+    """SLURM_MEM_PER_NODE (MiB) if set, else the machine's physical memory."""
+    slurm_mem = os.environ.get("SLURM_MEM_PER_NODE")
+    if slurm_mem:
+        return int(slurm_mem) * 1024 ** 2
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def dapi_footprint(config, settings, vips_threads=None):
+    """
+    Peak bytes of the DAPI stage, from the level shape and dtype of the sample
+    ``config``; ``vips_threads`` is the worker's libvips pool (default: the available CPUs).
+    """
+    height, width = config["dapi_shape"]
+    itemsize = np.dtype(config["dapi_dtype"]).itemsize
+    scale = config["dapi_scale"]
+    if settings["stream_dapi"]:
+        # one band in flight plus the libvips pyramid build of the level-0 temp file
+        return settings["tile_budget"] + VIPS_THREAD_BYTES * (vips_threads or hne.available_cpus())
+    pixels = height * width
+    peak = pixels * (itemsize + 1)                  # uint16 plane + uint8 LUT output
+    if scale != 1.0:
+        peak += int(pixels * scale ** 2 * 8)       # float64 rescale output
+    return peak                                     # handed to pyvips without a copy
+
+
+def hne_footprint(config, settings, vips_threads=None):
+    """
+    Peak bytes of the H&E stage, from the slide level shape of the sample
+    ``config``; ``vips_threads`` is the worker's libvips pool (default: the available CPUs).
+    """
+    scale = config["hne_scale"]
+    if settings["stream_hne"]:
+        return VIPS_THREAD_BYTES * (vips_threads or hne.available_cpus())
+    height, width = config["hne_shape"]
+    pixels = height * width
+    read_peak = pixels * (4 + 1)                    # RGBA read_region + uint8 pseudo-DAPI
+    if scale == 1.0:
+        return max(read_peak, pixels * 2)           # LUT stretch to uint8, handed to pyvips without a copy
+    out_pixels = int(pixels * scale ** 2)
+    # RGBA freed; uint8 pseudo-DAPI + float64 rescale + float64 stretch + uint8 cast
+    return max(read_peak, pixels + out_pixels * (8 + 8 + 1))
+
+
+def estimate_peak_bytes(config, settings, vips_threads=None):
+    """
+    Estimated peak resident memory of ``prepare_sample`` for one sample ``config``
+    (``sample.configure``) in a process running ``vips_threads`` libvips threads
+    (default: the available CPUs, as a single run sizes its pool).
+
+    With ``concurrent_stages`` the DAPI and H&E stages overlap and their
+    footprints add up; otherwise they run one after the other and the larger
+    counts. Either way on top of ``BASE_OVERHEAD``. Samples that will be
+    skipped estimate to the overhead only.
+    """
+    stages = [0]
+    if config["status"] == "ok":
+        stages += [dapi_footprint(config, settings, vips_threads), hne_footprint(config, settings, vips_threads)]
+    return BASE_OVERHEAD + (sum(stages) if settings["concurrent_stages"] else max(stages))
+
+
+def _init_worker(vips_threads):
+    pyvips.concurrency_set(vips_threads)
+
+
+def _run_sample(row, modality, save_ome, settings, config):
+    """Worker entry point: never raises, returns a status record."""
+    start = time.perf_counter()
+    try:
+        result = sample.prepare_sample(row, modality, save_ome, settings, config=config)
+        record = {"status": result["status"], "message": result["message"], "error": "", "timings": result["timings"]}
+    except Exception as exc:
+        record = {"status": "failed", "message": f"{type(exc).__name__}: {exc}", "error": traceback.format_exc()}
+    record["seconds"] = round(time.perf_counter() - start, 1)
+    return record
+
+
+def run_batch(rows, modality, save_ome, settings=None, max_workers=None, memory_budget=None):
+    """
+    Prepare ``rows`` (dicts or pandas rows of the master sheet) in a process pool.
+
+    Returns a DataFrame with one row per sample: ``sample``, ``status``
+    (exported / skipped / failed), ``message``, ``estimate_gb``, ``seconds``
+    and ``error`` (traceback of failures). Raises ValueError before starting
+    if any row has missing or inconsistent inputs (``fail_fast`` setting).
+    """
+    settings = sample.make_settings(**(settings or {}))
+    rows = [dict(row) for row in rows]
+    configs = sample.configure(rows, modality, settings)
+    max_workers = max_workers or hne.available_cpus()
+    memory_budget = memory_budget or default_memory_budget()
+    vips_threads = max(1, hne.available_cpus() // max_workers)
+
+    pending, records = [], {}
+    for row in rows:
+        file_id = row["MedicalAchiever"]
+        config = configs[file_id]
+        if config["status"] != "ok":
+            records[file_id] = {"status": "skipped", "message": config["message"], "error": "",
+                                "seconds": 0.0, "estimate": 0}
+            continue
+        estimate = estimate_peak_bytes(config, settings, vips_threads) # as the worker's pool is sized
+        pending.append((row, estimate))
+        records[file_id] = {"estimate": estimate}
+    # largest first, so big samples are not left to run alone at the end
+    pending.sort(key=lambda item: item[1], reverse=True)
+
+    def new_pool():
+        return cf.ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context("spawn"),
+                                      initializer=_init_worker, initargs=(vips_threads,))
+
+    pool = new_pool()
+    running = {}                                    # future -> (file_id, estimate)
+    try:
+        while pending or running:
+            in_use = sum(estimate for _, estimate in running.values())
+            for item in list(pending):
+                if len(running) >= max_workers:
+                    break
+                row, estimate = item
+                if in_use + estimate > memory_budget and running:
+                    continue
+                if estimate > memory_budget:
+                    print(f"{row['MedicalAchiever']}: estimated {estimate / 1024 ** 3:.1f} GiB exceeds the "
+                          f"{memory_budget / 1024 ** 3:.1f} GiB budget, running it alone")
+                pending.remove(item)
+                future = pool.submit(_run_sample, row, modality, save_ome, settings, configs[row["MedicalAchiever"]])
+                running[future] = (row["MedicalAchiever"], estimate)
+                in_use += estimate
+                if estimate > memory_budget:
+                    break
+            done, _ = cf.wait(running, return_when=cf.FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                file_id, _ = running.pop(future)
+                try:
+                    records[file_id].update(future.result())
+                except BrokenProcessPool:
+                    broken = True
+                    records[file_id].update({"status": "failed", "seconds": None, "error": "",
+                                             "message": "worker process died (out of memory?)"})
+                print(f"{file_id}: {records[file_id]['status']} {records[file_id]['message']}")
+            if broken:
+                # every sample still in the dead pool is lost with it; record them and start a fresh pool
+                for future, (file_id, _) in running.items():
+                    records[file_id].update({"status": "failed", "seconds": None, "error": "",
+                                             "message": "worker pool broken by another sample"})
+                running.clear()
+                pool.shutdown(wait=False, cancel_futures=True)
+                pool = new_pool()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    print(telemetry.format_summary([{"stages": record["timings"]} for record in records.values()
+                                    if record.get("status") == "exported"]))
+    table = pd.DataFrame([{"sample": file_id, **record} for file_id, record in records.items()])
+    table["estimate_gb"] = (table.pop("estimate") / 1024 ** 3).round(2)
+    return table[["sample", "status", "message", "estimate_gb", "seconds", "error"]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("modality", choices=sorted(sample.MODALITIES), help="which DAPI column / output names to use")
+    parser.add_argument("--metadata", required=True, help="master metadata Excel sheet")
+    parser.add_argument("--save-ome", required=True, help="output folder (one subfolder per sample)")
+    parser.add_argument("--max-workers", type=int, default=None, help="samples processed at once (default: available CPUs)")
+    parser.add_argument("--memory-budget", default=None,
+                        help="total memory for all workers, e.g. 200G (default: SLURM_MEM_PER_NODE or physical memory)")
+    parser.add_argument("--results", default=None, help="results table (default: <save-ome>/batch_results.xlsx)")
+    sample.add_settings_arguments(parser)
+    args = parser.parse_args()
+
+    settings = sample.settings_from_args(args)
+    budget = parse_bytes(args.memory_budget) if args.memory_budget else None
+    master_df = pd.read_excel(args.metadata)
+    rows = (row for _, row in master_df.iterrows())
+    table = run_batch(rows, args.modality, args.save_ome, settings, args.max_workers, budget)
+    results = args.results or os.path.join(args.save_ome, "batch_results.xlsx")
+    os.makedirs(os.path.dirname(os.path.abspath(results)), exist_ok=True)
+    table.to_excel(results, index=False)
+    print(table[["sample", "status", "message", "estimate_gb", "seconds"]].to_string(index=False))
+    print(f"Results written to {results}")
+
+
+if __name__ == "__main__":
+    main()
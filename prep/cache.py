@@ -0,0 +1,202 @@
+"""
+Input-fingerprinted build cache and atomic output writes.
+
+Purpose
+-------
+comet.py / ultivue.py used to skip a sample whenever its output folder
+existed, so a job killed mid-tiffsave left a half-written folder that was
+skipped forever, a parameter change needed manual deletion, and the H&E
+pseudo-DAPI was rebuilt for every COMET and Ultivue run of the same slide.
+
+- ``fingerprint`` hashes the identity of the input files (resolved path, size,
+  mtime) together with the processing parameters; an output is reused only if
+  the fingerprint recorded for it in ``<out_folder>/manifest.json`` matches
+  and the file exists.
+- ``atomic_output`` yields a temporary path next to the destination and
+  renames it into place only after the writer returns, so an interrupted
+  write never leaves a file that looks complete. Temporary files are named
+  ``.<pid>@<host>.partial.<name>``; a process killed outright (SLURM timeout,
+  OOM kill) cannot remove its own, so ``sweep_partials`` removes those of dead
+  processes when a sample folder or the shared store is next used.
+- ``SharedStore`` is a content-addressed folder (``<fingerprint>.tif`` plus a
+  ``.json`` record) shared between runs; outputs are hard-linked from it into
+  the sample folders (copied if the store is on another filesystem).
+
+Notes
+-----
+- Bump ``CACHE_VERSION`` when a change to the prep code alters output pixels,
+  so existing outputs are rebuilt.
+- Entries of the shared store are never evicted; delete old ``<fingerprint>.*``
+  files by hand if space is needed.
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import re
+import shutil
+import socket
+import time
+
+CACHE_VERSION = 1
+MANIFEST = "manifest.json"
+STALE_PARTIAL_SECONDS = 24 * 3600   # partials of other hosts untouched this long are orphans
+_PARTIAL_NAME = re.compile(r"^\.(\d+)(?:@(.+?))?\.partial\.")
+
+
+def file_identity(path):
+    """Resolved path, size and mtime (ns) of ``path``: cheap, changes whenever the file is rewritten."""
+    info = os.stat(path)
+    return {"path": os.path.realpath(path), "size": info.st_size, "mtime_ns": info.st_mtime_ns}
+
+
+def fingerprint(inputs, params):
+    """Hex digest of the identities of the ``inputs`` paths and a JSON-able ``params`` dict."""
+    payload = {"version": CACHE_VERSION, "inputs": [file_identity(p) for p in inputs], "params": params}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()[:32]
+
+
+def partial_prefix():
+    """``.<pid>@<host>.partial.``: the prefix of this process's temporary outputs."""
+    return f".{os.getpid()}@{socket.gethostname()}.partial."
+
+
+def _partial_path(path):
+    # keep the extension: pyvips picks the saver from it
+    folder, name = os.path.split(path)
+    return os.path.join(folder, partial_prefix() + name)
+
+
+def pid_alive(pid):
+    """Whether process ``pid`` exists on this host."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def sweep_partials(folder, max_age=STALE_PARTIAL_SECONDS):
+    """
+    Remove the temporary outputs in ``folder`` left by killed processes: those
+    of this host whose PID is gone, and those of other hosts untouched for
+    ``max_age`` seconds (a live writer keeps its file fresh). Returns bytes freed.
+    """
+    host, freed = socket.gethostname(), 0
+    try:
+        names = os.listdir(folder)
+    except FileNotFoundError:
+        return 0
+    for name in names:
+        match = _PARTIAL_NAME.match(name)
+        if match is None:
+            continue
+        path = os.path.join(folder, name)
+        try:
+            info = os.stat(path)
+            if match.group(2) in (None, host): # no host: written before hosts were recorded
+                orphan = not pid_alive(int(match.group(1)))
+            else:
+                orphan = time.time() - info.st_mtime >= max_age
+            if not orphan:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            continue
+        print(f"Removed {path} left by a killed run ({info.st_size / 1024 ** 3:.2f} GiB)")
+        freed += info.st_size
+    return freed
+
+
+@contextlib.contextmanager
+def atomic_output(path):
+    """
+    Yield a temporary path to write instead of ``path``; on success it is
+    renamed over ``path`` (atomic on one filesystem), on failure removed.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    partial = _partial_path(path)
+    try:
+        yield partial
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+
+
+def write_json(path, data):
+    """Atomically write ``data`` as indented JSON."""
+    with atomic_output(path) as partial:
+        with open(partial, "w") as fh:
+            json.dump(data, fh, indent=2)
+    return path
+
+
+def read_json(path):
+    """Parsed JSON at ``path``, or an empty dict if missing or unreadable (e.g. truncated)."""
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+
+def read_manifest(out_folder):
+    """``{output name: fingerprint}`` recorded for the outputs of ``out_folder``."""
+    return read_json(os.path.join(out_folder, MANIFEST))
+
+
+def is_current(out_folder, name, key):
+    """True if ``<out_folder>/<name>`` exists and was built with fingerprint ``key``."""
+    return os.path.exists(os.path.join(out_folder, name)) and read_manifest(out_folder).get(name) == key
+
+
+def record(out_folder, name, key):
+    """Record that ``<out_folder>/<name>`` was built with fingerprint ``key``."""
+    manifest = read_manifest(out_folder)
+    manifest[name] = key
+    return write_json(os.path.join(out_folder, MANIFEST), manifest)
+
+
+def link_into(src, dst):
+    """Hard-link ``src`` to ``dst`` (copy across filesystems), replacing ``dst`` atomically."""
+    with atomic_output(dst) as partial:
+        try:
+            os.link(src, partial)
+        except OSError:
+            shutil.copyfile(src, partial)
+    return dst
+
+
+class SharedStore:
+    """
+    Content-addressed folder of outputs shared between runs.
+
+    ``path(key)`` is the output file for fingerprint ``key``; ``metadata(key)``
+    / ``put_metadata(key, data)`` hold a JSON record next to it (e.g. the crop
+    record needed to rebuild crop.json without re-running tissue detection).
+    """
+
+    def __init__(self, root, suffix=".tif"):
+        self.root = root
+        self.suffix = suffix
+        sweep_partials(root)
+
+    def path(self, key):
+        return os.path.join(self.root, key + self.suffix)
+
+    def has(self, key):
+        return os.path.exists(self.path(key)) and os.path.exists(os.path.join(self.root, key + ".json"))
+
+    def metadata(self, key):
+        return read_json(os.path.join(self.root, key + ".json"))
+
+    def put_metadata(self, key, data):
+        # written after the image, so has() only sees complete entries
+        return write_json(os.path.join(self.root, key + ".json"), data)
@@ -0,0 +1,322 @@
+"""
+Parallel, incremental slide metadata catalog (COMET / Ultivue OME-TIFF, H&E SVS).
+
+Purpose
+-------
+The gather_* scripts opened every slide on the NAS one after the other on
+every run and rewrote their Excel sheet from scratch; the Ultivue one also
+called ``len(tif.pages)``, which parses every IFD of the file. ``scan``:
+
+- reads only what the sheets need (first-series level shapes, the first IFD,
+  the OME-XML, or the OpenSlide header), in a thread pool;
+- keeps each record in a local SQLite index keyed by path + size + mtime, so a
+  rerun only stats the files and opens the new or changed ones;
+- returns the same columns as before, which ``main`` writes to the same Excel sheets.
+
+Two further kinds, ``ome`` and ``slide``, hold the structured geometry
+(level shapes, dtype, channels, pixel size / OpenSlide properties) that
+prep.autoconfig derives each sample's levels and scale factors from.
+
+Usage
+-----
+python -m prep.catalog comet   --folder <COMET DAPI folder>        [--out COMET_metadata.xlsx]
+python -m prep.catalog hne     --folder <Visium H&E folder>        [--out hne_slide_info.xlsx]
+python -m prep.catalog ultivue --metadata <master sheet .xlsx>     [--out ultivue_dapi_metadata.xlsx]
+  common: [--index ~/.cache/spatial-prep/catalog.sqlite] [--workers 16] [--refresh]
+
+Notes
+-----
+- Unreadable files are reported in the ``Error`` column and retried on the next run.
+- Records are stored per catalog kind, so the same file can be in several catalogs.
+"""
+
+import argparse
+import concurrent.futures as cf
+import json
+import os
+import sqlite3
+import time
+import xml.etree.ElementTree as ET
+
+import tifffile
+
+from prep import hne, resolution
+from prep.cache import file_identity
+
+DEFAULT_INDEX = os.path.join(os.path.expanduser("~"), ".cache", "spatial-prep", "catalog.sqlite")
+DEFAULT_WORKERS = 16    # header reads are I/O bound (NFS latency), not CPU bound
+INDEX_VERSION = 1       # bump when a record layout changes
+
+
+def ome_fields(tif):
+    """PhysicalSizeX / Y, channel names and objective magnification from the OME-XML (None where absent)."""
+    fields = {"physical_size_x": None, "physical_size_y": None, "channels": None, "objective_power": None}
+    ome_xml = tif.ome_metadata
+    if not ome_xml:
+        return fields
+    root = ET.fromstring(ome_xml)
+    ns = {'ome': 'http://www.openmicroscopy.org/Schemas/OME/2016-06'}
+    pixels = root.find('.//ome:Pixels', ns)
+    if pixels is not None:
+        fields["physical_size_x"] = pixels.attrib.get('PhysicalSizeX')
+        fields["physical_size_y"] = pixels.attrib.get('PhysicalSizeY')
+        fields["channels"] = [ch.attrib.get('Name', '') for ch in pixels.findall('ome:Channel', ns)]
+    instrument = root.find('.//ome:Instrument', ns)
+    if instrument is not None:
+        objective = instrument.find('.//ome:Objective', ns)
+        if objective is not None:
+            fields["objective_power"] = objective.attrib.get('NominalMagnification')
+    return fields
+
+
+def comet_record(path):
+    """Row of COMET_metadata.xlsx (gather_ome_tiff_comet_metadata.py columns)."""
+    with tifffile.TiffFile(path) as tif:
+        series = tif.series[0]
+        dtype = series.dtype
+        size_y, size_x = series.levels[0].shape[-2:]
+        ome = ome_fields(tif)
+        return {
+            "Filename": os.path.basename(path),
+            "BitDepth": dtype.itemsize * 8 if dtype else None,
+            "SizeX": size_x,
+            "SizeY": size_y,
+            "SamplesPerPixel": series.shape[-1] if series.ndim >= 3 else 1,
+            "Levels": len(series.levels),
+            "LevelDimensions": "; ".join(f"Level {i}: {level.shape[-1]}x{level.shape[-2]}"
+                                         for i, level in enumerate(series.levels)),
+            "PhysicalSizeX (μm)": ome["physical_size_x"],
+            "PhysicalSizeY (μm)": ome["physical_size_y"],
+            "Channels": ", ".join(ome["channels"]) if ome["channels"] else None,
+            "ObjectivePower": ome["objective_power"],
+        }
+
+
+def ultivue_record(path):
+    """
+    Row of ultivue_dapi_metadata.xlsx (gather_ultivue_metadata.py columns).
+
+    Levels come from the first series' pyramid instead of ``len(tif.pages)``,
+    so only the IFDs of the levels are parsed.
+    """
+    with tifffile.TiffFile(path) as tif:
+        page0 = tif.pages[0]
+        levels = tif.series[0].levels
+        ome = ome_fields(tif)
+        return {
+            "Filename": os.path.basename(path),
+            "FullPath": path,
+            "BitDepth": getattr(page0, 'bitspersample', None),
+            "SizeX_Level0": getattr(page0, 'imagewidth', None),
+            "SizeY_Level0": getattr(page0, 'imagelength', None),
+            "SamplesPerPixel": getattr(page0, 'samplesperpixel', None),
+            "NumberOfLevels": len(levels),
+            "LevelDimensions": "; ".join(f"{level.shape[-1]}x{level.shape[-2]}" for level in levels),
+            "PhysicalSizeX": ome["physical_size_x"],
+            "PhysicalSizeY": ome["physical_size_y"],
+            "Channels": ", ".join(ome["channels"]) if ome["channels"] else None,
+            "ObjectivePower": ome["objective_power"],
+        }
+
+
+def hne_record(path):
+    """Row of hne_slide_info.xlsx (gather_h&e_meta_data.py columns; tuples as their text)."""
+    import openslide # gather_h&e_meta_data.py columns only; prep reads slide headers through libvips
+    slide = openslide.OpenSlide(path)
+    try:
+        return {
+            "Filename": os.path.basename(path),
+            "Level count": slide.level_count,
+            "Level dimensions": str(slide.level_dimensions),
+            "Level downsamples": str(slide.level_downsamples),
+            "Base level size": str(slide.level_dimensions[0]),
+            "MPP_x": slide.properties.get('openslide.mpp-x'),
+            "MPP_y": slide.properties.get('openslide.mpp-y'),
+            "Objective power": slide.properties.get('openslide.objective-power'),
+        }
+    finally:
+        slide.close()
+
+
+def ome_geometry(path):
+    """Level shapes (Y, X), dtype, channel count and names, and level-0 µm/pixel of an OME-TIFF."""
+    with tifffile.TiffFile(path) as tif:
+        series = tif.series[0]
+        channels = ome_fields(tif)["channels"]
+        return {
+            "level_shapes": [[int(n) for n in level.shape[-2:]] for level in series.levels],
+            "ndim": len(series.shape),
+            "channels": int(series.shape[0]) if len(series.shape) == 3 else 1,
+            "channel_names": channels,
+            "dtype": str(series.dtype),
+            "mpp": resolution.ome_pixel_size(tif),
+        }
+
+
+def slide_geometry(path):
+    """
+    ``openslide.*`` properties and level shapes (Y, X) of a whole-slide image,
+    through libvips, or openslide-python if libvips lacks OpenSlide support.
+    """
+    if not hne.has_openslideload():
+        import openslide # e.g. --in-memory runs, which read the slide with openslide-python too
+        slide = openslide.OpenSlide(path)
+        try:
+            return {
+                "properties": {name: str(value) for name, value in slide.properties.items()
+                               if name.startswith("openslide.")},
+                "level_shapes": [[int(height), int(width)] for width, height in slide.level_dimensions],
+            }
+        finally:
+            slide.close()
+    properties = hne.slide_properties(path)
+    level_count = int(properties.get("openslide.level-count", 1))
+    return {
+        "properties": {name: str(value) for name, value in properties.items()},
+        "level_shapes": [[int(properties[f"openslide.level[{i}].height"]), int(properties[f"openslide.level[{i}].width"])]
+                         for i in range(level_count)],
+    }
+
+
+# Catalog kinds: record reader, file suffixes when scanning a folder, Excel sheet name (None: not exported)
+CATALOGS = {
+    "comet": {"reader": comet_record, "suffixes": (".ome.tiff", ".ome.ome.tiff"), "output": "COMET_metadata.xlsx"},
+    "ultivue": {"reader": ultivue_record, "suffixes": (".tif", ".tiff"), "output": "ultivue_dapi_metadata.xlsx"},
+    "hne": {"reader": hne_record, "suffixes": (".svs",), "output": "hne_slide_info.xlsx"},
+    "ome": {"reader": ome_geometry, "suffixes": (".ome.tif", ".ome.tiff"), "output": None},
+    "slide": {"reader": slide_geometry, "suffixes": (".svs",), "output": None},
+}
+
+
+def error_record(kind, path, error):
+    record = {"Filename": os.path.basename(path), "Error": str(error)}
+    if kind == "ultivue":
+        record["FullPath"] = path
+    return record
+
+
+def find_files(folder, suffixes):
+    """Files directly in ``folder`` whose name ends with one of ``suffixes`` (case-insensitive), sorted."""
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder)
+                  if name.lower().endswith(tuple(suffixes)))
+
+
+class CatalogIndex:
+    """SQLite store of catalog records keyed by (kind, path), valid while size and mtime match."""
+
+    def __init__(self, path=DEFAULT_INDEX):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=60)   # concurrent scans (e.g. array jobs) wait for the lock
+        self.db.execute("CREATE TABLE IF NOT EXISTS records (kind TEXT, path TEXT, size INTEGER, mtime_ns INTEGER,"
+                        " version INTEGER, record TEXT, PRIMARY KEY (kind, path))")
+
+    def get(self, kind, identity):
+        """Stored record of ``identity`` (from ``cache.file_identity``), or None if missing or stale."""
+        row = self.db.execute("SELECT size, mtime_ns, version, record FROM records WHERE kind = ? AND path = ?",
+                              (kind, identity["path"])).fetchone()
+        if row is None or tuple(row[:3]) != (identity["size"], identity["mtime_ns"], INDEX_VERSION):
+            return None
+        return json.loads(row[3])
+
+    def put(self, kind, identity, record):
+        self.db.execute("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?)",
+                        (kind, identity["path"], identity["size"], identity["mtime_ns"], INDEX_VERSION,
+                         json.dumps(record)))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.commit()
+        self.close()
+
+
+def _identity(path):
+    try:
+        return file_identity(path)
+    except OSError as e:
+        return e
+
+
+def scan_records(kind, paths, index_path=DEFAULT_INDEX, workers=DEFAULT_WORKERS, refresh=False):
+    """
+    Catalog records of ``paths`` (one dict per path, in order).
+
+    Files are stat'ed and, if new or changed since the last scan (or with
+    ``refresh``), read in a pool of ``workers`` threads; successful records
+    are stored in the SQLite index at ``index_path``. Failures give
+    ``{"Filename", "Error"}`` records.
+    """
+    if kind not in CATALOGS:
+        raise ValueError(f"Unknown catalog {kind!r}; choose from {sorted(CATALOGS)}")
+    reader = CATALOGS[kind]["reader"]
+    paths = list(paths)
+    start = time.perf_counter()
+    records = [None] * len(paths)
+    with CatalogIndex(index_path) as index, cf.ThreadPoolExecutor(max_workers=workers) as pool:
+        identities = list(pool.map(_identity, paths))
+        todo, unreachable = [], 0
+        for i, (path, identity) in enumerate(zip(paths, identities)):
+            if isinstance(identity, OSError):
+                records[i] = error_record(kind, path, identity)
+                unreachable += 1
+                continue
+            records[i] = None if refresh else index.get(kind, identity)
+            if records[i] is None:
+                todo.append(i)
+        futures = {pool.submit(reader, paths[i]): i for i in todo}
+        for future in cf.as_completed(futures):
+            i = futures[future]
+            try:
+                records[i] = future.result()
+            except Exception as e:
+                records[i] = error_record(kind, paths[i], e)
+                continue
+            index.put(kind, identities[i], records[i])
+    print(f"{kind}: {len(paths)} file(s), {len(todo)} read, {len(paths) - len(todo) - unreachable} from the index, "
+          f"{unreachable} missing ({time.perf_counter() - start:.1f} s)")
+    return records
+
+
+def scan(kind, paths, index_path=DEFAULT_INDEX, workers=DEFAULT_WORKERS, refresh=False):
+    """``scan_records`` as a DataFrame, one row per path (the Excel sheet of ``kind``)."""
+    import pandas as pd
+    return pd.DataFrame(scan_records(kind, paths, index_path, workers, refresh))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("kind", choices=sorted(k for k, v in CATALOGS.items() if v["output"]),
+                        help="which catalog to build")
+    parser.add_argument("--folder", default=None, help="folder to scan (comet, hne)")
+    parser.add_argument("--metadata", default=None, help="master sheet with an Ultivue_DAPI_path column (ultivue)")
+    parser.add_argument("--out", default=None, help="Excel output (default: the usual sheet name next to the inputs)")
+    parser.add_argument("--index", default=DEFAULT_INDEX, help="SQLite index of previously read files")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="parallel header reads")
+    parser.add_argument("--refresh", action="store_true", help="re-read every file, ignoring the index")
+    args = parser.parse_args()
+
+    import pandas as pd
+    if args.kind == "ultivue" and args.metadata:
+        paths = list(pd.read_excel(args.metadata)["Ultivue_DAPI_path"].dropna())
+        folder = os.path.dirname(os.path.abspath(args.metadata))
+    elif args.folder:
+        paths = find_files(args.folder, CATALOGS[args.kind]["suffixes"])
+        folder = args.folder
+    else:
+        parser.error("give --folder (or --metadata for ultivue)")
+    out = args.out or os.path.join(folder, CATALOGS[args.kind]["output"])
+    df = scan(args.kind, paths, args.index, args.workers, args.refresh)
+    df.to_excel(out, index=False)
+    print(f"Metadata saved to {out}")
+
+
+if __name__ == "__main__":
+    main()
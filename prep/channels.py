@@ -0,0 +1,230 @@
+"""
+Single-pass multi-channel export of multiplex COMET / Ultivue OME-TIFFs.
+
+Purpose
+-------
+comet.py / ultivue.py only export ``dapi_idx`` from a (C, Y, X) level;
+getting other markers into registration-ready pyramids meant rerunning the
+whole script per channel and re-reading the multi-GiB source each time.
+``write_channels`` reads every band of the level once for all selected
+channels and:
+
+1. accumulates one exact histogram per channel (``prep.percentiles``) while
+   streaming the raw band as (Y, X, C) tiles into a temporary level-0 BigTIFF;
+2. turns each channel's clip limits into the usual uint8 lookup table
+   (``prep.dapi.normalisation_lut``) and lets libvips apply all of them
+   (``maplut``) while writing the outputs, either
+   - one multi-channel pyramidal OME-TIFF (channels as pages, pyramid levels in
+     SubIFDs, channel names and pixel size in the OME-XML), and/or
+   - one pyramid BigTIFF per channel (e.g. the DAPI for registration).
+
+If the clip limits are taken from a lower pyramid level (``percentile_level``)
+they are known up front and the band is normalised to uint8 before it is
+written, so the temporary file is C x 1 byte per pixel instead of C x 2.
+
+Notes
+-----
+- The source level is read exactly once regardless of the channel count; the
+  temporary file (on ``tmp_dir``, default next to the output) is read back by
+  libvips once per output.
+- Per-channel outputs are bit-identical to ``prep.dapi.write_normalised`` for
+  the same channel, limits, box and scale.
+"""
+
+import os
+import re
+import tempfile
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import quoteattr
+
+import numpy as np
+import pyvips
+import tifffile as tff
+
+from prep import cache, export, telemetry
+from prep.dapi import DEFAULT_TILE_BUDGET, TILE, apply_lut, band_rows, box_shape, normalisation_lut, open_level
+from prep.percentiles import DEFAULT_PERCENTILES, StreamingHistogram
+from prep.resolution import ome_level_pixel_sizes
+from prep.tissue import box_pixels
+
+
+def ome_channel_names(tif):
+    """Channel names from the OME-XML of ``tif`` (``Channel:<i>`` where a name is missing)."""
+    count = tif.series[0].shape[0] if len(tif.series[0].shape) == 3 else 1
+    names = [f"Channel:{i}" for i in range(count)]
+    if tif.ome_metadata:
+        pixels = ET.fromstring(tif.ome_metadata).find(".//{*}Pixels")
+        if pixels is not None:
+            for i, channel in enumerate(pixels.findall("{*}Channel")[:count]):
+                names[i] = channel.attrib.get("Name") or names[i]
+    return names
+
+
+def safe_name(name):
+    """Channel name usable in a file name."""
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", str(name)).strip("_") or "channel"
+
+
+def channel_count(plane):
+    """Number of channels of a (C, Y, X) or (Y, X) level."""
+    return plane.shape[0] if plane.ndim == 3 else 1
+
+
+def select_channels(count, channels=None):
+    """List of channel indices out of ``count``: all for ``None`` / "all", else the given indices (validated)."""
+    if channels is None or channels == "all":
+        return list(range(count))
+    channels = [int(c) for c in channels]
+    bad = [c for c in channels if not 0 <= c < count]
+    if bad:
+        raise ValueError(f"Channels {bad} out of range for {count} channel(s)")
+    return channels
+
+
+def iter_channel_bands(plane, channels, tile_budget=DEFAULT_TILE_BUDGET, box=None):
+    """
+    Yield ``(y0, band)`` with ``band`` of shape (len(channels), rows, width), one read per band.
+
+    The contiguous channel range spanning ``channels`` is read in one go and
+    the requested channels picked from it; ``box`` is a pixel (y0, x0, y1, x1).
+    """
+    if plane.ndim not in (2, 3):
+        raise ValueError(f"Unexpected array shape: {plane.shape}")
+    top, left, bottom, right = box if box is not None else (0, 0) + tuple(plane.shape[-2:])
+    first, last = min(channels), max(channels) + 1
+    # raw band of the spanned channels + the selected copy, per pixel
+    per_pixel = ((last - first) + len(channels)) * plane.dtype.itemsize + len(channels)
+    step = band_rows(right - left, tile_budget, per_pixel)
+    pick = [c - first for c in channels]
+    for y0 in range(top, bottom, step):
+        y1 = min(y0 + step, bottom)
+        with telemetry.stage("read"):
+            if plane.ndim == 3:
+                band = np.asarray(plane[first:last, y0:y1, left:right])[pick]
+            else:
+                band = np.asarray(plane[y0:y1, left:right])[np.newaxis]
+        yield y0 - top, band
+
+
+def level_channel_percentiles(tif, level, channels, percentiles=DEFAULT_PERCENTILES,
+                              tile_budget=DEFAULT_TILE_BUDGET, box=None):
+    """Per-channel percentiles of pyramid ``level`` in one pass (``box`` fractional)."""
+    level = min(int(level), len(tif.series[0].levels) - 1)
+    plane = open_level(tif, level)
+    hists = [StreamingHistogram(plane.dtype) for _ in channels]
+    pixel_box = box_pixels(box, plane.shape) if box is not None else None
+    for _, band in iter_channel_bands(plane, channels, tile_budget, pixel_box):
+        for hist, values in zip(hists, band):
+            hist.update(values)
+    return [hist.percentiles(percentiles) for hist in hists]
+
+
+def _tiles(bands, width, lut=None):
+    """(TILE, TILE, C) tiles of consecutive (C, rows, width) bands, optionally through per-channel LUTs."""
+    for _, band in bands:
+        if lut is not None:
+            with telemetry.stage("normalise"):
+                out = np.empty(band.shape, dtype=np.uint8)
+                for c, values in enumerate(band):
+                    apply_lut(values, lut[c], out[c])
+            band = out
+        for ty in range(0, band.shape[1], TILE):
+            for tx in range(0, width, TILE):
+                yield np.ascontiguousarray(band[:, ty:ty + TILE, tx:tx + TILE].transpose(1, 2, 0))
+
+
+def lut_image(luts):
+    """A 1-row pyvips LUT with one band per channel, for ``maplut``."""
+    stacked = np.ascontiguousarray(np.stack(luts, axis=-1)[np.newaxis])   # (1, N, C)
+    return pyvips.Image.new_from_memory(stacked.data, stacked.shape[1], 1, stacked.shape[2], "uchar")
+
+
+def ome_xml(width, height, names, pixel_size=None):
+    """Minimal OME-XML for a uint8 (C, Y, X) image stored one channel per page."""
+    size = "" if pixel_size is None else (f' PhysicalSizeX="{pixel_size:.6g}" PhysicalSizeXUnit="µm"'
+                                          f' PhysicalSizeY="{pixel_size:.6g}" PhysicalSizeYUnit="µm"')
+    channels = "".join(f'<Channel ID="Channel:0:{i}" Name={quoteattr(str(name))} SamplesPerPixel="1"/>'
+                       for i, name in enumerate(names))
+    planes = "".join(f'<TiffData FirstC="{i}" IFD="{i}" PlaneCount="1"/>' for i in range(len(names)))
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06">'
+            '<Image ID="Image:0"><Pixels BigEndian="false" DimensionOrder="XYCZT" ID="Pixels:0" '
+            f'SizeC="{len(names)}" SizeT="1" SizeX="{width}" SizeY="{height}" SizeZ="1" Type="uint8"{size}>'
+            f'{channels}{planes}</Pixels></Image></OME>')
+
+
+def save_ome(image, out_path, names, pixel_size=None, options=None):
+    """Write a C-band uchar pyvips image as a pyramidal OME-TIFF (pages = channels, SubIFD pyramid)."""
+    pages = pyvips.Image.arrayjoin(image.bandsplit(), across=1) if image.bands > 1 else image.copy()
+    pages.set_type(pyvips.GValue.gint_type, "page-height", image.height)
+    pages.set_type(pyvips.GValue.gstr_type, "image-description", ome_xml(image.width, image.height, names, pixel_size))
+    with telemetry.stage("tiffsave"):
+        pages.tiffsave(out_path, subifd=True, **export.tiffsave_kwargs(options))
+
+
+def write_channels(tif, level, channels=None, ome_path=None, channel_paths=None, percentiles=DEFAULT_PERCENTILES,
+                   percentile_level=None, scale=None, tile_budget=DEFAULT_TILE_BUDGET, box=None, options=None,
+                   tmp_dir=None):
+    """
+    Normalise ``channels`` of pyramid ``level`` with per-channel limits, reading the level once.
+
+    ``ome_path`` receives all channels as one pyramidal OME-TIFF (names from
+    the source OME-XML); ``channel_paths`` ({channel index: path}) receives
+    single-channel pyramid BigTIFFs. ``box`` is fractional (see ``prep.tissue``),
+    ``scale`` the residual resize. Returns ``{channel index: (lo, hi)}``.
+    """
+    plane = open_level(tif, level)
+    channels = select_channels(channel_count(plane), channels)
+    channel_paths = channel_paths or {}
+    missing = set(channel_paths) - set(channels)
+    if missing:
+        raise ValueError(f"Outputs requested for channels {sorted(missing)} that are not exported")
+    pixel_box = box_pixels(box, plane.shape) if box is not None else None
+    height, width = box_shape(plane, pixel_box)
+    first_out = ome_path or next(iter(channel_paths.values()), None)
+    if first_out is None:
+        raise ValueError("Nothing to write: give ome_path and/or channel_paths")
+    tmp_dir = tmp_dir or os.path.dirname(os.path.abspath(first_out))
+
+    if percentile_level is not None: # limits known up front: normalise while reading, uint8 temp
+        limits = level_channel_percentiles(tif, percentile_level, channels, percentiles, tile_budget, box)
+        luts = [normalisation_lut(lo, hi, plane.dtype) for lo, hi in limits]
+        tmp_dtype, hists = np.uint8, None
+    else: # exact limits: histogram while streaming the raw values, LUTs applied by libvips afterwards
+        luts, tmp_dtype = None, plane.dtype
+        hists = [StreamingHistogram(plane.dtype) for _ in channels]
+
+    def bands():
+        for y0, band in iter_channel_bands(plane, channels, tile_budget, pixel_box):
+            if hists is not None:
+                for hist, values in zip(hists, band):
+                    hist.update(values)
+            yield y0, band
+
+    fd, tmp_path = tempfile.mkstemp(prefix=cache.partial_prefix(), suffix=".channels.tmp.tif", dir=tmp_dir)
+    os.close(fd)
+    try:
+        shape = (height, width, len(channels)) if len(channels) > 1 else (height, width)
+        tiles = _tiles(bands(), width, luts)
+        if len(channels) == 1:
+            tiles = (tile[..., 0] for tile in tiles)
+        tff.imwrite(tmp_path, tiles, shape=shape, dtype=tmp_dtype, tile=(TILE, TILE),
+                    photometric="minisblack", planarconfig="contig", bigtiff=True)
+        if hists is not None:
+            limits = [hist.percentiles(percentiles) for hist in hists]
+            luts = [normalisation_lut(lo, hi, plane.dtype) for lo, hi in limits]
+        image = pyvips.Image.new_from_file(tmp_path)
+        if tmp_dtype != np.uint8:
+            image = image.maplut(lut_image(luts))
+        if scale is not None and scale != 1.0:
+            image = image.resize(scale)
+        for c, path in channel_paths.items():
+            export.tiffsave(image[channels.index(c)] if image.bands > 1 else image, path, options)
+        if ome_path is not None:
+            names = ome_channel_names(tif)
+            sizes = ome_level_pixel_sizes(tif)
+            pixel_size = None if sizes is None else sizes[level] / (scale or 1.0)
+            save_ome(image, ome_path, [names[c] for c in channels], pixel_size, options)
+    finally:
+        os.remove(tmp_path)
+    return {c: tuple(float(v) for v in lim) for c, lim in zip(channels, limits)}
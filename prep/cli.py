@@ -0,0 +1,130 @@
+"""
+Single command-line entry point of the prep package: ``python -m prep <command>``.
+
+Purpose
+-------
+comet.py and ultivue.py imported napari, OpenSlide, scikit-image, Zarr and
+pyvips and read the master sheet at import time, even with ``visualise = 0``,
+so every SLURM array task of a few minutes spent its first seconds (and a few
+hundred MB of RSS) on libraries it might never call. Commands:
+
+- comet / ultivue : prepare the selected rows of the master sheet, as comet.py
+  / ultivue.py do (``run``, which the scripts call with their config block);
+- hne             : build only the H&E pseudo-DAPIs, once per slide, in the
+  shared store the COMET and Ultivue runs link them from;
+- batch / plan / catalog / telemetry / register : the module command lines
+  (``python -m prep.batch`` ...), same arguments.
+
+Parsing the command line imports nothing but argparse; a command imports the
+modules it runs, and within prep scikit-image / SciPy, Zarr, OpenSlide, pandas
+and napari are imported by the stages that use them. benchmarks/bench_startup.py
+measures the import time and RSS of each entry point.
+
+Usage
+-----
+python -m prep comet --metadata 20250513_valis_meta_scratch1.xlsx --save-ome <folder> --sample <MedicalAchiever>
+python -m prep hne --metadata 20250513_valis_meta_scratch1.xlsx --save-ome <folder>
+python -m prep batch ultivue --metadata ... --save-ome ... --max-workers 4
+"""
+
+import argparse
+import importlib
+import sys
+
+# Commands preparing rows of the master sheet, and commands handed to a module's own main()
+SAMPLE_COMMANDS = {
+    "comet": "prepare COMET DAPI (and channels) + H&E pseudo-DAPI pyramids",
+    "ultivue": "prepare Ultivue DAPI (and channels) + H&E pseudo-DAPI pyramids",
+    "hne": "build the shared H&E pseudo-DAPIs only, once per slide",
+}
+MODULE_COMMANDS = {
+    "batch": ("prep.batch", "process-pool batch run with a memory budget"),
+    "plan": ("prep.plan", "per-sample estimates and SLURM array scripts"),
+    "catalog": ("prep.catalog", "slide metadata catalog (gather_* sheets)"),
+    "telemetry": ("prep.telemetry", "summarise a prep_telemetry.jsonl file"),
+    "register": ("prep.registration", "VALIS registration of the prepared samples, cached transforms"),
+}
+
+
+def add_selection_arguments(parser):
+    """``--sample`` / ``--samples-file`` / ``--shard``: the rows of the master sheet to process."""
+    parser.add_argument("--sample", nargs="+", default=None, help="MedicalAchiever IDs to process")
+    parser.add_argument("--samples-file", default=None, help="file with one MedicalAchiever ID per line")
+    parser.add_argument("--shard", default=None, help="i/N: process every N-th selected row starting at i")
+    return parser
+
+
+def selected_samples(args):
+    """MedicalAchiever IDs of ``--sample`` and ``--samples-file`` (None: every row)."""
+    samples = list(args.sample or [])
+    if args.samples_file:
+        with open(args.samples_file) as fh:
+            samples += [line.strip() for line in fh if line.strip()]
+    return samples or None
+
+
+def script_arguments():
+    """Row selection flags of comet.py / ultivue.py (interpreter / IPython arguments are tolerated)."""
+    args, _ = add_selection_arguments(argparse.ArgumentParser()).parse_known_args()
+    return args
+
+
+def run(command, metadata, save_ome, settings=None, samples=None, shard=None, visualise=False):
+    """
+    Prepare the rows of the master sheet ``metadata`` selected by ``samples`` / ``shard``
+    for ``command`` ("comet", "ultivue" or "hne") under ``save_ome``. With
+    ``visualise`` the in-memory arrays are shown in a napari viewer.
+    """
+    import pandas as pd
+    from prep import hne, sample
+
+    settings = sample.make_settings(**(settings or {}))
+    if settings["stream_hne"]:
+        hne.use_available_cpus()
+    master_df = pd.read_excel(metadata)
+    reg_df = sample.select_rows(master_df, samples=samples, shard=shard)
+    rows = (row for idx, row in reg_df.iterrows())
+    if command == "hne":
+        for result in sample.prepare_hne(list(rows), save_ome, settings):
+            print(f"{result['sample']}: {result['status']} {result['message']}")
+        return
+    viewer = None
+    if visualise:
+        import napari # optional: only for visualise
+        viewer = napari.Viewer()
+    # one sample at a time, next one prefetched; python -m prep batch runs them in parallel
+    for result in sample.prepare_samples(rows, command, save_ome, settings, keep_arrays=visualise):
+        if viewer is not None:
+            if result["hne"] is not None:
+                viewer.add_image(result["hne"], name=f'Purple Intensity Image', blending='additive',opacity=1.0)
+            if result["dapi"] is not None:
+                viewer.add_image(result["dapi"], name=f'Purple Intensity Image', blending='additive',opacity=1.0)
+        del result
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if argv and argv[0] in MODULE_COMMANDS:
+        module = importlib.import_module(MODULE_COMMANDS[argv[0]][0])
+        sys.argv = [f"python -m prep {argv[0]}", *argv[1:]]
+        return module.main()
+
+    parser = argparse.ArgumentParser(prog="python -m prep", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", metavar="command", required=True)
+    for name, text in SAMPLE_COMMANDS.items():
+        sub = commands.add_parser(name, help=text)
+        if argv and argv[0] == name: # the settings flags need prep.sample: only for the command being run
+            from prep import sample
+            sub.add_argument("--metadata", required=True, help="master metadata Excel sheet")
+            sub.add_argument("--save-ome", required=True, help="output folder (one subfolder per sample)")
+            add_selection_arguments(sub)
+            sub.add_argument("--visualise", action="store_true", help="show the in-memory arrays in napari")
+            sample.add_settings_arguments(sub)
+    for name, (module, text) in MODULE_COMMANDS.items():
+        commands.add_parser(name, help=f"{text} (python -m {module})")
+    args = parser.parse_args(argv)
+
+    from prep import sample
+    run(args.command, args.metadata, args.save_ome, sample.settings_from_args(args),
+        selected_samples(args), args.shard, args.visualise)
@@ -0,0 +1,158 @@
+"""
+Out-of-core DAPI normalisation for COMET / Ultivue OME-TIFF pyramids.
+
+Purpose
+-------
+comet.py / ultivue.py originally loaded the whole of pyramid level 0 with
+``np.array(position_zarr)`` and then clipped/rescaled it in float64, which
+needs ~4x the plane size in temporaries (12+ GiB for a 39570x39490 COMET
+slide). The helpers here walk the Zarr store exposed by
+``tif.series[0].aszarr()`` in row bands whose size is bounded by a tile
+budget, so peak memory no longer depends on the slide size:
+
+1. ``prep.percentiles``   – clip limits from a per-band histogram.
+2. ``write_normalised``   – normalise each band to uint8 and stream it as
+                            tiles into a level-0 BigTIFF, then let pyvips
+                            build the pyramid from that file sequentially.
+
+Notes
+-----
+- Band heights are multiples of ``TILE`` so every band maps onto whole rows
+  of output tiles.
+- Once the clip limits are known the clip/scale/cast is a function of the
+  input value only, so it is precomputed into a 256/65536-entry uint8 lookup
+  table (``normalisation_lut``) built with the original float arithmetic and
+  applied with a single gather (``apply_lut``). Results are bit-identical to
+  the old multi-pass path without its full-size float64 temporaries.
+"""
+
+import os
+
+import numpy as np
+import tifffile as tff
+import pyvips
+
+from prep import export, telemetry
+
+TILE = 512                                  # output tile edge (pixels)
+DEFAULT_TILE_BUDGET = 256 * 1024 ** 2       # bytes of band data held at once
+BYTES_PER_PIXEL = 2 + 1                     # uint16 input + uint8 output
+LUT_CHUNK = 1 << 20                         # pixels per gather; bounds numpy's intp index copy to 8 MiB
+
+
+def open_level(tif, level=0):
+    """Return pyramid ``level`` of the first series of ``tif`` as a lazy Zarr array."""
+    import zarr # imported on first use (~0.4 s), not by processes that never open a DAPI
+    return zarr.open(tif.series[0].aszarr(level=level), mode="r")
+
+
+def band_rows(width, tile_budget=DEFAULT_TILE_BUDGET, bytes_per_pixel=BYTES_PER_PIXEL):
+    """Rows per band so that one band stays within ``tile_budget`` bytes (at least one tile row)."""
+    rows = tile_budget // (width * bytes_per_pixel)
+    return max(TILE, (rows // TILE) * TILE)
+
+
+def box_shape(plane, box=None):
+    """(height, width) of ``plane`` or of the pixel ``box`` (y0, x0, y1, x1) within it."""
+    if box is None:
+        return tuple(plane.shape[-2:])
+    y0, x0, y1, x1 = box
+    return y1 - y0, x1 - x0
+
+
+def iter_bands(plane, channel=None, tile_budget=DEFAULT_TILE_BUDGET, box=None):
+    """
+    Yield ``(y0, band)`` for consecutive full-width row bands of ``plane``.
+
+    ``plane`` is a 2D (Y, X) or 3D (C, Y, X) Zarr array; for 3D arrays only
+    ``channel`` is read. With a pixel ``box`` (y0, x0, y1, x1) only that
+    region is read and ``y0`` is relative to the box.
+    """
+    if plane.ndim == 3:
+        channel = int(channel or 0)
+    elif plane.ndim != 2:
+        raise ValueError(f"Unexpected array shape: {plane.shape}")
+    top, left, bottom, right = box if box is not None else (0, 0) + tuple(plane.shape[-2:])
+    step = band_rows(right - left, tile_budget)
+    for y0 in range(top, bottom, step):
+        y1 = min(y0 + step, bottom)
+        with telemetry.stage("read"):
+            if plane.ndim == 3:
+                band = np.asarray(plane[channel, y0:y1, left:right])
+            else:
+                band = np.asarray(plane[y0:y1, left:right])
+        yield y0 - top, band
+
+
+def normalise_reference(values, lo, hi):
+    """
+    Clip ``values`` to [lo, hi] and rescale to 0-255 uint8 with the original float64 steps.
+
+    Modifies ``values`` in place; kept as the reference the lookup table is built from.
+    """
+    values[values > hi] = hi
+    values[values < lo] = lo
+    values[values < 0] = 0
+    values = 255 * (values - lo) / (hi - lo)
+    return values.astype(np.uint8)
+
+
+def normalisation_lut(lo, hi, dtype=np.uint16):
+    """uint8 lookup table mapping every value of ``dtype`` to its normalised output."""
+    return normalise_reference(np.arange(np.iinfo(dtype).max + 1, dtype=dtype), lo, hi)
+
+
+def apply_lut(values, lut, out=None):
+    """
+    Map ``values`` through ``lut`` with one gather, writing into ``out`` (C-contiguous uint8, same shape).
+
+    Works on 1M-pixel slices so the only temporary is numpy's index copy of one slice.
+    """
+    values = np.ascontiguousarray(values)
+    if out is None:
+        out = np.empty(values.shape, dtype=np.uint8)
+    flat_in, flat_out = values.reshape(-1), out.reshape(-1)
+    for start in range(0, flat_in.size, LUT_CHUNK):
+        np.take(lut, flat_in[start:start + LUT_CHUNK], out=flat_out[start:start + LUT_CHUNK])
+    return out
+
+
+def save_pyramid(src_path, out_path, scale=None, options=None):
+    """Build the tiled pyramid BigTIFF at ``out_path`` from a level-0 file, reading it sequentially."""
+    image = pyvips.Image.new_from_file(src_path, access="sequential")
+    if scale is not None and scale != 1.0:
+        image = image.resize(scale)
+    export.tiffsave(image, out_path, options)
+
+
+def write_normalised(plane, out_path, lo, hi, channel=None, scale=None, tile_budget=DEFAULT_TILE_BUDGET, box=None,
+                     options=None):
+    """
+    Normalise ``plane`` to uint8 band by band and export it as a pyramid BigTIFF.
+
+    Each band is cut into ``TILE`` x ``TILE`` tiles and streamed into a
+    temporary level-0 tiled BigTIFF next to ``out_path``; pyvips then builds
+    the pyramid (optionally resized by ``scale``) and the temporary file is
+    removed. Only one band is ever held in memory. A pixel ``box``
+    (y0, x0, y1, x1) restricts reading and export to that region; ``options``
+    are the prep.export options of the final pyramid.
+    """
+    height, width = box_shape(plane, box)
+    lut = normalisation_lut(lo, hi, plane.dtype)
+
+    def tiles():
+        for _, band in iter_bands(plane, channel, tile_budget, box):
+            with telemetry.stage("normalise"):
+                band = apply_lut(band, lut)
+            for ty in range(0, band.shape[0], TILE):
+                for tx in range(0, width, TILE):
+                    yield band[ty:ty + TILE, tx:tx + TILE]
+
+    tmp_path = out_path + ".level0.tmp.tif"
+    try:
+        tff.imwrite(tmp_path, tiles(), shape=(height, width), dtype=np.uint8,
+                    tile=(TILE, TILE), bigtiff=True)
+        save_pyramid(tmp_path, out_path, scale, options)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -0,0 +1,127 @@
+"""
+Pyramid BigTIFF export options (compression, tile size, predictor, pyramid depth).
+
+Purpose
+-------
+Every output used to be written with ``tiffsave(..., tile=True, pyramid=True,
+compression="none", bigtiff=True)``: tens of GiB per sample on scratch, and
+VALIS reading it back is I/O bound. ``tiffsave`` here takes an options dict
+(or a preset name) so the export step can trade write time, size and read
+speed; benchmarks/bench_export.py measures them on synthetic slides.
+
+Options
+-------
+- ``compression``: none, deflate, lzw, zstd, jpeg, packbits, webp (libvips names)
+- ``predictor``: none / horizontal (helps deflate, lzw and zstd on smooth images)
+- ``quality``: Q factor for jpeg / webp (lossy)
+- ``level``: deflate (1-9) / zstd (1-22) effort
+- ``lossless``: webp lossless mode
+- ``tile_size``: tile edge in pixels (libvips default 128)
+- ``depth``: pyramid depth, onetile (default: down to one tile), onepixel or one (no pyramid)
+- ``bitdepth``: 8 (default), or 4 / 2 / 1 to quantise (lossy)
+
+Notes
+-----
+- ``PRESETS["none"]`` reproduces the original export exactly.
+- ``save_array`` hands numpy buffers to libvips without the ``tobytes()``
+  copy and rotates inside libvips, so writing adds no full-image copy.
+- Codec support depends on the libtiff libvips was built with (zstd and webp are
+  optional), and libtiff's webp codec only takes RGB / RGBA, not the 1-band outputs here.
+"""
+
+import numpy as np
+import pyvips
+
+from prep import telemetry
+
+PRESETS = {
+    "none": {"compression": "none"},
+    "deflate": {"compression": "deflate", "predictor": "horizontal"},
+    "lzw": {"compression": "lzw", "predictor": "horizontal"},
+    "zstd": {"compression": "zstd", "predictor": "horizontal"},
+    "jpeg95": {"compression": "jpeg", "quality": 95},
+    "jpeg85": {"compression": "jpeg", "quality": 85},
+}
+DEFAULT_PRESET = "none"
+LOSSLESS = {"none", "deflate", "lzw", "zstd", "packbits"}
+
+_VIPS_NAMES = {"compression": "compression", "predictor": "predictor", "quality": "Q", "level": "level",
+               "lossless": "lossless", "depth": "depth", "bitdepth": "bitdepth"}
+
+
+def resolve(options=None):
+    """Options dict from a preset name, a dict (merged over its ``preset`` key) or None (default)."""
+    if options is None:
+        options = DEFAULT_PRESET
+    if isinstance(options, str):
+        if options not in PRESETS:
+            raise ValueError(f"Unknown export preset {options!r}; choose from {sorted(PRESETS)}")
+        return dict(PRESETS[options])
+    options = dict(options)
+    base = resolve(options.pop("preset", DEFAULT_PRESET))
+    unknown = set(options) - set(_VIPS_NAMES) - {"tile_size"}
+    if unknown:
+        raise ValueError(f"Unknown export options: {sorted(unknown)}")
+    base.update(options)
+    return base
+
+
+def is_lossless(options=None):
+    """True if ``options`` reproduce the pixels exactly."""
+    options = resolve(options)
+    if options.get("bitdepth", 8) != 8:
+        return False
+    return options["compression"] in LOSSLESS or (options["compression"] == "webp" and options.get("lossless", False))
+
+
+def tiffsave_kwargs(options=None):
+    """Keyword arguments for ``pyvips.Image.tiffsave`` (tiled pyramid BigTIFF plus ``options``)."""
+    options = resolve(options)
+    kwargs = {"tile": True, "pyramid": True, "bigtiff": True}
+    for name, value in options.items():
+        if name == "tile_size":
+            kwargs["tile_width"] = kwargs["tile_height"] = int(value)
+        else:
+            kwargs[_VIPS_NAMES[name]] = value
+    return kwargs
+
+
+def tiffsave(image, out_path, options=None):
+    """Write ``image`` as a tiled pyramid BigTIFF with the export ``options``."""
+    with telemetry.stage("tiffsave"): # the whole lazy libvips pipeline runs here
+        image.tiffsave(out_path, **tiffsave_kwargs(options))
+
+
+def from_array(array):
+    """
+    Wrap a 2-D uint8 numpy array as a pyvips image without copying it.
+
+    The buffer is handed over through the buffer protocol; pyvips keeps a
+    reference to it for the lifetime of the image (and of images derived from
+    it). Only a non-C-contiguous array (e.g. a strided view) is copied first.
+    """
+    if array.ndim != 2 or array.dtype != np.uint8:
+        raise ValueError(f"Expected a 2-D uint8 array, got {array.ndim}-D {array.dtype}")
+    array = np.ascontiguousarray(array)
+    height, width = array.shape
+    return pyvips.Image.new_from_memory(array.data, width, height, 1, "uchar")
+
+
+def rotate(image, degrees):
+    """Rotate a pyvips image counter-clockwise by a multiple of 90 degrees (numpy rot90 sense)."""
+    if degrees % 90:
+        raise ValueError(f"Rotation must be a multiple of 90 degrees, got {degrees}")
+    turns = (degrees // 90) % 4
+    if turns == 0:
+        return image
+    return {1: image.rot270, 2: image.rot180, 3: image.rot90}[turns]()
+
+
+def save_array(array, out_path, options=None, rotation=0):
+    """
+    Write a 2-D uint8 numpy array as a tiled pyramid BigTIFF.
+
+    No full-image copy is made: the array is wrapped in place and ``rotation``
+    (degrees, numpy rot90 sense) is applied by libvips tile by tile while writing.
+    """
+    tiffsave(rotate(from_array(array), rotation), out_path, options)
@@ -0,0 +1,347 @@
+"""
+Tile-streamed H&E pseudo-DAPI pipeline (pyvips).
+
+Purpose
+-------
+comet.py / ultivue.py originally read the whole level-0 H&E slide with
+``wsi_hne.read_region((0,0), level, size)`` and built the pseudo-DAPI with
+several full-size numpy/float64 passes (weighting, cv2.normalize, alpha mask,
+np.rot90, ski.transform.rescale, min/max stretch). Here the same steps are a
+lazy libvips pipeline that is evaluated tile by tile while the pyramid is
+written:
+
+    openslideload -> 0.4975 R + 0.4975 B + 0.005 G -> min/max normalise
+    -> invert -> alpha mask -> rot90 (Aperio vs COMET) -> optional resize
+    -> min/max stretch -> tiffsave
+
+Only two passes over the slide are made: ``pseudo_dapi_limits`` collects every
+min/max the normalisations need in one ``stats()`` pass, then ``tiffsave``
+pulls the pipeline. Memory is bounded by libvips' tile buffers, and all the
+CPUs granted by SLURM are used (``use_available_cpus``).
+
+Notes
+-----
+- Arithmetic is done in double precision with the same order of operations
+  as the numpy path; with no resize the output matches pseudo-dapi-hne*.tif
+  to within one grey level (the old path went through skimage's float
+  rescale, which occasionally truncates one level lower). A scale of 1.0 is
+  a no-op rather than a full float64 copy.
+- ``rescale`` reproduces ``ski.transform.rescale(image, scale)`` (the 20x
+  ``low_res_samples``): same output size (round half to even), pixel-centre
+  sampling, bilinear interpolation in double, reflect edges and, when
+  downscaling, the same Gaussian anti-aliasing; it matches skimage to
+  floating-point rounding. As in the old path the resized image is then
+  stretched by its own min/max, which costs one extra pass over the slide
+  (resized slides only); the output matches to within one grey level.
+- Requires libvips built with OpenSlide support (openslideload).
+- ``FixedPointPseudoDapi`` / ``pseudo_dapi_array`` are the numpy equivalent for
+  RGBA arrays already in memory (the stream_hne = False path): the weighting
+  is done exactly in integers (400 * w = 199 * (R + B) + 2 * G, uint32
+  accumulators) and weighting, normalise, invert and alpha mask are fused in
+  one pass over each tile with preallocated buffers. Outputs match the float
+  path to within one grey level.
+"""
+
+import os
+
+import numpy as np
+import pyvips
+
+from prep import export, telemetry
+from prep.tissue import box_pixels
+
+RED_WEIGHT = 0.4975
+BLUE_WEIGHT = 0.4975
+GREEN_WEIGHT = 0.005
+_FAR = 1e12             # stands in for +/- infinity when masking out background pixels
+
+# Fixed-point weights: 400 * (0.4975 R + 0.4975 B + 0.005 G) = 199 (R + B) + 2 G, exactly
+FIXED_RB_WEIGHT = 199
+FIXED_G_WEIGHT = 2
+FIXED_TILE_ROWS = 1024  # rows per tile for pseudo_dapi_array
+
+
+def available_cpus():
+    """CPUs granted to this process: SLURM_CPUS_PER_TASK, else the affinity mask."""
+    slurm_cpus = os.environ.get("SLURM_CPUS_PER_TASK")
+    if slurm_cpus:
+        return int(slurm_cpus)
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def use_available_cpus():
+    """Size the libvips worker pool to the CPUs actually allocated (not the whole node)."""
+    pyvips.concurrency_set(available_cpus())
+    return pyvips.concurrency_get()
+
+
+def open_slide(path, level=0):
+    """Open ``level`` of a whole-slide image lazily as an RGBA uchar pyvips image."""
+    return pyvips.Image.openslideload(path, level=level)
+
+
+def has_openslideload():
+    """Whether this libvips was built with OpenSlide support."""
+    return pyvips.type_find("VipsOperation", "openslideload") != 0
+
+
+def slide_properties(path):
+    """``openslide.*`` properties of a whole-slide image (MPP, level count, downsamples)."""
+    image = pyvips.Image.openslideload(path)
+    return {name: image.get(name) for name in image.get_fields() if name.startswith("openslide.")}
+
+
+def purple_intensity(slide):
+    """Red/blue-weighted grey image (double) used as the basis of the pseudo-DAPI."""
+    rgb = slide.extract_band(0, n=3).cast("double")
+    return rgb[0] * RED_WEIGHT + rgb[2] * BLUE_WEIGHT + rgb[1] * GREEN_WEIGHT
+
+
+def pseudo_dapi_limits(slide):
+    """
+    One stats() pass over ``slide`` returning the limits both normalisations need.
+
+    Returns a dict with the min/max of the weighted image over all pixels
+    (``w_min``/``w_max``, for the cv2.normalize step), over tissue pixels with
+    alpha > 0 (``tissue_min``/``tissue_max``) and whether any pixel is
+    transparent (``has_background``).
+    """
+    weighted = purple_intensity(slide)
+    tissue = slide[3] > 0
+    stack = weighted.bandjoin([tissue.ifthenelse(weighted, _FAR),
+                               tissue.ifthenelse(weighted, -_FAR),
+                               slide[3].cast("double")])
+    stats = stack.stats()   # row b + 1 holds band b; column 0 = min, column 1 = max
+    return {
+        "w_min": stats.getpoint(0, 1)[0],
+        "w_max": stats.getpoint(1, 1)[0],
+        "tissue_min": stats.getpoint(0, 2)[0],
+        "tissue_max": stats.getpoint(1, 3)[0],
+        "has_background": stats.getpoint(0, 4)[0] == 0,
+    }
+
+
+def _stretch_limits(limits, scale, shift):
+    """uint8 min/max of the masked, inverted image, derived without another pass."""
+    u_max = int(255 - (limits["tissue_min"] * scale + shift))
+    if limits["has_background"]:
+        u_min = 0
+    else:
+        u_min = int(255 - (limits["tissue_max"] * scale + shift))
+    return u_min, u_max
+
+
+def pseudo_dapi(slide, limits=None, scale=None):
+    """
+    Lazy uint8 pseudo-DAPI image from an RGBA slide.
+
+    ``limits`` comes from ``pseudo_dapi_limits`` (computed if omitted);
+    ``scale`` optionally resizes after rotation (e.g. 2.0 for slides scanned
+    at 20x). Nothing is computed until the result is written.
+    """
+    if limits is None:
+        limits = pseudo_dapi_limits(slide)
+    span = limits["w_max"] - limits["w_min"]
+    norm_scale = 255.0 / span if span > 0 else 0.0      # as cv2.normalize(NORM_MINMAX)
+    norm_shift = -limits["w_min"] * norm_scale
+    inverted = 255 - purple_intensity(slide).linear(norm_scale, norm_shift)
+    image = (slide[3] > 0).ifthenelse(inverted, 0).cast("uchar")
+    image = image.rot270()      # == np.rot90: Aperio rotates 90 degrees compared to COMET data
+    if scale is not None and scale != 1.0:
+        image = rescale(image, scale)
+        stats = image.stats()   # interpolation moves the min / max: stretch by the resized image's own
+        u_min, u_max = stats.getpoint(0, 0)[0], stats.getpoint(1, 0)[0]
+        if u_max > u_min:
+            image = image.linear(255.0 / (u_max - u_min), -u_min * 255.0 / (u_max - u_min))
+        return image.cast("uchar")
+    u_min, u_max = _stretch_limits(limits, norm_scale, norm_shift)
+    if u_max > u_min and (u_min, u_max) != (0, 255):
+        image = image.linear(255.0 / (u_max - u_min), -u_min * 255.0 / (u_max - u_min))
+    return image.cast("uchar")
+
+
+def _reflect_pad(image, px, py):
+    """Pad by ``px`` / ``py`` pixels mirrored about the edge pixels (numpy / skimage "reflect")."""
+    if px:
+        w, h = image.width, image.height
+        left = image.crop(1, 0, px, h).fliphor()
+        right = image.crop(w - px - 1, 0, px, h).fliphor()
+        image = left.join(image, "horizontal").join(right, "horizontal")
+    if py:
+        w, h = image.width, image.height
+        top = image.crop(0, 1, w, py).flipver()
+        bottom = image.crop(0, h - py - 1, w, py).flipver()
+        image = top.join(image, "vertical").join(bottom, "vertical")
+    return image
+
+
+def _gaussian_mask(sigma, horizontal):
+    """scipy.ndimage.gaussian_filter's 1-D kernel (truncate=4) as a pyvips matrix."""
+    radius = int(4.0 * sigma + 0.5)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 * x ** 2 / sigma ** 2)
+    kernel = (kernel / kernel.sum()).tolist()
+    return pyvips.Image.new_from_list([kernel] if horizontal else [[k] for k in kernel]), radius
+
+
+def rescale(image, scale):
+    """
+    Lazy double image resized by ``scale`` as ``ski.transform.rescale(image, scale)``
+    does (order=1, mode="reflect", anti-aliasing when downscaling), in the
+    input's value range.
+    """
+    w, h = image.width, image.height
+    out_w, out_h = max(round(scale * w), 1), max(round(scale * h), 1)
+    image = image.cast("double")
+    for horizontal, size, out_size in ((True, w, out_w), (False, h, out_h)):
+        sigma = max(0.0, (size / out_size - 1) / 2)
+        if sigma > 0:
+            mask, radius = _gaussian_mask(sigma, horizontal)
+            px, py = (radius, 0) if horizontal else (0, radius)
+            image = _reflect_pad(image, px, py).conv(mask, precision="float").crop(px, py, w, h)
+    pad = 2     # bilinear samples reach one pixel past the edge
+    # output pixel centre (x + 0.5) / scale - 0.5 in input pixels, as skimage / scipy.ndimage.zoom(grid_mode=True)
+    return _reflect_pad(image, pad, pad).affine([out_w / w, 0, 0, out_h / h], oarea=[0, 0, out_w, out_h],
+                                                idx=0.5 - pad, idy=0.5 - pad, odx=-0.5, ody=-0.5,
+                                                interpolate=pyvips.Interpolate.new("bilinear"))
+
+
+def level_shape(path, level=0):
+    """(height, width) of ``level`` of a whole-slide image (header only)."""
+    image = open_slide(path, level)
+    return image.height, image.width
+
+
+def crop_fraction(image, box):
+    """Crop a pyvips image to a fractional (top, left, bottom, right) box."""
+    y0, x0, y1, x1 = box_pixels(box, (image.height, image.width))
+    return image.crop(x0, y0, min(x1, image.width) - x0, min(y1, image.height) - y0)
+
+
+def write_pseudo_dapi(hne_path, out_path, level=0, scale=None, stats_level=None, box=None, options=None):
+    """
+    Build the H&E pseudo-DAPI and write it as a tiled pyramid BigTIFF.
+
+    ``stats_level`` optionally takes the normalisation limits from a lower
+    pyramid level (cheaper, approximate); by default they come from ``level``.
+    ``box`` restricts everything to a fractional tissue box (see
+    ``prep.tissue``); ``options`` are the prep.export options. Returns the
+    (width, height) written.
+    """
+    with telemetry.stage("open"):
+        slide = open_slide(hne_path, level)
+        stats_slide = slide if stats_level is None else open_slide(hne_path, stats_level)
+    if box is not None:
+        slide, stats_slide = crop_fraction(slide, box), crop_fraction(stats_slide, box)
+    with telemetry.stage("pseudo-dapi limits"): # one full read of the slide
+        limits = pseudo_dapi_limits(stats_slide)
+    image = pseudo_dapi(slide, limits, scale)
+    export.tiffsave(image, out_path, options)
+    return image.width, image.height
+
+
+class FixedPointPseudoDapi:
+    """
+    Fused integer pseudo-DAPI kernel for uint8 RGBA tiles.
+
+    Each RGBA pixel is read as one little-endian uint32 (A<<24 | B<<16 | G<<8 | R)
+    so every step is a contiguous integer op instead of a strided channel
+    read. Buffers are allocated once for ``tile_shape`` (rows, cols).
+    ``w_min``/``w_max`` are the limits of the fixed-point weighted image (see
+    ``weighted``) over the whole slide; once set, calling the kernel on a tile
+    does weighting, min/max normalisation, inversion and alpha masking in one
+    pass.
+    """
+
+    def __init__(self, tile_shape, w_min=0, w_max=0):
+        self._acc = np.empty(tile_shape, dtype=np.uint32)
+        self._tmp = np.empty(tile_shape, dtype=np.uint32)
+        self._background = np.empty(tile_shape, dtype=bool)
+        self.set_limits(w_min, w_max)
+
+    def set_limits(self, w_min, w_max):
+        self.w_min = int(w_min)
+        self.w_max = int(w_max)
+        self.span = max(self.w_max - self.w_min, 1)
+
+    @staticmethod
+    def packed(rgba):
+        """(rows, cols) uint32 view of a C-contiguous (rows, cols, 4) uint8 tile."""
+        return np.ascontiguousarray(rgba).view("<u4")[..., 0]
+
+    def weighted(self, rgba, out=None):
+        """199 * (R + B) + 2 * G of an RGBA tile as uint32 (400x the float weighting)."""
+        pixels = self.packed(rgba)
+        rows, cols = pixels.shape
+        if out is None:
+            out = self._acc[:rows, :cols]
+        green = self._tmp[:rows, :cols]
+        np.bitwise_and(pixels, 0x00FF00FF, out=out)     # R and B in separate 16-bit lanes
+        np.multiply(out, 0x00010001, out=out)           # upper lane becomes R + B (B << 32 overflows away)
+        np.right_shift(out, 16, out=out)
+        np.multiply(out, FIXED_RB_WEIGHT, out=out)
+        np.right_shift(pixels, 8, out=green)
+        np.bitwise_and(green, 0xFF, out=green)
+        np.multiply(green, FIXED_G_WEIGHT, out=green)
+        np.add(out, green, out=out)
+        return out
+
+    def __call__(self, rgba, out=None):
+        """uint8 pseudo-DAPI of an RGBA tile: 255 - normalised weighting, 0 where alpha == 0."""
+        pixels = self.packed(rgba)
+        rows, cols = pixels.shape
+        if out is None:
+            out = np.empty((rows, cols), dtype=np.uint8)
+        acc = self.weighted(rgba)
+        np.clip(acc, self.w_min, self.w_max, out=acc)
+        # trunc(255 - 255 * (w - w_min) / span) == 255 - ceil(255 * (w - w_min) / span)
+        acc -= self.w_min
+        acc *= 255
+        acc += self.span - 1
+        np.floor_divide(acc, self.span, out=acc)
+        np.subtract(255, acc, out=out, casting="unsafe")
+        background = self._background[:rows, :cols]
+        np.less(pixels, 1 << 24, out=background)        # alpha == 0
+        out[background] = 0
+        return out
+
+
+def stretch_uint8(image):
+    """
+    The scripts' final min/max stretch of a uint8 pseudo-DAPI, via a 256-entry LUT.
+
+    Reproduces ``255*(x-min)/(max-min)`` -> uint8 on the float image the
+    scripts had after ``ski.transform.rescale(..., 1.0)`` (values / 255),
+    without float64 copies of the slide.
+    """
+    lo, hi = int(image.min()), int(image.max())
+    if hi == lo:
+        return np.zeros_like(image)
+    values = np.arange(256) / 255.0
+    lut = (255 * (values - lo / 255.0) / (hi / 255.0 - lo / 255.0)).astype(np.uint8)
+    return np.take(lut, image)
+
+
+def pseudo_dapi_array(rgba, tile_rows=FIXED_TILE_ROWS):
+    """
+    uint8 pseudo-DAPI of an in-memory RGBA array with the fixed-point kernel.
+
+    Two passes over row tiles: min/max of the integer weighting, then the
+    fused kernel writing into one preallocated output.
+    """
+    height, width = rgba.shape[:2]
+    kernel = FixedPointPseudoDapi((min(tile_rows, height), width))
+    w_min, w_max = None, 0
+    for y0 in range(0, height, tile_rows):
+        weighted = kernel.weighted(rgba[y0:y0 + tile_rows])
+        tile_min, tile_max = int(weighted.min()), int(weighted.max())
+        w_min = tile_min if w_min is None else min(w_min, tile_min)
+        w_max = max(w_max, tile_max)
+    kernel.set_limits(w_min, w_max)
+    out = np.empty((height, width), dtype=np.uint8)
+    for y0 in range(0, height, tile_rows):
+        kernel(rgba[y0:y0 + tile_rows], out=out[y0:y0 + tile_rows])
+    return out
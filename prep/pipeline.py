@@ -0,0 +1,202 @@
+"""
+Overlapping the stages of a sample: concurrent DAPI / H&E exports and input prefetch.
+
+Purpose
+-------
+A sample used to read the DAPI OME-TIFF, then the H&E slide, then write the
+two pyramids, strictly in sequence, although the inputs sit on separate NAS /
+scratch mounts and the work is largely I/O-bound (tifffile / libvips release
+the GIL while reading, decoding and encoding).
+
+- ``run_stages`` runs independent stages (the DAPI and the H&E export, each
+  reading its input and writing its own pyramid) in threads.
+- ``Prefetcher`` reads the next sample's input files in a background thread
+  (``posix_fadvise(WILLNEED)`` plus a sequential read up to a byte limit) so
+  they are in the page cache by the time that sample starts, or, with a
+  ``stage`` callable (prep.staging), copies them to node-local disk.
+- ``StageTimes`` records start / end and resource use of every stage
+  relative to the sample start (prep/telemetry.py); ``summary()`` prints them
+  so the overlap is visible.
+
+Notes
+-----
+- Running both exports at once raises the sample's peak memory to the sum of
+  the two stages (prep.batch accounts for this).
+"""
+
+import concurrent.futures as cf
+import contextlib
+import os
+import threading
+import time
+
+from prep import telemetry
+
+DEFAULT_PREFETCH_BYTES = 4 * 1024 ** 3  # per input file
+PREFETCH_CHUNK = 16 * 1024 ** 2
+
+
+class StageTimes:
+    """
+    Thread-safe timings and resource use of named stages, relative to construction.
+
+    Every stage records start / end, wall and CPU seconds, peak RSS growth and
+    bytes read / written (prep.telemetry); a stage run again (e.g. once per
+    band) accumulates, counting ``calls``. Within ``stage(name)`` the kernels'
+    ``telemetry.stage`` calls in the same thread nest under ``name``.
+    ``sink`` (e.g. a ``telemetry.JsonLines``) receives a "start" event the
+    first time each stage starts and a "stage" event whenever a top-level one ends.
+    """
+
+    def __init__(self, sink=None):
+        self.t0 = time.perf_counter()
+        self.stages = {}
+        self.sink = sink
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def _emit(self, event):
+        if self.sink is not None:
+            with contextlib.suppress(OSError): # telemetry must never fail a sample
+                self.sink(event)
+
+    def start(self, name):
+        begin = telemetry.snapshot()
+        with self._lock:
+            self._running.setdefault(name, []).append(begin)
+            first = name not in self.stages
+            if first:
+                self.stages[name] = telemetry.new_entry(begin.wall - self.t0)
+            self.stages[name]["end"] = None
+        if first:
+            self._emit({"event": "start", "stage": name})
+
+    def stop(self, name):
+        end = telemetry.snapshot()
+        with self._lock:
+            used = telemetry.usage(self._running[name].pop(), end)
+            telemetry.accumulate(self.stages[name], used, end.wall - self.t0)
+        if "/" not in name:
+            self._emit({"event": "stage", "stage": name, **used})
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        name = telemetry.qualified(self, name)
+        self.start(name)
+        try:
+            with telemetry.active(self, name):
+                yield
+        finally:
+            self.stop(name)
+
+    def as_dict(self):
+        """``{stage: {"start", "end" (None while running), "seconds", "calls", "cpu_seconds", ...bytes}}``."""
+        with self._lock:
+            return {name: {key: round(value, 2) if isinstance(value, float) else value
+                           for key, value in entry.items()}
+                    for name, entry in self.stages.items()}
+
+    def summary(self):
+        """One line per stage: start, end, duration, CPU, peak RSS growth and MiB read / written, in start order."""
+        lines = []
+        for name, t in sorted(self.as_dict().items(), key=lambda item: item[1]["start"]):
+            if t["end"] is None:
+                lines.append(f"  {name:<32} {t['start']:8.1f} s -> running")
+                continue
+            calls = f" x{t['calls']}" if t["calls"] > 1 else ""
+            lines.append(f"  {name:<32} {t['start']:8.1f} s -> {t['end']:8.1f} s  ({t['seconds']:.1f} s{calls}, "
+                         f"cpu {t['cpu_seconds']:.1f} s, peak +{t['peak_rss_delta_bytes'] / 1024 ** 2:.0f} MiB, "
+                         f"read {t['read_bytes'] / 1024 ** 2:.0f} MiB, "
+                         f"written {t['written_bytes'] / 1024 ** 2:.0f} MiB)")
+        return "\n".join(lines)
+
+
+def run_stages(stages, concurrent=True, times=None):
+    """
+    Run ``stages`` ({name: callable}) and return ``{name: result}``.
+
+    With ``concurrent`` each stage gets its own thread; all stages are waited
+    for before the first exception (in stage order) is re-raised.
+    """
+    times = times or StageTimes()
+
+    def timed(name, func):
+        with times.stage(name):
+            return func()
+
+    if not concurrent or len(stages) < 2:
+        return {name: timed(name, func) for name, func in stages.items()}
+    with cf.ThreadPoolExecutor(max_workers=len(stages)) as pool:
+        futures = {name: pool.submit(timed, name, func) for name, func in stages.items()}
+        cf.wait(futures.values())
+    return {name: future.result() for name, future in futures.items()}
+
+
+def warm_file(path, max_bytes=DEFAULT_PREFETCH_BYTES, cancel=None):
+    """Pull up to ``max_bytes`` of ``path`` into the page cache; returns bytes read."""
+    done = 0
+    with open(path, "rb", buffering=0) as fh:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fh.fileno(), 0, max_bytes, os.POSIX_FADV_WILLNEED)
+        buffer = bytearray(PREFETCH_CHUNK)
+        while done < max_bytes and not (cancel is not None and cancel.is_set()):
+            n = fh.readinto(buffer)
+            if not n:
+                break
+            done += n
+    return done
+
+
+class Prefetcher:
+    """
+    Background read of the next sample's inputs while the current one is processed.
+
+    ``start(paths, times, label)`` queues a prefetch behind the one still
+    running, which is left to finish: it is usually the sample about to start,
+    whose reads then overlap with the rest of its read-ahead. Missing paths are
+    ignored. ``stage`` (``stage(path, cancel)``) replaces the page-cache read,
+    e.g. ``StagingCache.prefetch``. ``cancel()`` stops the queue (at shutdown).
+    Errors are swallowed: a failed prefetch only means a cold read later.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_PREFETCH_BYTES, stage=None):
+        self.max_bytes = max_bytes
+        self.stage = stage
+        self._thread = None
+        self._cancel = threading.Event()
+
+    def start(self, paths, times=None, label="prefetch"):
+        paths = [p for p in paths if isinstance(p, str) and os.path.exists(p)]
+        if not paths or (self.stage is None and self.max_bytes <= 0): # max_bytes bounds the page-cache read only
+            return
+        previous, cancel = self._thread, self._cancel
+
+        def run():
+            if previous is not None:
+                previous.join() # one prefetch at a time, in the order queued
+            if cancel.is_set():
+                return
+            if times is not None:
+                times.start(label)
+            try:
+                for path in paths:
+                    if self.stage is not None:
+                        self.stage(path, cancel)
+                    else:
+                        warm_file(path, self.max_bytes, cancel)
+            except Exception:
+                pass
+            finally:
+                if times is not None:
+                    times.stop(label)
+
+        self._thread = threading.Thread(target=run, name=label, daemon=True)
+        self._thread.start()
+
+    def cancel(self):
+        """Stop the running and queued prefetches and wait for them."""
+        self._cancel.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._cancel = threading.Event()
@@ -0,0 +1,217 @@
+"""
+SLURM array planner: per-sample memory / runtime estimates and array job scripts.
+
+Purpose
+-------
+submit_savetoVIPS.sh reserves one 258G / 48 h node and runs every row of the
+master metadata sheet serially. This planner reads the same sheet, takes
+each sample's pyramid level shapes from the slide catalog (prep.autoconfig,
+every row checked up front), estimates its peak
+memory (``prep.batch.estimate_peak_bytes``) and runtime (pixels / measured
+throughput), and writes SLURM array scripts so samples fan out across the
+cluster with ``--mem`` sized to what they need:
+
+- per-sample mode (default): samples are grouped into memory tiers (powers of
+  two GiB, at least ``MIN_MEM_GB``); one array per tier, one task per sample,
+  each task running ``comet.py --sample <MedicalAchiever>``;
+- shard mode (``--shards N``): one array of N tasks, task i running
+  ``comet.py --shard i/N`` (every N-th row), sized to its largest shard.
+
+Usage
+-----
+python -m prep.plan comet --metadata 20250513_valis_meta_scratch1.xlsx --out-dir slurm_plan \
+    [--save-ome <folder, to leave out up-to-date samples>] [--shards N] [--cpus 8] [--max-concurrent 20]
+bash slurm_plan/submit_comet.sh
+
+Notes
+-----
+- The settings flags (--target-mpp, --in-memory, ...) only inform the
+  estimates; the array tasks run comet.py / ultivue.py with their own config block.
+- Throughput constants are rough figures for a streamed run on 8 CPUs; runtime
+  estimates are multiplied by ``TIME_SAFETY`` and memory by ``MEM_SAFETY``.
+"""
+
+import argparse
+import math
+import os
+import stat
+
+import pandas as pd
+
+from prep import batch, sample
+
+DAPI_MPX_PER_S = 40.0       # histogram pass + LUT + pyramid write of a streamed DAPI level
+HNE_MPX_PER_S = 25.0        # lazy pyvips pseudo-DAPI + pyramid write of an H&E level
+TASK_OVERHEAD_S = 300       # start-up, tissue detection, metadata reads
+MEM_SAFETY = 1.25
+TIME_SAFETY = 2.0
+MIN_MEM_GB = 8
+MIN_TIME_MIN = 30
+
+SCRIPT_DIR = "/mnt/scratchc/fmlab/lythgo02/Spatial/scripts"
+
+SLURM_TEMPLATE = """#!/bin/bash
+# ------------------------------------------------------------------------------
+# Generated by python -m prep.plan: {description}
+# ------------------------------------------------------------------------------
+#SBATCH --job-name={job}
+#SBATCH --output={log_dir}/{job}_%A_%a.log
+#SBATCH --error={log_dir}/{job}_%A_%a_error.log
+#SBATCH --partition={partition}
+#SBATCH --cpus-per-task={cpus}
+#SBATCH --mem={mem_gb}G
+#SBATCH --time={time}
+#SBATCH --array=0-{last}%{concurrent}
+
+# Initialize micromamba shell support (IMPORTANT for batch jobs)
+eval "$(micromamba shell hook --shell bash)"
+micromamba activate napari-env
+
+export PATH="$HOME/local/libvips/bin:$PATH"
+export PKG_CONFIG_PATH="$HOME/local/libvips/lib64/pkgconfig:$PKG_CONFIG_PATH"
+export LD_LIBRARY_PATH="$HOME/local/libvips/lib64:/home/lythgo02/micromamba/pkgs/libffi-3.4.6-h2dba641_1/lib:/home/lythgo02/micromamba/envs/napari-env/lib:$LD_LIBRARY_PATH"
+
+cd {script_dir}
+{command}
+"""
+
+
+def sample_pixels(config):
+    """``(dapi_pixels, hne_pixels)`` of the levels ``prepare_sample`` will export, from a sample ``config``."""
+    height, width = config["dapi_shape"]
+    # multiplex channels exported alongside the DAPI are read in the same pass, one plane each
+    count = len(config["exported_channels"]) if config["exported_channels"] is not None else 1
+    dapi_pixels = height * width * count * max(1.0, config["dapi_scale"] ** 2)
+    height, width = config["hne_shape"]
+    hne_pixels = height * width * max(1.0, config["hne_scale"] ** 2)
+    return int(dapi_pixels), int(hne_pixels)
+
+
+def estimate_minutes(dapi_pixels, hne_pixels):
+    """Padded wall-time estimate (minutes) for one sample."""
+    seconds = TASK_OVERHEAD_S + dapi_pixels / (DAPI_MPX_PER_S * 1e6) + hne_pixels / (HNE_MPX_PER_S * 1e6)
+    return max(MIN_TIME_MIN, int(math.ceil(seconds * TIME_SAFETY / 60)))
+
+
+def memory_tier(mem_gb):
+    """Round a memory request up to a power of two GiB (at least ``MIN_MEM_GB``)."""
+    return max(MIN_MEM_GB, 2 ** int(math.ceil(math.log2(max(mem_gb, 1)))))
+
+
+def slurm_time(minutes):
+    """Minutes as a SLURM ``D-HH:MM:SS`` time limit."""
+    days, rest = divmod(int(minutes), 24 * 60)
+    return f"{days}-{rest // 60:02d}:{rest % 60:02d}:00"
+
+
+def plan_samples(master_df, modality, settings=None, save_ome=None, cpus=None):
+    """
+    Per-sample plan table: ``sample``, ``dapi_mpx``, ``hne_mpx``, ``mem_gb``
+    (padded estimate for a task of ``cpus`` CPUs, default: those available here),
+    ``tier_gb`` and ``minutes``. Samples whose outputs under
+    ``save_ome`` are up to date (prep.cache) or without a DAPI / H&E path are
+    left out; missing or inconsistent inputs raise ValueError (``fail_fast``).
+    """
+    settings = sample.make_settings(**(settings or {}))
+    rows = [row for _, row in master_df.iterrows()]
+    configs = sample.configure(rows, modality, settings)
+    records = []
+    for row in rows:
+        file_id = row["MedicalAchiever"]
+        config = configs[file_id]
+        if config["status"] != "ok":
+            print(f"{file_id}: {config['message']}, not planned")
+            continue
+        if save_ome is not None and sample.outputs_current(row, modality, save_ome, settings, config):
+            continue
+        dapi_pixels, hne_pixels = sample_pixels(config)
+        mem_gb = int(math.ceil(batch.estimate_peak_bytes(config, settings, cpus) * MEM_SAFETY / 1024 ** 3))
+        records.append({
+            "sample": file_id,
+            "dapi_mpx": round(dapi_pixels / 1e6, 1),
+            "hne_mpx": round(hne_pixels / 1e6, 1),
+            "mem_gb": mem_gb,
+            "tier_gb": memory_tier(mem_gb),
+            "minutes": estimate_minutes(dapi_pixels, hne_pixels),
+        })
+    return pd.DataFrame(records, columns=["sample", "dapi_mpx", "hne_mpx", "mem_gb", "tier_gb", "minutes"])
+
+
+def _write_script(path, **fields):
+    with open(path, "w") as fh:
+        fh.write(SLURM_TEMPLATE.format(**fields))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    return path
+
+
+def write_array_scripts(plan, modality, out_dir, shards=None, cpus=8, partition="rocm",
+                        max_concurrent=20, script_dir=SCRIPT_DIR):
+    """
+    Write the array job scripts for ``plan`` into ``out_dir`` plus
+    ``submit_<modality>.sh`` that sbatches them all; returns the submit script path.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    out_dir = os.path.abspath(out_dir)
+    script = f"{modality}.py"
+    common = dict(log_dir=out_dir, partition=partition, cpus=cpus, script_dir=script_dir)
+    jobs = []
+    if shards and not plan.empty:
+        # the same rule as comet.py --shard: task i takes rows i, i+N, ... of the planned samples
+        shards = min(int(shards), len(plan))
+        groups = [plan.iloc[i::shards] for i in range(shards)]
+        mem_gb = memory_tier(max(int(group["mem_gb"].max()) for group in groups))
+        minutes = max(int(group["minutes"].sum()) for group in groups)
+        samples_file = os.path.join(out_dir, f"{modality}_samples.txt")
+        with open(samples_file, "w") as fh:
+            fh.write("\n".join(plan["sample"]) + "\n")
+        command = (f'python {script} --samples-file {samples_file} --shard "$SLURM_ARRAY_TASK_ID/{shards}"')
+        jobs.append(_write_script(os.path.join(out_dir, f"{modality}_shards.sh"),
+                                  description=f"{len(plan)} {modality} samples in {shards} shards",
+                                  job=f"{modality}_shards", mem_gb=mem_gb, time=slurm_time(minutes),
+                                  last=shards - 1, concurrent=max_concurrent, command=command, **common))
+    else:
+        for tier_gb, group in plan.groupby("tier_gb"):  # empty plan: no jobs
+            samples_file = os.path.join(out_dir, f"{modality}_{tier_gb}G_samples.txt")
+            with open(samples_file, "w") as fh:
+                fh.write("\n".join(group["sample"]) + "\n")
+            command = (f'SAMPLE=$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" {samples_file})\n'
+                       f'python {script} --sample "$SAMPLE"')
+            jobs.append(_write_script(os.path.join(out_dir, f"{modality}_{tier_gb}G.sh"),
+                                      description=f"{len(group)} {modality} samples needing <= {tier_gb}G",
+                                      job=f"{modality}_{tier_gb}G", mem_gb=tier_gb,
+                                      time=slurm_time(group["minutes"].max()),
+                                      last=len(group) - 1, concurrent=max_concurrent, command=command, **common))
+    submit = os.path.join(out_dir, f"submit_{modality}.sh")
+    with open(submit, "w") as fh:
+        fh.write("#!/bin/bash\n# Submit every array job planned by python -m prep.plan\n")
+        fh.writelines(f"sbatch {job}\n" for job in jobs)
+    os.chmod(submit, os.stat(submit).st_mode | stat.S_IXUSR)
+    return submit
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("modality", choices=sorted(sample.MODALITIES), help="which script / DAPI column to plan for")
+    parser.add_argument("--metadata", required=True, help="master metadata Excel sheet")
+    parser.add_argument("--out-dir", required=True, help="folder for the plan table, sample lists, job scripts and logs")
+    parser.add_argument("--save-ome", default=None, help="output folder of the script; up-to-date samples are left out")
+    parser.add_argument("--shards", type=int, default=None, help="one array of N shard tasks instead of one task per sample")
+    parser.add_argument("--cpus", type=int, default=8, help="--cpus-per-task of every task")
+    parser.add_argument("--partition", default="rocm")
+    parser.add_argument("--max-concurrent", type=int, default=20, help="array tasks running at once (%%N)")
+    parser.add_argument("--script-dir", default=SCRIPT_DIR, help="folder holding comet.py / ultivue.py on the cluster")
+    sample.add_settings_arguments(parser)
+    args = parser.parse_args()
+
+    master_df = pd.read_excel(args.metadata)
+    plan = plan_samples(master_df, args.modality, sample.settings_from_args(args), args.save_ome, args.cpus)
+    os.makedirs(args.out_dir, exist_ok=True)
+    plan.to_excel(os.path.join(args.out_dir, f"plan_{args.modality}.xlsx"), index=False)
+    submit = write_array_scripts(plan, args.modality, args.out_dir, args.shards, args.cpus,
+                                 args.partition, args.max_concurrent, args.script_dir)
+    print(plan.to_string(index=False))
+    print(f"{len(plan)} samples planned; submit with: bash {submit}")
+
+
+if __name__ == "__main__":
+    main()
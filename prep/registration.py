@@ -0,0 +1,361 @@
+"""
+Batch VALIS co-registration of the prepared sample folders, with cached transforms.
+
+Purpose
+-------
+co-register_with_valis.ipynb looped over the sample folders of comet.py /
+ultivue.py and ran ``registration.Valis(...).register()`` serially in one
+kernel, then again with ``MicroRigidRegistrar``: every rerun registered every
+sample from scratch, and warping another channel or resolution meant
+registering again. This driver:
+
+- finds the sample folders under ``save_ome`` and registers their
+  pseudo-DAPI images (``images`` pattern) to ``reference``, one sample per
+  worker process (a crash, OOM kill or JVM error of one sample is recorded
+  and the others carry on; the JVM is killed when each worker ends);
+- keeps VALIS's results where the notebook put them
+  (``<save_ome>/registration/<sample>/``, ``micro_registration`` with
+  ``micro``), including the registrar pickle with the rigid and non-rigid
+  transforms, and records its fingerprint (input files, VALIS version and
+  parameters) in that folder's manifest.json (prep/cache.py): a sample whose
+  inputs and parameters did not change is not registered again;
+- ``warp_only``: loads the cached registrar of each sample and warps other
+  images on the same pixel grid as a registered one (by default the
+  multiplex channel outputs onto their DAPI: comet-channels.ome.tif,
+  comet-chNN-*.tif, ...) at any pyramid ``level``, without feature detection
+  or optimisation. Warped files go to ``registration/<sample>/warped/`` and
+  are cached the same way.
+
+Usage
+-----
+python -m prep register /mnt/scratchc/.../valis_prep_comet_hne40x/ [--micro] [--max-workers 2]
+python -m prep register /mnt/scratchc/.../valis_prep_comet_hne40x/ --micro --warp-only \
+    [--warp pseudo-dapi-comet.tif=comet-ch*.tif] [--level 1]
+
+Notes
+-----
+- Requires valis-wsi (imported in the workers only); VALIS's own outputs
+  (overlaps, error metrics) are written as before.
+- A registration interrupted half way is not recorded, so it is redone.
+- ``--warp-only`` never registers: samples without a current registrar are
+  reported as skipped.
+"""
+
+import argparse
+import fnmatch
+import importlib.metadata
+import multiprocessing
+import multiprocessing.connection
+import os
+import time
+import traceback
+
+import pandas as pd
+
+from prep import cache, sample
+
+DEFAULT_SETTINGS = {
+    "reference": "pseudo-dapi-ultivue.tif",   # image the others are aligned to (align_to_reference)
+    "images": "pseudo-dapi-*.tif",            # images of a sample folder to register
+    "image_type": "fluorescence",
+    "max_processed_image_dim_px": 850,        # rigid registration image size; adjust (500-2000) if it fails
+    "micro": False,                           # MicroRigidRegistrar + register_micro (micro_registration/)
+    "micro_reg_fraction": 0.25,               # micro non-rigid size, as a fraction of the smallest image
+}
+RESULTS_NAME = "registration_results.xlsx"
+WARP_RESULTS_NAME = "warp_results.xlsx"
+
+
+def make_settings(**overrides):
+    """``DEFAULT_SETTINGS`` with ``overrides`` applied (unknown keys are rejected)."""
+    unknown = set(overrides) - set(DEFAULT_SETTINGS)
+    if unknown:
+        raise ValueError(f"Unknown registration settings: {sorted(unknown)}")
+    return {**DEFAULT_SETTINGS, **overrides}
+
+
+def valis_version():
+    """Installed valis-wsi version (part of the fingerprint), without importing VALIS."""
+    try:
+        return importlib.metadata.version("valis-wsi")
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+def results_dir(save_ome, s):
+    """Where VALIS writes: ``registration`` or ``micro_registration`` under ``save_ome``, as in the notebook."""
+    return os.path.join(save_ome, "micro_registration" if s["micro"] else "registration")
+
+
+def sample_images(sample_dir, s):
+    """Sorted file names of ``sample_dir`` to register (``images`` pattern)."""
+    return sorted(name for name in os.listdir(sample_dir)
+                  if fnmatch.fnmatch(name, s["images"]) and os.path.isfile(os.path.join(sample_dir, name)))
+
+
+def find_samples(save_ome, s):
+    """``{sample: folder}`` of the folders under ``save_ome`` holding at least two images to register."""
+    samples = {}
+    for name in sorted(os.listdir(save_ome)):
+        folder = os.path.join(save_ome, name)
+        if os.path.isdir(folder) and len(sample_images(folder, s)) >= 2:
+            samples[name] = folder
+    return samples
+
+
+def registrar_name(file_id):
+    """Registrar pickle relative to ``<results_dir>/<sample>`` (VALIS's data/<name>_registrar.pickle)."""
+    return os.path.join("data", f"{file_id}_registrar.pickle")
+
+
+def registration_key(sample_dir, s):
+    """Fingerprint of a sample's registration: its images plus the parameters and VALIS version."""
+    images = sample_images(sample_dir, s)
+    return cache.fingerprint([os.path.join(sample_dir, name) for name in images], {
+        "stage": "registration", "images": images, "valis": valis_version(),
+        **{key: s[key] for key in sorted(DEFAULT_SETTINGS) if key != "images"}})
+
+
+def default_warp(sample_dir):
+    """
+    ``{registered image: [patterns]}``: the multiplex channel outputs of each
+    modality (prep/channels.py) onto its DAPI, which shares their pixel grid.
+    """
+    return {names["dapi_name"]: [f"{names['channel_prefix']}-*.tif"] for names in sample.MODALITIES.values()
+            if os.path.exists(os.path.join(sample_dir, names["dapi_name"]))}
+
+
+def warp_jobs(sample_dir, warp):
+    """``[(registered image, source path, output name)]`` of the files matching ``warp`` patterns."""
+    jobs = []
+    for image, patterns in warp.items():
+        for name in sorted(os.listdir(sample_dir)):
+            if any(fnmatch.fnmatch(name, pattern) for pattern in patterns): # the image itself: e.g. another level
+                jobs.append((image, os.path.join(sample_dir, name), name))
+    return jobs
+
+
+def parse_warp(values):
+    """``--warp IMAGE=PATTERN`` values -> ``{image: [patterns]}`` (None: ``default_warp``)."""
+    if not values:
+        return None
+    warp = {}
+    for value in values:
+        image, sep, pattern = value.partition("=")
+        if not sep or not image or not pattern:
+            raise ValueError(f"--warp takes IMAGE=PATTERN, got {value!r}")
+        warp.setdefault(image, []).append(pattern)
+    return warp
+
+
+def register_sample(file_id, sample_dir, dst_dir, s):
+    """
+    Register the images of one sample with VALIS (in a worker process); returns
+    the registrar pickle relative to ``<dst_dir>/<file_id>``. Raises on failure.
+    """
+    import numpy as np
+    from valis import registration
+
+    images = [os.path.join(sample_dir, name) for name in sample_images(sample_dir, s)]
+    if s["reference"] not in map(os.path.basename, images):
+        raise ValueError(f"reference {s['reference']} not among the images {sorted(map(os.path.basename, images))}")
+    kwargs = {}
+    if s["micro"]:
+        from valis.micro_rigid_registrar import MicroRigidRegistrar # High-res rigid registration
+        kwargs["micro_rigid_registrar_cls"] = MicroRigidRegistrar
+    registrar = registration.Valis(sample_dir, dst_dir, name=file_id, img_list=images,
+                                   reference_img_f=s["reference"], align_to_reference=True,
+                                   image_type=s["image_type"],
+                                   max_processed_image_dim_px=s["max_processed_image_dim_px"], **kwargs)
+    try:
+        rigid_registrar, non_rigid_registrar, error_df = registrar.register() # rigid + non-rigid
+        if s["micro"]: # micro non-rigid registration at a fraction of the smallest image's full resolution
+            img_dims = np.array([slide_obj.slide_dimensions_wh[0] for slide_obj in registrar.slide_dict.values()])
+            min_max_size = np.min([np.max(d) for d in img_dims])
+            micro_reg_size = np.floor(min_max_size * s["micro_reg_fraction"]).astype(int)
+            micro_registrar, error_df = registrar.register_micro(max_non_rigid_registration_dim_px=micro_reg_size)
+    finally:
+        registration.kill_jvm()
+    return registrar_name(file_id) # error metrics are in VALIS's own outputs
+
+
+def warp_sample(registrar_path, jobs, out_dir, level=0, non_rigid=True, crop=True, keys=None):
+    """
+    Warp ``jobs`` (``warp_jobs``) with the cached registrar at ``registrar_path`` (in a
+    worker process), writing ``<out_dir>/<name>``; returns the names written.
+    """
+    from valis import registration
+
+    registrar = registration.load_registrar(registrar_path)
+    written = []
+    try:
+        for image, src, name in jobs:
+            slide_obj = registrar.get_slide(image)
+            with cache.atomic_output(os.path.join(out_dir, name)) as partial:
+                slide_obj.warp_and_save_slide(dst_f=partial, level=level, non_rigid=non_rigid, crop=crop, src_f=src)
+            if keys is not None:
+                cache.record(out_dir, name, keys[name])
+            written.append(name)
+    finally:
+        registration.kill_jvm()
+    return written
+
+
+def _run(conn, func, args):
+    """Worker entry point: sends a status record, never raises."""
+    start = time.perf_counter()
+    try:
+        record = {"status": "done", "message": "", "error": "", "result": func(*args)}
+    except Exception as exc:
+        record = {"status": "failed", "message": f"{type(exc).__name__}: {exc}", "error": traceback.format_exc()}
+    record["seconds"] = round(time.perf_counter() - start, 1)
+    conn.send(record)
+    conn.close()
+
+
+def run_isolated(tasks, max_workers=1):
+    """
+    Run ``tasks`` (``{name: (func, args)}``) in fresh spawned processes, at most
+    ``max_workers`` at once; yields ``(name, record)`` as they finish. A worker
+    that dies (OOM kill, segfault in native code) gives a "failed" record.
+    """
+    context = multiprocessing.get_context("spawn")
+    pending = list(tasks.items())
+    running = {}                                    # parent end of the pipe -> (name, process)
+    while pending or running:
+        while pending and len(running) < max_workers:
+            name, (func, args) = pending.pop(0)
+            parent, child = context.Pipe(duplex=False)
+            process = context.Process(target=_run, args=(child, func, args), name=f"prep-register-{name}")
+            process.start()
+            child.close()   # only the worker holds the sending end: EOF when it exits
+            running[parent] = (name, process)
+        for conn in multiprocessing.connection.wait(list(running)):
+            name, process = running.pop(conn)
+            try:
+                record = conn.recv()
+            except EOFError:
+                record = None
+            conn.close()
+            process.join()
+            if record is None:
+                record = {"status": "failed", "seconds": None, "error": "",
+                          "message": f"worker process died (exit code {process.exitcode}; out of memory?)"}
+            yield name, record
+
+
+def register_all(save_ome, settings=None, samples=None, max_workers=1):
+    """
+    Register every sample folder under ``save_ome`` (or those in ``samples``)
+    whose registration is not current; returns a results DataFrame (sample,
+    status registered / up to date / failed, message, seconds, error).
+    """
+    s = make_settings(**(settings or {}))
+    dst_dir = results_dir(save_ome, s)
+    folders = find_samples(save_ome, s)
+    if samples:
+        missing = set(samples) - set(folders)
+        if missing:
+            raise ValueError(f"No sample folders with images to register for: {sorted(missing)}")
+        folders = {file_id: folders[file_id] for file_id in samples}
+    records, tasks, keys = {}, {}, {}
+    for file_id, folder in folders.items():
+        keys[file_id] = registration_key(folder, s)
+        if cache.is_current(os.path.join(dst_dir, file_id), registrar_name(file_id), keys[file_id]):
+            records[file_id] = {"status": "up to date", "message": "", "error": "", "seconds": 0.0}
+        else:
+            tasks[file_id] = (register_sample, (file_id, folder, dst_dir, s))
+    print(f"{len(tasks)} sample(s) to register, {len(records)} up to date")
+    for file_id, record in run_isolated(tasks, max_workers):
+        if record["status"] == "done":
+            cache.record(os.path.join(dst_dir, file_id), record.pop("result"), keys[file_id])
+            record["status"] = "registered"
+        records[file_id] = record
+        print(f"{file_id}: {record['status']} {record['message']}")
+    table = pd.DataFrame([{"sample": file_id, **record} for file_id, record in records.items()])
+    return table.reindex(columns=["sample", "status", "message", "seconds", "error"])
+
+
+def warp_all(save_ome, settings=None, samples=None, warp=None, level=0, non_rigid=True, crop=True, max_workers=1):
+    """
+    Warp-only: apply each sample's cached transforms to the files matching
+    ``warp`` (``{registered image: [patterns]}``, default ``default_warp``),
+    written to ``<results_dir>/<sample>/warped/``; only outputs whose source,
+    transforms or options changed are rewritten. Returns a results DataFrame.
+    """
+    s = make_settings(**(settings or {}))
+    dst_dir = results_dir(save_ome, s)
+    folders = find_samples(save_ome, s)
+    if samples:
+        folders = {file_id: folders[file_id] for file_id in samples if file_id in folders}
+    records, tasks = {}, {}
+    for file_id, folder in folders.items():
+        reg_folder = os.path.join(dst_dir, file_id)
+        key = registration_key(folder, s)
+        if not cache.is_current(reg_folder, registrar_name(file_id), key):
+            records[file_id] = {"status": "skipped", "message": "no current registration (run without --warp-only)",
+                                "error": "", "seconds": 0.0}
+            continue
+        out_dir = os.path.join(reg_folder, "warped")
+        jobs, keys = [], {}
+        for image, src, name in warp_jobs(folder, warp or default_warp(folder)):
+            keys[name] = cache.fingerprint([src], {"stage": "warp", "registration": key, "image": image,
+                                                   "level": level, "non_rigid": non_rigid, "crop": crop})
+            if not cache.is_current(out_dir, name, keys[name]):
+                jobs.append((image, src, name))
+        if not jobs:
+            records[file_id] = {"status": "up to date", "message": "", "error": "", "seconds": 0.0}
+            continue
+        tasks[file_id] = (warp_sample, (os.path.join(reg_folder, registrar_name(file_id)), jobs, out_dir,
+                                        level, non_rigid, crop, keys))
+    print(f"{len(tasks)} sample(s) to warp, {len(records)} up to date or skipped")
+    for file_id, record in run_isolated(tasks, max_workers):
+        if record["status"] == "done":
+            record.update(status="warped", message=", ".join(record.pop("result")))
+        records[file_id] = record
+        print(f"{file_id}: {record['status']} {record['message']}")
+    table = pd.DataFrame([{"sample": file_id, **record} for file_id, record in records.items()])
+    return table.reindex(columns=["sample", "status", "message", "seconds", "error"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("save_ome", help="output folder of comet.py / ultivue.py (one subfolder per sample)")
+    parser.add_argument("--sample", nargs="+", default=None, help="only these sample folders")
+    parser.add_argument("--reference", default=DEFAULT_SETTINGS["reference"], help="image the others are aligned to")
+    parser.add_argument("--images", default=DEFAULT_SETTINGS["images"], help="pattern of the images to register")
+    parser.add_argument("--max-processed-image-dim-px", type=int, default=DEFAULT_SETTINGS["max_processed_image_dim_px"],
+                        help="rigid registration image size (500-2000; smaller for little empty space around tissue)")
+    parser.add_argument("--micro", action="store_true", help="micro-rigid + micro non-rigid registration (micro_registration/)")
+    parser.add_argument("--micro-reg-fraction", type=float, default=DEFAULT_SETTINGS["micro_reg_fraction"],
+                        help="micro non-rigid size as a fraction of the smallest image")
+    parser.add_argument("--max-workers", type=int, default=1, help="samples registered at once, one process each")
+    parser.add_argument("--warp-only", action="store_true", help="reuse cached transforms to warp other images")
+    parser.add_argument("--warp", nargs="+", default=None, metavar="IMAGE=PATTERN",
+                        help="warp files matching PATTERN with the transform of registered IMAGE "
+                             "(default: each modality's channel outputs onto its DAPI)")
+    parser.add_argument("--level", type=int, default=0, help="pyramid level of the images to warp")
+    parser.add_argument("--rigid-only", action="store_true", help="warp with the rigid transform only")
+    parser.add_argument("--no-crop", action="store_true", help="do not crop warped images to the reference")
+    parser.add_argument("--results", default=None,
+                        help=f"results table (default: <results dir>/{RESULTS_NAME}, or {WARP_RESULTS_NAME})")
+    args = parser.parse_args()
+
+    settings = make_settings(reference=args.reference, images=args.images, micro=args.micro,
+                             max_processed_image_dim_px=args.max_processed_image_dim_px,
+                             micro_reg_fraction=args.micro_reg_fraction)
+    if args.warp_only:
+        table = warp_all(args.save_ome, settings, args.sample, parse_warp(args.warp), args.level,
+                         not args.rigid_only, not args.no_crop, args.max_workers)
+    else:
+        table = register_all(args.save_ome, settings, args.sample, args.max_workers)
+    results = args.results or os.path.join(results_dir(args.save_ome, settings),
+                                           WARP_RESULTS_NAME if args.warp_only else RESULTS_NAME)
+    os.makedirs(os.path.dirname(os.path.abspath(results)), exist_ok=True)
+    table.to_excel(results, index=False)
+    print(table[["sample", "status", "message", "seconds"]].to_string(index=False))
+    print(f"Results written to {results}")
+
+
+if __name__ == "__main__":
+    main()
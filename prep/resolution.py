@@ -0,0 +1,100 @@
+"""
+Physical-resolution-aware pyramid level selection.
+
+Purpose
+-------
+comet.py / ultivue.py always read pyramid level 0 and then resampled with
+hard-coded factors (0.9245x Ultivue downscale, 2.0x for 20x H&E scans, a no-op
+1.0x). Given a target pixel size in µm/pixel, the helpers here read the pixel
+size of every pyramid level from the file itself and pick the coarsest level
+that is still at least as fine as the target, leaving only a small residual
+resample (scale <= 1, or > 1 only when even level 0 is coarser than the target).
+
+- OME-TIFF (COMET / Ultivue): PhysicalSizeX from the OME-XML (the same field
+  gather_ome_tiff_comet_metadata.py / gather_ultivue_metadata.py record),
+  scaled by each level's width ratio.
+- Whole-slide H&E: ``openslide.mpp-x`` and ``openslide.level[N].downsample``
+  (the fields gather_h&e_meta_data.py records), from OpenSlide or pyvips.
+
+Notes
+-----
+- A residual within ``SCALE_TOLERANCE`` of 1.0 is reported as exactly 1.0 so
+  callers can skip resampling altogether.
+"""
+
+import xml.etree.ElementTree as ET
+
+SCALE_TOLERANCE = 0.01
+_UNIT_TO_UM = {"µm": 1.0, "um": 1.0, "micron": 1.0, "nm": 1e-3, "mm": 1e3}
+
+
+def ome_pixel_size(tif):
+    """PhysicalSizeX (µm/pixel) of level 0 from the OME-XML of ``tif``, or None."""
+    ome_xml = tif.ome_metadata
+    if not ome_xml:
+        return None
+    pixels = ET.fromstring(ome_xml).find(".//{*}Pixels")
+    if pixels is None or pixels.attrib.get("PhysicalSizeX") is None:
+        return None
+    unit = pixels.attrib.get("PhysicalSizeXUnit", "µm")
+    return float(pixels.attrib["PhysicalSizeX"]) * _UNIT_TO_UM.get(unit, 1.0)
+
+
+def ome_level_pixel_sizes(tif):
+    """µm/pixel of every pyramid level of the first series of ``tif`` (None if unknown)."""
+    base = ome_pixel_size(tif)
+    if base is None:
+        return None
+    levels = tif.series[0].levels
+    base_width = levels[0].shape[-1]
+    return [base * base_width / level.shape[-1] for level in levels]
+
+
+def slide_level_pixel_sizes(properties):
+    """
+    µm/pixel of every level of a whole-slide image from its OpenSlide properties.
+
+    ``properties`` is ``OpenSlide(...).properties`` or any mapping with the same
+    keys (e.g. ``prep.hne.slide_properties``). Returns None without ``openslide.mpp-x``.
+    """
+    mpp = properties.get("openslide.mpp-x")
+    if not mpp:
+        return None
+    level_count = int(properties.get("openslide.level-count", 1))
+    return [float(mpp) * float(properties.get(f"openslide.level[{i}].downsample", 1.0))
+            for i in range(level_count)]
+
+
+def choose_level(level_pixel_sizes, target_mpp):
+    """
+    ``(level, scale)`` to reach ``target_mpp`` from a pyramid with the given pixel sizes.
+
+    ``level`` is the coarsest level whose pixel size is <= the target (level 0
+    if none is); ``scale`` is the residual resize factor to apply to it.
+    """
+    if not level_pixel_sizes:
+        raise ValueError("No pixel size metadata available to choose a pyramid level")
+    level = 0
+    for i, mpp in enumerate(level_pixel_sizes):
+        if mpp <= target_mpp * (1 + SCALE_TOLERANCE) and mpp >= level_pixel_sizes[level]:
+            level = i
+    scale = level_pixel_sizes[level] / target_mpp
+    if abs(scale - 1.0) <= SCALE_TOLERANCE:
+        scale = 1.0
+    return level, scale
+
+
+def ome_level_for(tif, target_mpp):
+    """``(level, scale)`` for an OME-TIFF; raises ValueError without PhysicalSizeX."""
+    sizes = ome_level_pixel_sizes(tif)
+    if sizes is None:
+        raise ValueError(f"No PhysicalSizeX in the OME-XML of {tif.filehandle.path}")
+    return choose_level(sizes, target_mpp)
+
+
+def slide_level_for(properties, target_mpp):
+    """``(level, scale)`` for a whole-slide image; raises ValueError without openslide.mpp-x."""
+    sizes = slide_level_pixel_sizes(properties)
+    if sizes is None:
+        raise ValueError("No openslide.mpp-x in the slide properties")
+    return choose_level(sizes, target_mpp)
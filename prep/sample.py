@@ -0,0 +1,640 @@
+"""
+Per-sample DAPI / H&E preparation shared by comet.py, ultivue.py and the batch runner.
+
+Purpose
+-------
+``prepare_sample`` is the body of the comet.py / ultivue.py loop for one row
+of the master metadata sheet: normalise the COMET or Ultivue DAPI, build the
+H&E pseudo-DAPI and write both as pyramid BigTIFFs (plus crop.json) under
+``<save_ome>/<MedicalAchiever>/``. It is a plain module-level function so it
+can run serially in the scripts or in worker processes (prep/batch.py).
+
+Outputs are incremental (prep/cache.py): each file is rebuilt only when its
+inputs or settings changed, written under a temporary name and renamed into
+place, and the H&E pseudo-DAPI is shared between the COMET and Ultivue runs.
+The DAPI and H&E exports of a sample run concurrently, and ``prepare_samples``
+prefetches the next sample's inputs (prep/pipeline.py). With the ``channels``
+setting the other multiplex channels are exported from the same read of the
+OME-TIFF as the DAPI (prep/channels.py). Pyramid levels and scale factors
+come from the slide catalog and every row is checked before any sample
+starts (``configure``, prep/autoconfig.py). With ``staging_dir`` the inputs
+are copied to node-local disk and read from there (prep/staging.py). Every
+stage's time, CPU, peak RSS and I/O is appended to a JSON-lines telemetry
+file (prep/telemetry.py). ``prepare_hne`` builds the shared H&E pseudo-DAPIs
+alone (``python -m prep hne``).
+
+Settings
+--------
+``DEFAULT_SETTINGS`` holds the knobs the scripts expose (level, dapi_idx,
+target_mpp, hne_objective, crop_to_tissue, stream_dapi, tile_budget,
+percentile_level, stream_hne, hne_cache, concurrent_stages, prefetch_bytes,
+export, channels, channel_output, fail_fast, catalog_index, staging_dir,
+staging_quota, telemetry, profile); pass a dict
+overriding any of them.
+"""
+
+import contextlib
+import gc
+import os
+import threading
+
+import numpy as np
+import tifffile as tff
+
+from prep import autoconfig, cache, catalog, channels, dapi, export, hne, percentiles, pipeline, staging, telemetry, tissue
+
+# Per-modality columns of the master sheet and output file names
+MODALITIES = {
+    "comet": {
+        "dapi_column": "COMET_DAPI_path",
+        "dapi_name": "pseudo-dapi-comet.tif",
+        "hne_name": "pseudo-dapi-hne-40x.tif",
+        "channel_prefix": "comet",
+    },
+    "ultivue": {
+        "dapi_column": "Ultivue_DAPI_path",
+        "dapi_name": "pseudo-dapi-ultivue.tif",
+        "hne_name": "pseudo-dapi-hne.tif",
+        "channel_prefix": "ultivue",
+    },
+}
+
+PERCENTILES = (0.05, 99.95)     # DAPI clip limits (also per multiplex channel)
+CHANNEL_OUTPUTS = ("ome", "separate", "both")
+
+DEFAULT_SETTINGS = {
+    "level": 0,
+    "dapi_idx": 0,
+    "target_mpp": None,
+    "hne_objective": 40,            # H&E scanned at another objective power (e.g. 20x) is rescaled to this one
+    "crop_to_tissue": True,
+    "stream_dapi": True,
+    "tile_budget": dapi.DEFAULT_TILE_BUDGET,
+    "percentile_level": None,
+    "stream_hne": True,
+    "hne_cache": None,              # shared H&E pseudo-DAPI store; None = hne_pseudo_dapi_cache next to save_ome
+    "concurrent_stages": True,      # DAPI and H&E exports in parallel threads
+    "prefetch_bytes": pipeline.DEFAULT_PREFETCH_BYTES,  # per input file of the next sample (prepare_samples)
+    "export": export.DEFAULT_PRESET,  # pyramid compression / tiling: preset name or options dict (prep/export.py)
+    "channels": None,               # None = DAPI only; "all" or channel indices: also export these multiplex channels
+    "channel_output": "ome",        # ome = one multi-channel OME-TIFF, separate = one pyramid per channel, or both
+    "fail_fast": True,              # any missing / inconsistent input stops the run before the first sample
+    "catalog_index": catalog.DEFAULT_INDEX,  # SQLite index of slide headers (prep/catalog.py)
+    "staging_dir": None,            # None = read inputs in place; "auto" ($TMPDIR) or a node-local directory
+    "staging_quota": staging.DEFAULT_QUOTA,  # bytes of staged inputs kept, least recently used evicted first
+    "telemetry": "auto",            # JSON-lines stage telemetry: "auto" = <save_ome>/prep_telemetry.jsonl, a path or None
+    "profile": None,                # None, "py-spy" (threads named after their stage) or "tracemalloc"
+}
+
+
+def make_settings(**overrides):
+    """``DEFAULT_SETTINGS`` with ``overrides`` applied (unknown keys are rejected)."""
+    unknown = set(overrides) - set(DEFAULT_SETTINGS)
+    if unknown:
+        raise ValueError(f"Unknown settings: {sorted(unknown)}")
+    return {**DEFAULT_SETTINGS, **overrides}
+
+
+def add_settings_arguments(parser):
+    """Command-line flags for the settings shared by prep.batch and prep.plan."""
+    parser.add_argument("--target-mpp", type=float, default=None, help="target µm/pixel (see prep/resolution.py)")
+    parser.add_argument("--percentile-level", type=int, default=None, help="pyramid level for the DAPI clip limits")
+    parser.add_argument("--hne-objective", type=float, default=DEFAULT_SETTINGS["hne_objective"],
+                        help="objective power H&E slides are rescaled to (without --target-mpp)")
+    parser.add_argument("--keep-going", action="store_true",
+                        help="skip samples with missing / inconsistent inputs instead of stopping before the first")
+    parser.add_argument("--no-crop", action="store_true", help="export the full slide instead of the tissue box")
+    parser.add_argument("--in-memory", action="store_true", help="use the in-memory DAPI and H&E paths")
+    parser.add_argument("--export", default=export.DEFAULT_PRESET, choices=sorted(export.PRESETS),
+                        help="pyramid compression preset (prep/export.py)")
+    parser.add_argument("--channels", nargs="+", default=None,
+                        help='also export these multiplex channels ("all" or indices) in the DAPI pass')
+    parser.add_argument("--channel-output", default="ome", choices=CHANNEL_OUTPUTS,
+                        help="multi-channel OME-TIFF, one pyramid per channel, or both")
+    parser.add_argument("--staging-dir", nargs="?", const="auto", default=None,
+                        help="copy inputs to this node-local directory first (no value: $TMPDIR)")
+    parser.add_argument("--telemetry", default="auto",
+                        help='JSON-lines stage telemetry file ("auto": <save-ome>/prep_telemetry.jsonl, "none": off)')
+    parser.add_argument("--profile", default=None, choices=[p for p in telemetry.PROFILES if p],
+                        help="py-spy: threads named after their stage; tracemalloc: trace Python allocations")
+    parser.add_argument("--staging-quota-gb", type=float, default=DEFAULT_SETTINGS["staging_quota"] / 1024 ** 3,
+                        help="disk quota of the staging directory")
+    return parser
+
+
+def settings_from_args(args):
+    """Settings overrides from flags added by ``add_settings_arguments``."""
+    return {"target_mpp": args.target_mpp, "hne_objective": args.hne_objective, "fail_fast": not args.keep_going,
+            "percentile_level": args.percentile_level,
+            "crop_to_tissue": not args.no_crop, "stream_dapi": not args.in_memory, "stream_hne": not args.in_memory,
+            "export": args.export, "channels": parse_channels(args.channels), "channel_output": args.channel_output,
+            "staging_dir": args.staging_dir, "staging_quota": int(args.staging_quota_gb * 1024 ** 3),
+            "telemetry": None if args.telemetry.lower() == "none" else args.telemetry, "profile": args.profile}
+
+
+def parse_channels(values):
+    """``--channels`` values -> None, "all" or a list of channel indices."""
+    if not values:
+        return None
+    if list(values) == ["all"]:
+        return "all"
+    try:
+        return [int(value) for value in values]
+    except ValueError:
+        raise ValueError(f'Channels must be "all" or integer indices, got {values}') from None
+
+
+def parse_shard(text):
+    """``"i/N"`` -> ``(i, N)`` with 0 <= i < N."""
+    try:
+        index, count = (int(part) for part in str(text).split("/"))
+    except ValueError:
+        raise ValueError(f"Shard must look like i/N, got {text!r}") from None
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Shard index must be in [0, {count}), got {text!r}")
+    return index, count
+
+
+def select_rows(master_df, samples=None, shard=None):
+    """
+    Rows of the master sheet to process: the MedicalAchiever IDs in ``samples``
+    and/or every N-th row starting at i for ``shard`` = "i/N" (row order of the sheet).
+    """
+    selected = master_df
+    if samples:
+        missing = set(samples) - set(master_df["MedicalAchiever"])
+        if missing:
+            raise ValueError(f"Samples not in the metadata sheet: {sorted(missing)}")
+        selected = selected[selected["MedicalAchiever"].isin(samples)]
+    if shard is not None:
+        index, count = parse_shard(shard)
+        selected = selected.iloc[index::count]
+    return selected
+
+
+def configure(rows, modality, settings=None):
+    """
+    ``{MedicalAchiever: config}`` of ``rows``: levels, scale factors and shapes
+    from the slide catalog, every row checked first (prep/autoconfig.py).
+    """
+    s = make_settings(**(settings or {}))
+    return autoconfig.configure(rows, MODALITIES[modality]["dapi_column"], s, index_path=s["catalog_index"])
+
+
+def dapi_fingerprint(dapi_path, level, scale, s):
+    """Cache key of a DAPI export: input file identity plus every setting that changes its pixels."""
+    return cache.fingerprint([dapi_path], {
+        "stage": "dapi", "level": level, "scale": round(scale, 6), "channel": int(s["dapi_idx"]),
+        "crop": s["crop_to_tissue"], "pad": tissue.DEFAULT_PAD, "percentiles": PERCENTILES,
+        "percentile_level": s["percentile_level"], "stream": s["stream_dapi"], "export": export.resolve(s["export"])})
+
+
+def channel_fingerprint(dapi_path, level, scale, s, exported):
+    """Cache key of a multiplex channel output holding the channel indices ``exported``."""
+    return cache.fingerprint([dapi_path], {
+        "stage": "channels", "level": level, "scale": round(scale, 6), "channels": [int(c) for c in exported],
+        "crop_channel": int(s["dapi_idx"]), "crop": s["crop_to_tissue"], "pad": tissue.DEFAULT_PAD,
+        "percentiles": PERCENTILES, "percentile_level": s["percentile_level"], "export": export.resolve(s["export"])})
+
+
+def dapi_channel(tif, s):
+    """Index of the DAPI channel (0 for single-channel files)."""
+    return int(s["dapi_idx"]) if len(tif.series[0].shape) == 3 else 0
+
+
+def selected_channels(tif, s):
+    """Channel indices exported with the ``channels`` setting (the DAPI channel is always included)."""
+    selected = channels.select_channels(channels.channel_count(dapi.open_level(tif, 0)), s["channels"])
+    return sorted(set(selected) | {dapi_channel(tif, s)})
+
+
+def channel_outputs(tif, modality, s):
+    """
+    ``{output name: channel index}`` of the multiplex outputs besides the DAPI
+    (index None for the multi-channel OME-TIFF); empty unless ``channels`` is set.
+    """
+    if s["channels"] is None:
+        return {}
+    if s["channel_output"] not in CHANNEL_OUTPUTS:
+        raise ValueError(f"channel_output must be one of {CHANNEL_OUTPUTS}, got {s['channel_output']!r}")
+    if not s["stream_dapi"]:
+        raise ValueError("Exporting multiplex channels needs stream_dapi = True")
+    prefix = MODALITIES[modality]["channel_prefix"]
+    selected = selected_channels(tif, s)
+    outputs = {}
+    if s["channel_output"] in ("ome", "both"):
+        outputs[f"{prefix}-channels.ome.tif"] = None
+    if s["channel_output"] in ("separate", "both"):
+        names = channels.ome_channel_names(tif)
+        dapi_idx = dapi_channel(tif, s)
+        for c in selected:
+            if c != dapi_idx:
+                outputs[f"{prefix}-ch{c:02d}-{channels.safe_name(names[c])}.tif"] = c
+    return outputs
+
+
+def dapi_keys(tif, modality, dapi_path, level, scale, s):
+    """``{output name: fingerprint}`` of the DAPI and of any multiplex channel outputs."""
+    keys = {MODALITIES[modality]["dapi_name"]: dapi_fingerprint(dapi_path, level, scale, s)}
+    selected = selected_channels(tif, s) if s["channels"] is not None else []
+    for name, c in channel_outputs(tif, modality, s).items():
+        keys[name] = channel_fingerprint(dapi_path, level, scale, s, selected if c is None else [c])
+    return keys
+
+
+def hne_fingerprint(hne_path, level, scale, s):
+    """Cache key of an H&E pseudo-DAPI export (shared by COMET and Ultivue runs)."""
+    params = {"stage": "hne", "level": level, "scale": round(scale, 6), "crop": s["crop_to_tissue"],
+              "pad": tissue.DEFAULT_PAD, "stream": s["stream_hne"], "export": export.resolve(s["export"])}
+    if s["stream_hne"] and scale != 1.0:
+        params["resample"] = "skimage" # streamed resize rebuilt since it follows ski.transform.rescale
+    return cache.fingerprint([hne_path], params)
+
+
+def hne_cache_dir(save_ome, s):
+    """Shared H&E store: ``s["hne_cache"]``, else a folder next to ``save_ome``."""
+    return s["hne_cache"] or os.path.join(os.path.dirname(os.path.normpath(save_ome)), "hne_pseudo_dapi_cache")
+
+
+def staging_cache(s):
+    """The node-local ``StagingCache`` of settings ``s``, or None with staging off."""
+    if s["staging_dir"] is None:
+        return None
+    return staging.cache_for(s["staging_dir"], s["staging_quota"])
+
+
+def telemetry_path(save_ome, s):
+    """JSON-lines telemetry file of settings ``s`` (None with telemetry off)."""
+    if s["telemetry"] == "auto":
+        return os.path.join(save_ome, telemetry.TELEMETRY_NAME)
+    return s["telemetry"]
+
+
+def export_dapi(tif, dapi_path, out_path, level, scale, s):
+    """Normalise and write the DAPI pyramid; returns (uint8 array or None if streamed, crop record)."""
+    dapi_idx = s["dapi_idx"]
+    with telemetry.stage("tissue box"):
+        dapi_box = tissue.dapi_tissue_box(tif, dapi_idx) if s["crop_to_tissue"] else tissue.FULL_BOX
+    if s["stream_dapi"]: # Out-of-core: percentiles and normalisation band by band, written straight to the pyramid
+        with telemetry.stage("open"):
+            dapi_plane = dapi.open_level(tif, level)
+        dapi_pixels = tissue.box_pixels(dapi_box, dapi_plane.shape)
+        print(np.shape(dapi_plane), "tissue box", dapi_pixels)
+        with telemetry.stage("percentiles"):
+            if s["percentile_level"] is None:
+                lwcy5_wb, upcy5_wb = percentiles.plane_percentiles(dapi_plane, PERCENTILES, channel=dapi_idx,
+                                                                   tile_budget=s["tile_budget"], box=dapi_pixels)
+            else:
+                lwcy5_wb, upcy5_wb = percentiles.level_percentiles(tif, s["percentile_level"], PERCENTILES, channel=dapi_idx,
+                                                                   tile_budget=s["tile_budget"], box=dapi_box)
+        dapi.write_normalised(dapi_plane, out_path, lwcy5_wb, upcy5_wb, channel=dapi_idx,
+                              scale=scale, tile_budget=s["tile_budget"], box=dapi_pixels, options=s["export"])
+        wsiStain = None
+    else:
+        with telemetry.stage("open"):
+            position_zarr = dapi.open_level(tif, level) # Use Zarr to avoid loading into memory the complete image
+        print(np.shape(position_zarr))
+        y0, x0, y1, x1 = tissue.box_pixels(dapi_box, position_zarr.shape) # read only the tissue bounding box
+        with telemetry.stage("read"):
+            if position_zarr.ndim == 3: # Load DAPI image and preprocess it
+                wsiStain = np.array(position_zarr[int(dapi_idx), y0:y1, x0:x1])
+            elif position_zarr.ndim == 2:
+                wsiStain = np.array(position_zarr[y0:y1, x0:x1])
+            else:
+                raise ValueError(f"Unexpected array shape: {position_zarr.shape}")
+        with telemetry.stage("percentiles"):
+            if s["percentile_level"] is None: # exact, same limits as scoreatpercentile without sorting the slide
+                lwcy5_wb, upcy5_wb = percentiles.array_percentiles(wsiStain, PERCENTILES)
+            else:
+                lwcy5_wb, upcy5_wb = percentiles.level_percentiles(tif, s["percentile_level"], PERCENTILES, channel=dapi_idx, box=dapi_box)
+        with telemetry.stage("normalise"):
+            lut = dapi.normalisation_lut(lwcy5_wb, upcy5_wb, wsiStain.dtype) # clip/scale/cast precomputed per input value
+            wsiStain = dapi.apply_lut(wsiStain, lut) # single gather straight to uint8, no float64 temporaries
+        print(wsiStain.shape)
+        if scale != 1.0:
+            print(f"Rescaling DAPI by {scale:.4f}x")
+            import skimage as ski # in-memory path only: not loaded by streamed runs
+            with telemetry.stage("rescale"):
+                wsiStain = ski.transform.rescale(wsiStain, scale, anti_aliasing=True, preserve_range=True)
+            print("Rescaled DAPI shape:", wsiStain.shape)
+        if wsiStain.dtype != np.uint8:
+            wsiStain = wsiStain.astype(np.uint8)
+        export.save_array(wsiStain, out_path, s["export"])
+    return wsiStain, tissue.crop_record(dapi_path, level, tif.series[0].levels[level].shape, dapi_box, scale)
+
+
+def export_channels(tif, dapi_path, dapi_out, outputs, level, scale, s):
+    """
+    Write the DAPI and the multiplex ``outputs`` ({path: channel index, None = OME-TIFF})
+    from one read of the OME-TIFF; returns the crop record shared by all of them.
+    """
+    dapi_idx = dapi_channel(tif, s)
+    with telemetry.stage("tissue box"):
+        dapi_box = tissue.dapi_tissue_box(tif, dapi_idx) if s["crop_to_tissue"] else tissue.FULL_BOX
+    ome_path = next((path for path, c in outputs.items() if c is None), None)
+    channel_paths = {dapi_idx: dapi_out, **{c: path for path, c in outputs.items() if c is not None}}
+    limits = channels.write_channels(tif, level, selected_channels(tif, s), ome_path=ome_path,
+                                     channel_paths=channel_paths, percentiles=PERCENTILES,
+                                     percentile_level=s["percentile_level"], scale=scale,
+                                     tile_budget=s["tile_budget"], box=dapi_box, options=s["export"])
+    for c, (lo, hi) in limits.items():
+        print(f"channel {c}: clip limits {lo:g} - {hi:g}")
+    return tissue.crop_record(dapi_path, level, tif.series[0].levels[level].shape, dapi_box, scale)
+
+
+def export_hne(hne_file_path, out_path, level, scale, s, source=None):
+    """
+    Build and write the H&E pseudo-DAPI pyramid; returns (uint8 array or None if
+    streamed, crop record). ``source`` is recorded instead of ``hne_file_path`` (staged copy).
+    """
+    with telemetry.stage("tissue box"):
+        hne_box = tissue.hne_tissue_box(hne_file_path) if s["crop_to_tissue"] else tissue.FULL_BOX
+    if s["stream_hne"]: # pseudo-DAPI computed tile by tile while the pyramid is written
+        width_h, height_h = hne.write_pseudo_dapi(hne_file_path, out_path, level, scale, box=hne_box, options=s["export"])
+        print((height_h, width_h))
+        cropped_region = None
+    else:
+        import openslide # in-memory path only: streamed runs read the slide through libvips
+        import skimage as ski
+        with telemetry.stage("open"):
+            wsi_hne = openslide.OpenSlide(hne_file_path)  # Load HnE image
+        y0, x0, y1, x1 = tissue.box_pixels(hne_box, wsi_hne.level_dimensions[level][::-1])
+        size = (x1 - x0, y1 - y0) # tissue bounding box only
+        print(size)
+        origin = tissue.box_pixels(hne_box, wsi_hne.level_dimensions[0][::-1])[1::-1] # read_region takes level-0 (x, y)
+        with telemetry.stage("read"):
+            region_img = wsi_hne.read_region(origin, level, size)
+            rgba_array = np.array(region_img)
+        # Create a pseudo-DAPI from HnE as an inverted grayscale image using a weighted combination of red and blue channels
+        # (fixed-point kernel: weighting, min/max normalise, invert and alpha mask fused per tile, no float64 copies)
+        with telemetry.stage("pseudo-dapi"):
+            purple_intensity = hne.pseudo_dapi_array(rgba_array)
+        wsi_hne.close()
+        del region_img, rgba_array
+        # Aperio rotates 90degrees compared to COMET data: rotated by libvips while writing (no numpy copy)
+        with telemetry.stage("rescale"):
+            if scale != 1.0:
+                region_out = ski.transform.rescale(purple_intensity, scale)
+                cropped_region = 255*(region_out-np.min(region_out))/(np.max(region_out)-np.min(region_out)) # Output normalised pseudo-DAPI from HnE
+                cropped_region = cropped_region.astype(np.uint8)
+                del region_out
+            else: # same stretch through a 256-entry LUT, no float64 copies
+                cropped_region = hne.stretch_uint8(purple_intensity)
+        del purple_intensity
+        print(cropped_region.shape[::-1])
+        export.save_array(cropped_region, out_path, s["export"], rotation=90)
+        cropped_region = np.rot90(cropped_region) # view, for napari
+    return cropped_region, tissue.crop_record(source or hne_file_path, level, hne.level_shape(hne_file_path, level), hne_box, scale, rotation=90)
+
+
+def shared_hne(store, key, hne_file_path, level, scale, s, stage_input=None):
+    """
+    H&E pseudo-DAPI of ``hne_file_path`` in the shared ``store`` under ``key``, built
+    unless already there; returns (uint8 array or None, crop record). ``stage_input``
+    maps the slide path to the file to read (prep.staging).
+    """
+    if store.has(key): # already built for this slide and settings (e.g. by the COMET or Ultivue run)
+        print(f"Reusing H&E pseudo-DAPI {store.path(key)}")
+        return None, store.metadata(key)
+    local = stage_input(hne_file_path) if stage_input is not None else hne_file_path
+    with cache.atomic_output(store.path(key)) as partial:
+        cropped_region, record = export_hne(local, partial, level, scale, s, source=hne_file_path)
+    store.put_metadata(key, record)
+    return cropped_region, record
+
+
+def sample_keys(modality, config, s):
+    """``{output name: fingerprint}`` of all outputs of a sample with an "ok" ``config``."""
+    names = MODALITIES[modality]
+    dapi_path, hne_path = config["dapi_path"], config["hne_path"]
+    with tff.TiffFile(dapi_path) as tif:
+        keys = dapi_keys(tif, modality, dapi_path, config["dapi_level"], config["dapi_scale"], s)
+    keys[names["hne_name"]] = hne_fingerprint(hne_path, config["hne_level"], config["hne_scale"], s)
+    return keys
+
+
+def outputs_current(row, modality, save_ome, settings=None, config=None):
+    """True if all outputs of ``row`` exist under ``save_ome`` and match its inputs and settings."""
+    s = make_settings(**(settings or {}))
+    config = config or configure([row], modality, s)[row["MedicalAchiever"]]
+    if config["status"] != "ok":
+        return False
+    out_folder = os.path.join(save_ome, row["MedicalAchiever"])
+    return all(cache.is_current(out_folder, name, key) for name, key in sample_keys(modality, config, s).items())
+
+
+def prepare_sample(row, modality, save_ome, settings=None, keep_arrays=False, times=None, config=None):
+    """
+    Prepare one sample (one row of the master sheet) for co-registration.
+
+    Each output is rebuilt only if it is missing or its inputs / settings
+    changed (prep.cache manifest); files are written via a temporary name and
+    renamed into place. The H&E pseudo-DAPI is built once in the shared store
+    (``hne_cache_dir``) and hard-linked into the sample folder. With the
+    ``concurrent_stages`` setting the DAPI and H&E exports run in parallel
+    threads (prep.pipeline); ``times`` (a ``pipeline.StageTimes``) collects
+    the stage timings. ``config`` is the sample's entry of ``configure``
+    (computed for this row alone if not given). With ``staging_dir`` each
+    input that has to be read is staged first (prep.staging) and released
+    for eviction when the sample is done.
+
+    Returns a dict with ``sample``, ``status`` ("exported" or "skipped"),
+    ``message``, ``timings`` and, with ``keep_arrays`` (in-memory paths only,
+    for napari), the ``dapi`` / ``hne`` uint8 arrays. Errors propagate to the caller.
+    Stage telemetry (and failures) are appended to the ``telemetry`` file.
+    """
+    s = make_settings(**(settings or {}))
+    times = times or pipeline.StageTimes()
+    with telemetry.recording(telemetry_path(save_ome, s), times, s["profile"],
+                             sample=row["MedicalAchiever"], modality=modality) as record:
+        result = _prepare_sample(row, modality, save_ome, s, keep_arrays, times, config)
+        record.update(status=result["status"], message=result["message"])
+    result["timings"] = times.as_dict()
+    return result
+
+
+def _prepare_sample(row, modality, save_ome, s, keep_arrays, times, config):
+    """Body of ``prepare_sample``, with the settings ``s`` resolved."""
+    names = MODALITIES[modality]
+    file_id = row["MedicalAchiever"]
+    result = {"sample": file_id, "status": "skipped", "message": "", "dapi": None, "hne": None, "timings": {}}
+    print(f"Preparing data for co-registration: {file_id}")
+    out_folder = os.path.join(save_ome, file_id)
+    config = config or configure([row], modality, s)[file_id]
+    if config["status"] != "ok":
+        print(f"{config['message']} — skipping.")
+        result["message"] = config["message"]
+        return result
+    result["message"] = config["message"] # a configuration warning, if any
+    dapi_path = config["dapi_path"]
+    hne_file_path = config["hne_path"]
+    dapi_out = os.path.join(out_folder, names["dapi_name"])
+    hne_out = os.path.join(out_folder, names["hne_name"])
+    with times.stage("metadata"):
+        tif = tff.TiffFile(dapi_path)
+        dapi_level, dapi_scale = config["dapi_level"], config["dapi_scale"]
+        hne_level, hne_scale = config["hne_level"], config["hne_scale"]
+        dapi_outputs = dapi_keys(tif, modality, dapi_path, dapi_level, dapi_scale, s)
+        extra_outputs = channel_outputs(tif, modality, s)
+        hne_key = hne_fingerprint(hne_file_path, hne_level, hne_scale, s)
+        dapi_current = all(cache.is_current(out_folder, name, key) for name, key in dapi_outputs.items())
+        hne_current = cache.is_current(out_folder, names["hne_name"], hne_key)
+    if dapi_current and hne_current:
+        print("FILES UP TO DATE")
+        tif.close()
+        result["message"] = "up to date"
+        return result
+    os.makedirs(out_folder, exist_ok=True)
+    cache.sweep_partials(out_folder) # left by a run of this sample killed mid-write
+    record_lock = threading.Lock() # crop.json / manifest.json are read-modify-write
+    stager = staging_cache(s)
+    staged = []
+
+    def stage_input(path):
+        if stager is None:
+            return path
+        with telemetry.stage("staging"): # one sequential copy instead of random reads over NFS
+            local = stager.stage(path)
+        staged.append(local)
+        return local
+
+    def finish(name, key, record):
+        with record_lock:
+            tissue.write_sidecar(out_folder, {name: record})
+            cache.record(out_folder, name, key)
+
+    def dapi_stage():
+        wsiStain = None
+        local = stage_input(dapi_path)
+        with contextlib.ExitStack() as stack:
+            source = tif if local == dapi_path else stack.enter_context(tff.TiffFile(local)) # staged copy
+            if extra_outputs: # DAPI and the other multiplex channels from one read of the OME-TIFF
+                partial = stack.enter_context(cache.atomic_output(dapi_out))
+                outputs = {stack.enter_context(cache.atomic_output(os.path.join(out_folder, name))): c
+                           for name, c in extra_outputs.items()}
+                dapi_record = export_channels(source, dapi_path, partial, outputs, dapi_level, dapi_scale, s)
+            else:
+                partial = stack.enter_context(cache.atomic_output(dapi_out))
+                wsiStain, dapi_record = export_dapi(source, dapi_path, partial, dapi_level, dapi_scale, s)
+        for name, key in dapi_outputs.items():
+            finish(name, key, dapi_record)
+        return wsiStain
+
+    def hne_stage():
+        store = cache.SharedStore(hne_cache_dir(save_ome, s))
+        cropped_region, hne_record = shared_hne(store, hne_key, hne_file_path, hne_level, hne_scale, s, stage_input)
+        cache.link_into(store.path(hne_key), hne_out)
+        finish(names["hne_name"], hne_key, hne_record)
+        return cropped_region
+
+    stages = {} # the decisions are printed here: the stages run in concurrent threads
+    if not dapi_current:
+        print(f"DAPI pyramid level {dapi_level}, residual scale {dapi_scale:.4f}")
+        if extra_outputs:
+            print(f"Exporting channels {selected_channels(tif, s)} -> {sorted(extra_outputs)}")
+        stages["dapi"] = dapi_stage
+    if not hne_current:
+        print(f"H&E pyramid level {hne_level}, residual scale {hne_scale:.4f}")
+        stages["hne"] = hne_stage
+    try: # DAPI and H&E read from different mounts and write separate pyramids: overlap them
+        arrays = pipeline.run_stages(stages, concurrent=s["concurrent_stages"], times=times)
+    finally:
+        tif.close()
+        if stager is not None:
+            stager.release(staged)
+    if keep_arrays:
+        result["dapi"], result["hne"] = arrays.get("dapi"), arrays.get("hne")
+    del arrays
+    gc.collect()
+    print('Saved DAPI/DAPI-like files')
+    print(times.summary())
+    print('----')
+    result["status"] = "exported"
+    return result
+
+
+def prepare_samples(rows, modality, save_ome, settings=None, keep_arrays=False):
+    """
+    ``prepare_sample`` over ``rows`` in order, yielding each result.
+
+    All rows are configured and checked before the first sample starts
+    (``configure``; raises ValueError with ``fail_fast``). While a sample is
+    processed, the next sample's DAPI and H&E files are read into the page
+    cache in the background (``prefetch_bytes`` per file, 0 to disable), or
+    with ``staging_dir`` staged to node-local disk unless its outputs are
+    already current (whatever ``prefetch_bytes``); a staging copy still running
+    when its sample starts is waited for, not restarted. The prefetch shows up
+    in the current sample's timings.
+    A per-stage telemetry summary of the exported samples is printed at the end.
+    """
+    s = make_settings(**(settings or {}))
+    names = MODALITIES[modality]
+    rows = list(rows)
+    configs = configure(rows, modality, s)
+    stager = staging_cache(s)
+    prefetcher = pipeline.Prefetcher(s["prefetch_bytes"], stage=None if stager is None else stager.prefetch)
+    exported = []
+    try:
+        for i, row in enumerate(rows):
+            times = pipeline.StageTimes()
+            following = rows[i + 1] if i + 1 < len(rows) else None
+            if stager is not None and following is not None: # a copy is costly: only for samples that will run
+                config = configs[following["MedicalAchiever"]]
+                if config["status"] != "ok" or outputs_current(following, modality, save_ome, s, config):
+                    following = None
+            if following is not None:
+                prefetcher.start([following[names["dapi_column"]], following["H&E_path"]], times,
+                                 label=f"prefetch {following['MedicalAchiever']}")
+            result = prepare_sample(row, modality, save_ome, s, keep_arrays, times, configs[row["MedicalAchiever"]])
+            if result["status"] == "exported":
+                exported.append({"stages": result["timings"]})
+            yield result
+    finally:
+        prefetcher.cancel()
+    print(telemetry.format_summary(exported))
+
+
+def prepare_hne(rows, save_ome, settings=None):
+    """
+    Build the H&E pseudo-DAPIs of ``rows`` in the shared store only (``hne_cache_dir``),
+    one per distinct slide, for the COMET and Ultivue runs to link in; yields
+    ``{"sample": slide path, "status", "message", "timings"}`` per slide.
+    """
+    s = make_settings(**(settings or {}))
+    configs = autoconfig.configure_slides([row["H&E_path"] for row in rows], s, index_path=s["catalog_index"])
+    store = cache.SharedStore(hne_cache_dir(save_ome, s))
+    stager = staging_cache(s)
+    exported = []
+    for path, config in configs.items():
+        result = {"sample": path, "status": "skipped", "message": config["message"], "timings": {}}
+        if config["status"] != "ok":
+            yield result
+            continue
+        key = hne_fingerprint(path, config["hne_level"], config["hne_scale"], s)
+        if store.has(key):
+            result["message"] = "up to date"
+            yield result
+            continue
+        print(f"H&E pseudo-DAPI: {path}, pyramid level {config['hne_level']}, residual scale {config['hne_scale']:.4f}")
+        times = pipeline.StageTimes()
+        staged = []
+
+        def stage_input(path):
+            with telemetry.stage("staging"):
+                local = stager.stage(path)
+            staged.append(local)
+            return local
+
+        try:
+            with telemetry.recording(telemetry_path(save_ome, s), times, s["profile"],
+                                     sample=os.path.basename(path), modality="hne"), times.stage("hne"):
+                shared_hne(store, key, path, config["hne_level"], config["hne_scale"], s,
+                           None if stager is None else stage_input)
+        finally:
+            if stager is not None:
+                stager.release(staged)
+        print(times.summary())
+        result.update(status="exported", timings=times.as_dict())
+        exported.append({"stages": result["timings"]})
+        yield result
+    print(telemetry.format_summary(exported))
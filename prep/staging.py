@@ -0,0 +1,314 @@
+"""
+Node-local staging of NAS-resident input slides, with LRU eviction under a disk quota.
+
+Purpose
+-------
+Inputs are read straight from /mnt/nas-data and /mnt/scratchc. Random tile
+access through tifffile / Zarr and OpenSlide over a network filesystem is far
+slower than one sequential copy, and the same H&E is read by both comet.py
+and ultivue.py. ``StagingCache.stage(path)``:
+
+- copies the file to a node-local directory (default ``$TMPDIR``) with large
+  sequential reads, hashing it on the way;
+- verifies the copy (size, and the checksum re-read from local disk) before
+  renaming it into place, and records the source size / mtime / checksum next
+  to it, so a later ``stage`` of an unchanged file is a lookup;
+- evicts the least recently used staged files to stay under ``quota`` bytes;
+  files staged for the sample in progress are pinned until ``release``;
+- returns the local path, or the source path if the file cannot be staged
+  (larger than the quota, disk full, ...): staging is an optimisation only.
+
+prep.sample uses it when the ``staging_dir`` setting is set, and
+``prepare_samples`` stages the next sample's files in the background
+(prep.pipeline.Prefetcher).
+
+Notes
+-----
+- Several processes (prep.batch workers, array tasks on one node) may share
+  one staging directory; eviction and bookkeeping are serialised with a lock
+  file. Pins and copies in progress are kept on disk next to the staged file
+  (``<local>.pin.<pid>``, ``<local>.copying.<pid>.<thread>`` holding the size),
+  so no process evicts a file another has pinned and the quota counts every
+  copy in progress. Markers (and partial copies) of dead processes are swept
+  when room is made.
+- Cache keys and crop records keep referring to the source paths.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from prep.cache import file_identity, pid_alive
+
+DEFAULT_QUOTA = 200 * 1024 ** 3
+COPY_CHUNK = 64 * 1024 ** 2     # bytes per sequential read / write
+STAGING_SUBDIR = "spatial-prep-staging"
+_META_SUFFIX = ".staged.json"
+_PIN = ".pin."              # <local>.pin.<pid>: <local> is in use by that process
+_COPYING = ".copying."      # <local>.copying.<pid>.<thread>: that many bytes being copied to <local>
+_PARTIAL = ".partial"       # <local>.<pid>.<thread>.partial: the copy itself
+
+
+def default_root():
+    """``$TMPDIR/spatial-prep-staging`` (node-local scratch on SLURM), else the system temp dir."""
+    return os.path.join(os.environ.get("TMPDIR") or tempfile.gettempdir(), STAGING_SUBDIR)
+
+
+def _digest():
+    return hashlib.blake2b(digest_size=16)
+
+
+def file_checksum(path, chunk=COPY_CHUNK):
+    """BLAKE2b checksum of ``path``, read sequentially."""
+    digest = _digest()
+    with open(path, "rb", buffering=0) as fh:
+        for block in iter(lambda: fh.read(chunk), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def copy_with_checksum(src, dst, cancel=None, chunk=COPY_CHUNK):
+    """
+    Copy ``src`` to ``dst`` with sequential ``chunk``-sized reads, hashing the data.
+
+    Returns ``(bytes copied, checksum)``, or None if ``cancel`` (a threading.Event) was set.
+    """
+    digest = _digest()
+    copied = 0
+    buffer = bytearray(chunk)
+    view = memoryview(buffer)
+    with open(src, "rb", buffering=0) as fin, open(dst, "wb", buffering=0) as fout:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fin.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            if cancel is not None and cancel.is_set():
+                return None
+            n = fin.readinto(buffer)
+            if not n:
+                break
+            digest.update(view[:n])
+            fout.write(view[:n])
+            copied += n
+    return copied, digest.hexdigest()
+
+
+class StagingCache:
+    """
+    LRU cache of local copies of input files under ``root``, at most ``quota`` bytes.
+
+    ``stage(path)`` returns a local copy (pinned until ``release``); with
+    ``verify`` each new copy is re-read and its checksum compared.
+    """
+
+    def __init__(self, root=None, quota=DEFAULT_QUOTA, verify=True):
+        self.root = os.path.abspath(root or default_root())
+        self.quota = int(quota)
+        self.verify = verify
+        self._pinned = {}               # local path -> pin count in this process (on disk: one pin file)
+        self._done = {}                 # local path -> Event set when this process's copy finishes
+        self._thread_lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def local_path(self, path):
+        """Where ``path`` is staged (one slot per source path)."""
+        key = hashlib.sha1(os.path.realpath(path).encode()).hexdigest()[:16]
+        return os.path.join(self.root, f"{key}-{os.path.basename(path)}")
+
+    @contextlib.contextmanager
+    def _lock(self):
+        with self._thread_lock, open(os.path.join(self.root, ".lock"), "a") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def _read_meta(self, local):
+        try:
+            with open(local + _META_SUFFIX) as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+    def _current(self, local, identity):
+        meta = self._read_meta(local)
+        if meta is None or not os.path.exists(local):
+            return False
+        return (meta["size"], meta["mtime_ns"]) == (identity["size"], identity["mtime_ns"]) \
+            and os.path.getsize(local) == identity["size"]
+
+    def _touch(self, local):
+        os.utime(local + _META_SUFFIX)     # the sidecar's mtime is the last use
+
+    def entries(self):
+        """``[(last used, size, local path)]`` of the staged files, least recently used first."""
+        entries = []
+        for name in os.listdir(self.root):
+            if not name.endswith(_META_SUFFIX):
+                continue
+            local = os.path.join(self.root, name[:-len(_META_SUFFIX)])
+            try:
+                entries.append((os.path.getmtime(local + _META_SUFFIX), os.path.getsize(local), local))
+            except OSError:
+                continue
+        return sorted(entries)
+
+    def _remove(self, local):
+        for path in (local + _META_SUFFIX, local):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+    def _holders(self):
+        """
+        ``(pinned local paths, bytes being copied)`` of every live process, from
+        the markers on disk; markers and partial copies of dead processes are removed.
+        """
+        pinned, copying = set(), 0
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if _PIN in name:
+                local, pid = name.rsplit(_PIN, 1)
+            elif _COPYING in name:
+                local, owner = name.rsplit(_COPYING, 1)
+                pid = owner.split(".")[0]
+            elif name.endswith(_PARTIAL):
+                pid = name[:-len(_PARTIAL)].split(".")[-2]
+            else:
+                continue
+            if not pid.isdigit() or not pid_alive(int(pid)):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+            elif _PIN in name:
+                pinned.add(os.path.join(self.root, local))
+            elif _COPYING in name:
+                with contextlib.suppress(OSError, ValueError), open(path) as fh:
+                    copying += int(fh.read())
+        return pinned, copying
+
+    def _make_room(self, size):
+        """
+        Evict files no live process has pinned, least recently used first, until
+        ``size`` more bytes fit next to every copy in progress; False if they cannot.
+        """
+        entries = self.entries()
+        pinned, copying = self._holders()
+        used = sum(entry[1] for entry in entries) + copying
+        for _, entry_size, local in entries:
+            if used + size <= self.quota:
+                break
+            if local in pinned:
+                continue
+            self._remove(local)
+            used -= entry_size
+        return used + size <= self.quota
+
+    def _pinned_elsewhere(self, local):
+        """Whether another live process holds a pin on ``local``."""
+        prefix = os.path.basename(local) + _PIN
+        for name in os.listdir(self.root):
+            if name.startswith(prefix):
+                pid = name[len(prefix):]
+                if pid.isdigit() and int(pid) != os.getpid() and pid_alive(int(pid)):
+                    return True
+        return False
+
+    def _pin(self, local):
+        """Pin ``local`` for this process (call with the lock held)."""
+        self._pinned[local] = self._pinned.get(local, 0) + 1
+        if self._pinned[local] == 1:
+            open(f"{local}{_PIN}{os.getpid()}", "w").close()
+
+    def stage(self, path, cancel=None):
+        """Local copy of ``path`` (staged now if needed, pinned), or ``path`` itself if it cannot be staged."""
+        identity = file_identity(path)
+        local = self.local_path(path)
+        while True:
+            with self._lock():
+                if self._current(local, identity):
+                    self._touch(local)
+                    self._pin(local)
+                    return local
+                done = self._done.get(local)
+                if done is None: # not being copied by another thread of this process: copy it here
+                    if os.path.exists(local) and self._pinned_elsewhere(local):
+                        return path # an outdated copy another process still reads: leave it in place
+                    self._remove(local)
+                    if not self._make_room(identity["size"]):
+                        print(f"Not staging {path}: {identity['size'] / 1024 ** 3:.1f} GiB does not fit the "
+                              f"{self.quota / 1024 ** 3:.1f} GiB staging quota")
+                        return path
+                    copying = f"{local}{_COPYING}{os.getpid()}.{threading.get_ident()}"
+                    with open(copying, "w") as fh:
+                        fh.write(str(identity["size"]))
+                    self._done[local] = threading.Event()
+                    self._pin(local)
+                    break
+            done.wait() # e.g. the prefetch of this sample still running
+            if cancel is not None and cancel.is_set():
+                return path
+        partial = f"{local}.{os.getpid()}.{threading.get_ident()}{_PARTIAL}"
+        try:
+            start = time.perf_counter()
+            copied = copy_with_checksum(path, partial, cancel)
+            if copied is None:
+                self._unpin(local)
+                return path
+            size, checksum = copied
+            if size != identity["size"] or (self.verify and file_checksum(partial) != checksum):
+                raise OSError(f"staged copy of {path} does not match the source")
+            with self._lock():
+                os.replace(partial, local)
+                with open(local + _META_SUFFIX, "w") as fh:
+                    json.dump({**identity, "checksum": checksum, "staged_at": time.time()}, fh)
+            seconds = time.perf_counter() - start
+            print(f"Staged {path} ({size / 1024 ** 3:.2f} GiB, {size / 1024 ** 2 / max(seconds, 1e-6):.0f} MiB/s)")
+            return local
+        except OSError as exc:
+            print(f"Not staging {path}: {exc}")
+            self._unpin(local)
+            return path
+        finally:
+            with self._lock():
+                for leftover in (partial, copying):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(leftover)
+                self._done.pop(local).set()
+
+    def _unpin(self, local):
+        with self._lock():
+            count = self._pinned.get(local, 0) - 1
+            if count > 0:
+                self._pinned[local] = count
+                return
+            self._pinned.pop(local, None)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(f"{local}{_PIN}{os.getpid()}")
+
+    def prefetch(self, path, cancel=None):
+        """Stage ``path`` without pinning it (background staging of the next sample)."""
+        local = self.stage(path, cancel)
+        self.release([local])
+        return local
+
+    def release(self, paths):
+        """Unpin ``paths`` returned by ``stage`` so they can be evicted (source paths are ignored)."""
+        for path in paths:
+            if os.path.dirname(path) == self.root:
+                self._unpin(path)
+
+
+_CACHES = {}
+
+
+def cache_for(root, quota=DEFAULT_QUOTA, verify=True):
+    """The process-wide ``StagingCache`` of ``root`` ("auto" = ``default_root()``)."""
+    root = default_root() if root == "auto" else root
+    key = (os.path.abspath(root), int(quota), bool(verify))
+    if key not in _CACHES:
+        _CACHES[key] = StagingCache(root, quota, verify)
+    return _CACHES[key]
@@ -0,0 +1,291 @@
+"""
+Per-stage resource telemetry of the prep pipeline, as JSON lines.
+
+Purpose
+-------
+A run used to leave nothing but ad-hoc prints of shapes and "Saved
+DAPI/DAPI-like files", so a sample that took 3 hours or was OOM-killed at
+258G gave no hint of which stage was responsible. Stages are timed with
+``prep.pipeline.StageTimes``; for each stage this module adds:
+
+- wall and CPU seconds (CPU of the whole process, libvips threads included);
+- the growth of the process peak RSS during the stage, and that peak;
+- bytes read and written (``/proc/self/io`` rchar / wchar: NFS, local disk
+  and page cache alike).
+
+The kernels mark their inner stages with ``telemetry.stage(name)`` (open,
+read, percentiles, normalise, pseudo-dapi, rescale, tiffsave, ...). They nest
+under the stage running in that thread ("dapi/percentiles/read") and
+accumulate over repeated calls (one call per band: ``calls``, total seconds),
+and cost nothing outside a timed stage.
+
+``JsonLines(path, **context)`` appends one line per event: "start" the first
+time a stage starts (the last one of a killed sample names the stage it died
+in), "stage" when a top-level stage ends and "sample" with every stage when
+the sample ends. ``summarise`` aggregates sample records per stage;
+prep.sample.prepare_samples and prep.batch print it at the end of a run.
+
+Profiling (``profile`` setting):
+- "py-spy": threads are renamed after the stage they run, so ``py-spy dump
+  --pid <pid>`` / ``py-spy record`` show the stage next to every stack;
+- "tracemalloc": Python / numpy allocations are traced; stages record the
+  traced peak so far and the sample record lists the top allocation sites.
+
+Usage
+-----
+python -m prep.telemetry <save_ome>/prep_telemetry.jsonl
+
+Notes
+-----
+- CPU time, RSS and I/O counters are per process: with concurrent stages (DAPI
+  and H&E in parallel) their numbers overlap, wall times do not.
+- libvips runs the H&E read, pseudo-DAPI, rescale / rotation and the pyramid
+  write as one lazy pipeline: that time is all accounted to "tiffsave".
+"""
+
+import argparse
+import collections
+import contextlib
+import json
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+
+PROFILES = (None, "py-spy", "tracemalloc")
+TOP_ALLOCATIONS = 15            # allocation sites listed per sample with profile="tracemalloc"
+TELEMETRY_NAME = "prep_telemetry.jsonl"
+
+Snapshot = collections.namedtuple("Snapshot", "wall cpu peak_rss read written traced_peak")
+
+_local = threading.local()
+_profile = None
+_RSS_UNIT = 1 if sys.platform == "darwin" else 1024     # ru_maxrss: bytes on macOS, KiB on Linux
+
+
+def _proc_io():
+    try:
+        with open("/proc/self/io") as fh:
+            fields = dict(line.split(":") for line in fh)
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def snapshot():
+    """Process counters now: wall / CPU seconds, peak RSS, bytes read / written, traced peak."""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    read, written = _proc_io()
+    traced = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+    return Snapshot(time.perf_counter(), usage.ru_utime + usage.ru_stime, usage.ru_maxrss * _RSS_UNIT,
+                    read, written, traced)
+
+
+def usage(begin, end):
+    """Resource use between two snapshots."""
+    used = {"seconds": end.wall - begin.wall, "cpu_seconds": end.cpu - begin.cpu,
+            "peak_rss_delta_bytes": end.peak_rss - begin.peak_rss, "peak_rss_bytes": end.peak_rss,
+            "read_bytes": end.read - begin.read, "written_bytes": end.written - begin.written}
+    if end.traced_peak is not None:
+        used["traced_peak_bytes"] = end.traced_peak
+    return used
+
+
+def new_entry(start):
+    """Empty accumulated record of a stage first started at ``start`` seconds."""
+    return {"start": start, "end": None, "calls": 0, "seconds": 0.0, "cpu_seconds": 0.0,
+            "peak_rss_delta_bytes": 0, "peak_rss_bytes": 0, "read_bytes": 0, "written_bytes": 0}
+
+
+def accumulate(entry, used, end):
+    """Add one call's ``used`` resources, ending at ``end`` seconds, to a stage ``entry``."""
+    entry["end"] = end
+    entry["calls"] += 1
+    for key in ("seconds", "cpu_seconds", "read_bytes", "written_bytes"):
+        entry[key] += used[key]
+    for key in ("peak_rss_delta_bytes", "peak_rss_bytes", "traced_peak_bytes"):
+        if key in used:
+            entry[key] = max(entry.get(key, 0), used[key])
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def qualified(times, name):
+    """``name`` nested under the stage of ``times`` running in this thread, if any."""
+    stack = _stack()
+    if stack and stack[-1][0] is times:
+        return f"{stack[-1][1]}/{name}"
+    return name
+
+
+@contextlib.contextmanager
+def active(times, name):
+    """Make ``name`` of ``times`` the current stage of this thread (renamed after it with profile="py-spy")."""
+    thread = threading.current_thread()
+    thread_name = thread.name
+    _stack().append((times, name))
+    if _profile == "py-spy":
+        thread.name = f"{thread_name} [{name}]"
+    try:
+        yield
+    finally:
+        _stack().pop()
+        thread.name = thread_name
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Time ``name`` as an inner stage of the stage running in this thread (no-op outside one)."""
+    stack = _stack()
+    if not stack:
+        yield
+        return
+    with stack[-1][0].stage(name):
+        yield
+
+
+class JsonLines:
+    """Append events as JSON lines to ``path``, each with ``context`` and a timestamp (one write per line)."""
+
+    def __init__(self, path, **context):
+        self.path = path
+        self.context = context
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def __call__(self, event):
+        line = json.dumps({"time": round(time.time(), 3), **self.context, **event}, default=str) + "\n"
+        with self._lock:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode())
+            finally:
+                os.close(fd)
+
+
+def top_allocations(limit=TOP_ALLOCATIONS):
+    """The ``limit`` largest traced allocation sites, as strings."""
+    stats = tracemalloc.take_snapshot().statistics("lineno")[:limit]
+    return [f"{stat.size / 1024 ** 2:.1f} MiB in {stat.count} block(s): {stat.traceback[0]}" for stat in stats]
+
+
+@contextlib.contextmanager
+def recording(path, times, profile=None, **context):
+    """
+    Record the stages of ``times`` (a ``pipeline.StageTimes``) for one sample.
+
+    Events go to ``path`` (None: not written) with ``context`` (sample,
+    modality, ...) plus host, pid and an attempt id. Yields the dict that
+    becomes the final "sample" event: callers set ``status`` / ``message``;
+    an exception records status "failed" and propagates.
+    """
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown profile {profile!r}, expected one of {PROFILES}")
+    global _profile
+    _profile = profile
+    if path is not None:
+        times.sink = JsonLines(path, attempt=uuid.uuid4().hex[:12], host=socket.gethostname(), pid=os.getpid(),
+                               **context)
+    if profile == "tracemalloc":
+        tracemalloc.start()
+    begin = snapshot()
+    record = {"status": "exported", "message": ""}
+    try:
+        yield record
+    except BaseException as exc:
+        record.update(status="failed", message=f"{type(exc).__name__}: {exc}")
+        raise
+    finally:
+        record.update(usage(begin, snapshot()))
+        record["stages"] = times.as_dict()
+        if profile == "tracemalloc":
+            record["top_allocations"] = top_allocations()
+            tracemalloc.stop()
+        if times.sink is not None:
+            times.sink({"event": "sample", **record})
+        _profile = None
+
+
+def summarise(records):
+    """
+    Per-stage totals over sample records (``{"stages": StageTimes.as_dict()}``):
+    samples, calls, total / mean / max seconds, CPU seconds, largest peak RSS
+    and its growth, GiB read and written.
+    """
+    import pandas as pd # summaries only: kept out of the import of every stage
+    rows = []
+    for record in records:
+        for name, entry in (record.get("stages") or {}).items():
+            if entry.get("seconds") is not None:
+                rows.append({"stage": name, **entry})
+    if not rows:
+        return pd.DataFrame(columns=["stage"])
+    frame = pd.DataFrame(rows)
+    gib = 1024 ** 3
+    table = frame.groupby("stage").agg(
+        samples=("seconds", "size"), calls=("calls", "sum"), seconds=("seconds", "sum"),
+        mean_seconds=("seconds", "mean"), max_seconds=("seconds", "max"), cpu_seconds=("cpu_seconds", "sum"),
+        peak_rss_gb=("peak_rss_bytes", "max"), peak_rss_delta_gb=("peak_rss_delta_bytes", "max"),
+        read_gb=("read_bytes", "sum"), written_gb=("written_bytes", "sum"))
+    for column in ("peak_rss_gb", "peak_rss_delta_gb", "read_gb", "written_gb"):
+        table[column] = table[column] / gib
+    return table.sort_values("seconds", ascending=False).round(2).reset_index()
+
+
+def format_summary(records):
+    """``summarise`` as a printable table."""
+    table = summarise(records)
+    if table.empty:
+        return "No stage telemetry recorded"
+    return f"Stage telemetry over {len(records)} sample(s):\n" + table.to_string(index=False)
+
+
+def read_events(path):
+    """All events of a telemetry file (unparseable lines, e.g. cut by a kill, are skipped)."""
+    events = []
+    with open(path) as fh:
+        for line in fh:
+            with contextlib.suppress(ValueError):
+                events.append(json.loads(line))
+    return events
+
+
+def unfinished(events):
+    """``[(sample, host, pid, last stage started)]`` of attempts that never wrote their "sample" event."""
+    started, finished = {}, set()
+    for event in events:
+        attempt = event.get("attempt")
+        if event.get("event") == "sample":
+            finished.add(attempt)
+        elif event.get("event") == "start":
+            started[attempt] = (event.get("sample"), event.get("host"), event.get("pid"), event.get("stage"))
+    return [info for attempt, info in started.items() if attempt not in finished]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help=f"telemetry file (default name {TELEMETRY_NAME} in the output folder)")
+    parser.add_argument("--sample", default=None, help="only this sample")
+    args = parser.parse_args()
+
+    events = read_events(args.path)
+    if args.sample is not None:
+        events = [event for event in events if event.get("sample") == args.sample]
+    records = [event for event in events if event.get("event") == "sample"]
+    print(format_summary(records))
+    for status, count in collections.Counter(record["status"] for record in records).items():
+        print(f"{status}: {count}")
+    for sample, host, pid, name in unfinished(events):
+        print(f"Unfinished (killed?): {sample} on {host} pid {pid}, last stage started: {name}")
+
+
+if __name__ == "__main__":
+    main()
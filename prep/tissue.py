@@ -0,0 +1,117 @@
+"""
+Tissue bounding-box detection on a low pyramid level.
+
+Purpose
+-------
+COMET, Ultivue and H&E whole-slide images are mostly empty glass, yet every
+stage of comet.py / ultivue.py used to process and write the full canvas. The
+helpers here find the tissue on the coarsest pyramid level (Gaussian blur ->
+Otsu threshold -> morphological closing -> small-object removal), take a
+padded bounding box around it and map it onto whichever level is exported,
+so reading, normalisation and pyramid export can be restricted to it.
+
+Boxes are kept as fractions of the slide, ``(top, left, bottom, right)`` in
+[0, 1], so one detection serves every pyramid level; ``box_pixels`` converts
+them to ``(y0, x0, y1, x1)`` pixel bounds for a given level shape.
+
+Notes
+-----
+- ``write_sidecar`` records, per exported file, the source level, its shape,
+  the pixel crop box and the residual scale (plus rotation for H&E), so that
+  registration results can be mapped back to the original frame:
+  original (x, y) = (x0, y0) + exported (x, y) / scale  (before rotation).
+- If no tissue is found the full slide is used.
+"""
+
+import os
+
+import numpy as np
+import pyvips
+
+from prep.cache import read_json, write_json
+from prep.dapi import open_level
+
+FULL_BOX = (0.0, 0.0, 1.0, 1.0)
+DEFAULT_PAD = 0.02              # padding on each side, as a fraction of the slide size
+CLOSING_FRACTION = 0.01         # closing radius, as a fraction of the detection image size
+MIN_OBJECT_FRACTION = 0.0005    # drop components smaller than this fraction of the image
+
+
+def tissue_mask(image, tissue_is_bright=True):
+    """Boolean tissue mask of a small grey image via blur, Otsu and morphology."""
+    import skimage as ski # imported on first use: scipy / skimage add ~0.5 s to every process start
+    from scipy import ndimage
+    image = ski.filters.gaussian(image.astype(np.float32), sigma=2, preserve_range=True)
+    if np.ptp(image) == 0:
+        return np.zeros(image.shape, dtype=bool)
+    threshold = ski.filters.threshold_otsu(image)
+    mask = image > threshold if tissue_is_bright else image < threshold
+    radius = max(1, int(CLOSING_FRACTION * max(mask.shape)))
+    mask = ndimage.binary_closing(mask, structure=ski.morphology.disk(radius))
+    labels, _ = ndimage.label(mask)
+    sizes = np.bincount(labels.ravel())
+    keep = sizes >= max(1, int(MIN_OBJECT_FRACTION * mask.size))
+    keep[0] = False     # label 0 is background
+    return keep[labels]
+
+
+def mask_box(mask, pad=DEFAULT_PAD):
+    """Padded fractional ``(top, left, bottom, right)`` box around ``mask`` (FULL_BOX if empty)."""
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if rows.size == 0:
+        return FULL_BOX
+    height, width = mask.shape
+    return (max(0.0, float(rows[0] / height - pad)),
+            max(0.0, float(cols[0] / width - pad)),
+            min(1.0, float((rows[-1] + 1) / height + pad)),
+            min(1.0, float((cols[-1] + 1) / width + pad)))
+
+
+def box_pixels(box, shape):
+    """Pixel bounds ``(y0, x0, y1, x1)`` of a fractional box on a level of ``shape`` (.., Y, X)."""
+    height, width = shape[-2:]
+    top, left, bottom, right = box
+    return (int(np.floor(top * height)), int(np.floor(left * width)),
+            int(np.ceil(bottom * height)), int(np.ceil(right * width)))
+
+
+def dapi_tissue_box(tif, channel=0, pad=DEFAULT_PAD):
+    """Fractional tissue box of an OME-TIFF, detected on its coarsest pyramid level."""
+    plane = open_level(tif, len(tif.series[0].levels) - 1)
+    image = np.asarray(plane[int(channel)] if plane.ndim == 3 else plane[:])
+    return mask_box(tissue_mask(image, tissue_is_bright=True), pad)
+
+
+def hne_tissue_box(hne_path, pad=DEFAULT_PAD):
+    """Fractional tissue box of a whole-slide H&E, detected on its coarsest level."""
+    level_count = int(pyvips.Image.openslideload(hne_path).get("openslide.level-count"))
+    rgba = pyvips.Image.openslideload(hne_path, level=level_count - 1).numpy()
+    grey = rgba[..., :3].mean(axis=2)
+    mask = tissue_mask(grey, tissue_is_bright=False) & (rgba[..., 3] > 0)
+    return mask_box(mask, pad)
+
+
+def crop_record(source, level, level_shape, box, scale=1.0, rotation=0):
+    """Sidecar record for one exported file (``box`` fractional, stored as level pixels)."""
+    return {
+        "source": str(source),
+        "level": int(level),
+        "level_shape": [int(n) for n in level_shape[-2:]],
+        "box": list(box_pixels(box, level_shape)),
+        "scale": float(scale),
+        "rotation": int(rotation),
+    }
+
+
+def write_sidecar(out_folder, entries):
+    """
+    Merge ``entries`` ({output file name: crop record}) into ``<out_folder>/crop.json``.
+
+    A crop record holds ``source``, ``level``, ``level_shape``, ``box`` (pixel
+    y0, x0, y1, x1 on that level), ``scale`` and ``rotation`` (degrees, numpy rot90 sense).
+    """
+    path = os.path.join(out_folder, "crop.json")
+    records = read_json(path)
+    records.update(entries)
+    return write_json(path, records)
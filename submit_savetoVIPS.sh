@@ -5,6 +5,10 @@
 # SLURM batch script to run COMET or Ultivue image preprocessing (`comet.py` or 'ultivue.py') on the cluster.
 # Sets up micromamba environment, applies required libvips/libffi paths, and
 # executes the Python workflow in the napari-env.
+# To fan samples out as SLURM array tasks with per-sample --mem / --time instead:
+#   python -m prep.plan comet --metadata <master sheet> --out-dir slurm_plan --save-ome <save_ome>
+#   bash slurm_plan/submit_comet.sh
+# or, without editing the script's config block: python -m prep comet --metadata <master sheet> --save-ome <save_ome>
 # ------------------------------------------------------------------------------
 #SBATCH --job-name=lay1_job
 #SBATCH --output=lay1.log
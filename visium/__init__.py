@@ -0,0 +1,9 @@
+"""
+Shared helpers for the Visium cell2location notebooks
+(mouse_run_cell2location.ipynb, human_visium_run_cell2location.ipynb).
+
+Modules
+-------
+- loader : parallel, cached loading and QC of Visium samples / h5ads (sparse counts, hires images on demand).
+- concat : out-of-core concatenation of the cached samples into one backed h5ad / zarr store, images by reference.
+"""
@@ -0,0 +1,138 @@
+"""
+Out-of-core concatenation of Visium samples before cell2location training.
+
+Purpose
+-------
+The notebooks merged the ``slides`` list in memory (``slides[0].concatenate(...)``),
+so every sample, with its H&E images in ``uns``, had to fit in RAM at once
+next to the reference signatures: 22 SITS samples in the human notebook.
+``concat_slides`` merges the per-sample files of the local cache
+(``loader.build_cached``) into one h5ad (or zarr) store instead:
+
+- anndata's ``concat_on_disk`` streams ``X`` / layers sample by sample into
+  the store, keeping only the genes present in every sample (``join="inner"``)
+  and the matrices sparse; ``obs`` / ``obsm`` are concatenated alongside;
+- ``uns["spatial"]`` keeps each library's scale factors and metadata, and
+  references its images in ``image_files`` instead of copying them: the image
+  files of the Space Ranger ``outs`` folder, or the image element of the
+  per-sample cache file. ``loader.load_images`` reads them when a plot needs them;
+- the merged store is keyed like the per-sample cache (identity of the sample
+  files and the concatenation parameters), so re-running the cell reuses it.
+
+Peak memory while merging is about one sample (``max_loaded_elems`` bounds the
+matrix chunks); the result is opened backed (h5ad), ``adata.to_memory()`` when
+cell2location needs the counts.
+
+Usage
+-----
+from visium import concat, loader
+paths = loader.build_cached(loader.h5ad_tasks(files, sample_names=samples))
+adata_vis = concat.concat_slides(paths, keys=samples, index_unique="_")
+
+Notes
+-----
+- Image references point into the cache folder: delete a merged store along
+  with the sample files it was built from.
+- anndata reads zarr stores into memory (there is no backed zarr mode): use
+  the default h5ad when the merged matrix should stay on disk.
+- ``concat_on_disk`` copies dense arrays (``obsm["spatial"]``) through dask,
+  which must be installed alongside anndata.
+"""
+
+import os
+
+from prep import cache
+from visium import loader
+
+CONCAT_VERSION = 1
+MAX_LOADED_ELEMS = 100_000_000     # anndata's default: ~1 GB of float64 values per matrix chunk
+
+
+def open_store(path, mode="r"):
+    """h5py file or zarr group of an h5ad / zarr store."""
+    if path.endswith(".zarr"):
+        import zarr
+
+        return zarr.open_group(path, mode=mode)
+    import h5py
+
+    return h5py.File(path, mode)
+
+
+def spatial_reference(store, path):
+    """
+    ``uns["spatial"]`` of a sample store without its image arrays: each
+    library's entries, with the images it holds recorded in ``image_files``
+    as references into the store (``path``) rather than read.
+    """
+    import anndata
+
+    spatial = {}
+    if "uns" not in store or "spatial" not in store["uns"]:
+        return spatial
+    for library_id, group in store["uns"]["spatial"].items():
+        library = {name: anndata.io.read_elem(group[name]) for name in group if name != "images"}
+        image_files = dict(library.get("image_files", {}))
+        for key in group.get("images", {}):
+            image_files.setdefault(key, {"store": os.path.abspath(path),
+                                         "element": f"uns/spatial/{library_id}/images/{key}"})
+        library.update(images={}, image_files=image_files)
+        spatial[library_id] = library
+    return spatial
+
+
+def merged_spatial(paths):
+    """``uns["spatial"]`` of the merged store: the libraries of every sample, by reference."""
+    spatial, owner = {}, {}
+    for path in paths:
+        store = open_store(path)
+        try:
+            libraries = spatial_reference(store, path)
+        finally:
+            if hasattr(store, "close"):
+                store.close()
+        for library_id, library in libraries.items():
+            if library_id in spatial:
+                raise ValueError(f"Library {library_id!r} is in both {owner[library_id]} and {path}")
+            spatial[library_id], owner[library_id] = library, path
+    return spatial
+
+
+def concat_slides(paths, out_file=None, keys=None, label=None, index_unique=None, join="inner",
+                  cache_dir=loader.DEFAULT_CACHE_DIR, fmt="h5ad", max_loaded_elems=MAX_LOADED_ELEMS, backed="r"):
+    """
+    Merge the sample stores ``paths`` (h5ad / zarr) into ``out_file`` (default: a
+    store in ``cache_dir`` keyed by the inputs and parameters) without loading
+    them together; returns the merged AnnData, backed if ``backed`` and h5ad.
+    ``keys`` / ``label`` / ``index_unique`` / ``join`` are those of ``anndata.concat``.
+    """
+    import anndata
+    from anndata.experimental import concat_on_disk
+
+    if fmt not in loader.FORMATS:
+        raise ValueError(f"Unknown store format {fmt!r}, expected one of {loader.FORMATS}")
+    paths = [os.fspath(path) for path in paths]
+    if keys is not None and len(keys) != len(paths):
+        raise ValueError(f"{len(keys)} keys for {len(paths)} samples")
+    if out_file is None:
+        os.makedirs(cache_dir, exist_ok=True)
+        key = cache.fingerprint(paths, {"concat": CONCAT_VERSION, "keys": keys, "label": label,
+                                        "index_unique": index_unique, "join": join})
+        out_file = loader.cache_path(cache_dir, "merged", key, fmt)
+    if os.path.exists(out_file):
+        print(f"Merged samples from the cache: {out_file}")
+    else:
+        spatial = merged_spatial(paths)
+        with loader.atomic_store(out_file) as partial:
+            concat_on_disk(paths, partial, keys=None if keys is None else [str(k) for k in keys], label=label,
+                           index_unique=index_unique, join=join, max_loaded_elems=max_loaded_elems)
+            store = open_store(partial, mode="a")
+            try:
+                if "uns" in store:
+                    del store["uns"]
+                anndata.io.write_elem(store, "uns", {"spatial": spatial})
+            finally:
+                if hasattr(store, "close"):
+                    store.close()
+        print(f"Merged {len(paths)} samples into {out_file}")
+    return loader.read_cached(out_file, backed)
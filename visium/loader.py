@@ -0,0 +1,308 @@
+"""
+Parallel, cached loading and QC of Visium samples for the cell2location notebooks.
+
+Purpose
+-------
+``read_and_qc`` in mouse_run_cell2location.ipynb read every sample with
+``sc.read_visium(..., load_images=True)`` from sftp / gvfs mounts, one after
+the other, on every kernel restart; human_visium_run_cell2location.ipynb read
+each ``*_spe_nnsvg_clusterDE`` h5ad the same way. Here:
+
+- ``load_visium`` / ``load_h5ads`` build the samples in a process pool, one
+  sample per task, and write each QC'd AnnData to a local cache (h5ad, or
+  zarr with ``fmt="zarr"``) keyed by the source files (resolved path, size,
+  mtime), the QC parameters and ``LOADER_VERSION`` (prep/cache.py). A cached
+  sample is read straight from local disk, without touching the mount;
+- count matrices stay sparse (CSR) throughout;
+- only the lowres H&E image is read with the sample: the hires image is read
+  by ``load_images`` when a plot needs it (spot positions and scale factors
+  are always loaded, as ``sc.pl.spatial`` needs them).
+
+Usage
+-----
+from visium import loader
+slides = loader.load_visium([f"OV_{n}" for n in range(1, 7)], sp_data_folder + "seq/runs/")
+loader.load_images(slides[0])     # before sc.pl.spatial(..., img_key="hires")
+
+Notes
+-----
+- Workers write the cache and return its path, so no AnnData is pickled
+  between processes.
+- Bump ``LOADER_VERSION`` when a change here alters the loaded objects.
+- The cache is never evicted; delete old files under ``cache_dir`` by hand.
+"""
+
+import concurrent.futures as cf
+import contextlib
+import json
+import multiprocessing
+import os
+import shutil
+
+from prep import cache
+
+LOADER_VERSION = 2
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "spatial-visium")
+FORMATS = ("h5ad", "zarr")
+EAGER_IMAGES = ("lowres",)      # read with the sample; the others (hires) on demand by load_images
+COUNT_FILE = "filtered_feature_bc_matrix.h5"
+
+
+def default_workers(n_tasks):
+    """One process per sample, at most the CPUs available (SLURM_CPUS_PER_TASK or the affinity mask)."""
+    slurm_cpus = os.environ.get("SLURM_CPUS_PER_TASK")
+    cpus = int(slurm_cpus) if slurm_cpus else len(os.sched_getaffinity(0))
+    return max(1, min(n_tasks, cpus))
+
+
+def outs_dir(sample_name, path):
+    """Space Ranger ``outs`` folder of ``sample_name`` under ``path``."""
+    return os.path.join(path, str(sample_name), "outs")
+
+
+def spatial_files(outs):
+    """Positions, scale factors and image files of a Space Ranger ``outs`` folder (those that exist)."""
+    spatial = os.path.join(outs, "spatial")
+    files = {"scalefactors": os.path.join(spatial, "scalefactors_json.json")}
+    for name in ("tissue_positions.csv", "tissue_positions_list.csv"):    # Space Ranger >= 2.0, then older
+        if os.path.exists(os.path.join(spatial, name)):
+            files["positions"] = os.path.join(spatial, name)
+            break
+    for key in ("hires", "lowres"):
+        files[key] = os.path.join(spatial, f"tissue_{key}_image.png")
+    return {key: path for key, path in files.items() if os.path.exists(path)}
+
+
+def count_metadata(outs):
+    """``chemistry_description`` / ``software_version`` attributes of the count file, as sc.read_visium reads them."""
+    import h5py
+
+    with h5py.File(os.path.join(outs, COUNT_FILE), "r") as fh:
+        attrs = dict(fh.attrs)
+    return {key: str(attrs[key], "utf-8") if isinstance(attrs[key], bytes) else attrs[key]
+            for key in ("chemistry_description", "software_version") if key in attrs}
+
+
+def add_spatial(adata, outs, images=EAGER_IMAGES):
+    """
+    Spot positions, scale factors, count-file metadata and the ``images`` of
+    ``outs`` into ``adata``, as ``sc.read_visium(load_images=True)`` lays them
+    out; the paths of all images are kept in ``uns["spatial"][library]["image_files"]``
+    for ``load_images``.
+    """
+    import pandas as pd
+
+    files = spatial_files(outs)
+    library_id = next(iter(adata.uns["spatial"]))
+    positions = pd.read_csv(files["positions"], index_col=0,
+                            header=0 if os.path.basename(files["positions"]) == "tissue_positions.csv" else None)
+    positions.columns = ["in_tissue", "array_row", "array_col", "pxl_col_in_fullres", "pxl_row_in_fullres"]
+    adata.obs = adata.obs.join(positions, how="left")
+    adata.obsm["spatial"] = adata.obs[["pxl_row_in_fullres", "pxl_col_in_fullres"]].to_numpy()
+    adata.obs.drop(columns=["pxl_row_in_fullres", "pxl_col_in_fullres"], inplace=True)
+    with open(files["scalefactors"]) as fh:
+        scalefactors = json.load(fh)
+    library = adata.uns["spatial"][library_id]
+    library.update(images={}, scalefactors=scalefactors, metadata=count_metadata(outs),
+                   image_files={key: files[key] for key in ("hires", "lowres") if key in files})
+    load_images(adata, library_id, images)
+    return adata
+
+
+def load_images(adata, library_id=None, keys=("hires", "lowres")):
+    """
+    Read the H&E images ``keys`` of ``library_id`` (default: every library) into
+    ``adata.uns["spatial"]`` from their recorded files, if not there yet; returns ``adata``.
+    A recorded file is an image path, or ``{"store": h5ad / zarr path, "element": path in the store}``.
+    """
+    libraries = [library_id] if library_id is not None else list(adata.uns.get("spatial", {}))
+    for library_id in libraries:
+        library = adata.uns["spatial"][library_id]
+        images = library.setdefault("images", {})
+        for key in keys:
+            path = library.get("image_files", {}).get(key)
+            if key not in images and path is not None:
+                images[key] = read_image(path)
+    return adata
+
+
+def read_image(path):
+    """An image recorded in ``image_files``: an image file, or an element of an h5ad / zarr store."""
+    if isinstance(path, str):
+        from matplotlib.image import imread
+
+        return imread(path)
+    import anndata
+
+    if path["store"].endswith(".zarr"):
+        import zarr
+
+        return anndata.io.read_elem(zarr.open_group(path["store"], mode="r")[path["element"]])
+    import h5py
+
+    with h5py.File(path["store"], "r") as store:
+        return anndata.io.read_elem(store[path["element"]])
+
+
+def to_csr(adata):
+    """Keep ``X`` (and the layers) sparse CSR: dense or CSC matrices are converted."""
+    from scipy import sparse
+
+    for name, matrix in [(None, adata.X), *adata.layers.items()]:
+        if not sparse.isspmatrix_csr(matrix):
+            matrix = sparse.csr_matrix(matrix)
+            if name is None:
+                adata.X = matrix
+            else:
+                adata.layers[name] = matrix
+    return adata
+
+
+def read_and_qc(sample_name, path, mt_prefix="mt-", images=EAGER_IMAGES):
+    """
+    Read a 10X Visium sample (``<path>/<sample_name>/outs``) and compute QC
+    metrics, as the notebook's read_and_qc: ``sample`` / ``SYMBOL`` / ``ENSEMBL``
+    / ``mt`` annotations, ``calculate_qc_metrics``, ``mt_frac`` and spot IDs
+    prefixed with the sample name. Only ``images`` are read (see ``load_images``).
+    """
+    import scanpy as sc
+
+    outs = outs_dir(sample_name, path)
+    adata = sc.read_visium(outs, count_file=COUNT_FILE, load_images=False)  # counts + library id only
+    add_spatial(adata, outs, images)
+    to_csr(adata)
+    adata.obs['sample'] = str(sample_name)  # Annotate sample in obs
+    adata.var['SYMBOL'] = adata.var_names.copy()  # Preserve original gene symbols
+    adata.var.rename(columns={'gene_ids': 'ENSEMBL'}, inplace=True)  # Rename gene_ids to ENSEMBL
+    adata.var_names_make_unique() # Ensure unique var_names
+    adata.var['mt'] = [gene.lower().startswith(mt_prefix.lower()) for gene in adata.var['SYMBOL']]  # mt gene mask
+    sc.pp.calculate_qc_metrics(adata, qc_vars=['mt'], inplace=True)  # sparse-aware QC metrics incl. pct_counts_mt
+    adata.obs['mt_frac'] = adata.obs['pct_counts_mt'] / 100.0  # Mito fraction as ratio
+    adata.obs_names = adata.obs['sample'] + '_' + adata.obs_names  # Prefix spot IDs with sample name
+    adata.obs.index.name = 'spot_id'  # Name obs index as spot_id
+    return adata
+
+
+def read_h5ad(path, sample_name=None, make_unique=True):
+    """An h5ad as the human notebook prepares it: unique var_names, ``sample`` column, sparse X."""
+    import anndata
+
+    adata = anndata.read_h5ad(path)
+    if make_unique:
+        adata.var_names_make_unique()    # ensures gene names are unique
+    if sample_name is not None:
+        adata.obs["sample"] = sample_name
+    return to_csr(adata)
+
+
+def visium_inputs(sample_name, path):
+    """Source files whose identity keys the cache of a Visium sample."""
+    outs = outs_dir(sample_name, path)
+    files = spatial_files(outs)
+    return [os.path.join(outs, COUNT_FILE)] + [files[key] for key in sorted(files)]
+
+
+def cache_path(cache_dir, name, key, fmt):
+    return os.path.join(cache_dir, f"{name}-{key}.{fmt}")
+
+
+@contextlib.contextmanager
+def atomic_store(path):
+    """``cache.atomic_output`` for an h5ad file or a zarr folder: yields a temporary path renamed to ``path``."""
+    partial = os.path.join(os.path.dirname(path), f".{os.getpid()}.partial.{os.path.basename(path)}")
+    try:
+        yield partial
+        os.replace(partial, path)
+    finally:
+        if os.path.isdir(partial):
+            shutil.rmtree(partial)
+        elif os.path.exists(partial):
+            os.remove(partial)
+
+
+def write_cached(adata, path, fmt):
+    """Write ``adata`` to ``path`` under a temporary name, renamed into place when complete."""
+    with atomic_store(path) as partial:
+        if fmt == "zarr":
+            adata.write_zarr(partial)
+        else:
+            adata.write_h5ad(partial)
+    return path
+
+
+def read_cached(path, backed=None):
+    """A cached sample (``backed="r"``: h5ad matrix left on disk)."""
+    import anndata
+
+    if path.endswith(".zarr"):
+        return anndata.read_zarr(path)
+    return anndata.read_h5ad(path, backed=backed)
+
+
+def _build(reader, args, path, fmt):
+    """Worker task: build one sample with ``reader(*args)`` and write it to the cache; returns ``path``."""
+    return write_cached(reader(*args), path, fmt)
+
+
+def build_cached(tasks, cache_dir=DEFAULT_CACHE_DIR, fmt="h5ad", workers=None):
+    """
+    Cache paths of ``tasks`` (``[(name, reader, args, inputs, params)]``), in order:
+    each built by ``reader(*args)`` in a process pool unless its key (identity of
+    the ``inputs`` files and ``params``) is in ``cache_dir`` already.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown cache format {fmt!r}, expected one of {FORMATS}")
+    os.makedirs(cache_dir, exist_ok=True)
+    paths, missing = [], {}
+    for name, reader, args, inputs, params in tasks:
+        key = cache.fingerprint(inputs, {"loader": LOADER_VERSION, "reader": reader.__name__, **params})
+        path = cache_path(cache_dir, name, key, fmt)
+        paths.append(path)
+        if not os.path.exists(path):
+            missing[path] = (name, reader, args)
+    print(f"{len(tasks) - len(missing)} sample(s) from the cache, {len(missing)} to read")
+    if missing:
+        with cf.ProcessPoolExecutor(workers or default_workers(len(missing)),
+                                    mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = {pool.submit(_build, reader, args, path, fmt): name
+                       for path, (name, reader, args) in missing.items()}
+            for future in cf.as_completed(futures):
+                future.result() # a failing sample stops the load with its error
+                print(f"Loaded {futures[future]}")
+    return paths
+
+
+def load_cached(tasks, cache_dir=DEFAULT_CACHE_DIR, fmt="h5ad", workers=None, backed=None):
+    """``[AnnData]`` of ``tasks`` (see ``build_cached``), read from the cache."""
+    return [read_cached(path, backed) for path in build_cached(tasks, cache_dir, fmt, workers)]
+
+
+def visium_tasks(sample_names, path, mt_prefix="mt-", images=EAGER_IMAGES):
+    """``build_cached`` tasks of ``read_and_qc`` for every sample in ``sample_names``."""
+    images = tuple(images)
+    return [(str(sample_name), read_and_qc, (sample_name, path, mt_prefix, images),
+             visium_inputs(sample_name, path), {"mt_prefix": mt_prefix, "images": images})
+            for sample_name in sample_names]
+
+
+def h5ad_tasks(paths, sample_names=None, make_unique=True):
+    """``build_cached`` tasks of ``read_h5ad`` for every path (``sample`` column from ``sample_names``)."""
+    paths = list(paths)
+    sample_names = list(sample_names) if sample_names is not None else [None] * len(paths)
+    return [(sample_name or os.path.splitext(os.path.basename(path))[0], read_h5ad, (path, sample_name, make_unique),
+             [path], {"sample": sample_name, "make_unique": make_unique}) for path, sample_name in zip(paths, sample_names)]
+
+
+def load_visium(sample_names, path, mt_prefix="mt-", images=EAGER_IMAGES, cache_dir=DEFAULT_CACHE_DIR,
+                fmt="h5ad", workers=None):
+    """``read_and_qc`` of every sample in ``sample_names`` (``<path>/<sample>/outs``), in parallel and cached."""
+    return load_cached(visium_tasks(sample_names, path, mt_prefix, images), cache_dir, fmt, workers)
+
+
+def load_h5ads(paths, sample_names=None, make_unique=True, cache_dir=DEFAULT_CACHE_DIR, fmt="h5ad", workers=None,
+               backed=None):
+    """
+    ``read_h5ad`` of every path (``sample`` column from ``sample_names``), in
+    parallel and copied to the local cache; ``backed="r"`` leaves the matrices on disk.
+    """
+    return load_cached(h5ad_tasks(paths, sample_names, make_unique), cache_dir, fmt, workers, backed)